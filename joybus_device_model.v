@@ -0,0 +1,211 @@
+// Simulation model of a controller with a Controller Pak on the JoyBus line
+//
+// Bits are 4 us long and start low for 1 us (1) or 3 us (0), the timing
+// n64_sender.v produces and n64_receiver.v samples. Answers info, state,
+// pak read and pak write commands.
+`timescale 1ns / 1ps
+`default_nettype none
+
+module joybus_device_model (
+                            inout wire line
+                            );
+
+   // timings in ns
+   parameter BIT_TIME = 4000;
+   parameter SHORT_LOW = 1000;
+   parameter LONG_LOW = 3000;
+   // line idle this long after a falling edge ends a command
+   parameter IDLE_TIME = 6000;
+   parameter RESPONSE_DELAY = 2000;
+
+   // open drain, the testbench provides the pull-up
+   reg drive_low = 0;
+   assign line = drive_low ? 1'b 0 : 1'b z;
+
+   reg [7:0]  pak_mem [0:32767];
+   // chunk answered with a bad data CRC, to exercise error paths
+   reg [15:0] corrupt_addr = 16'h ffff;
+
+   integer    n_commands = 0;
+   integer    n_pak_reads = 0;
+   integer    n_pak_writes = 0;
+   integer    n_addr_crc_errors = 0;
+   integer    n_unknown = 0;
+
+   // Reference CRCs, written like crc_util.py rather than like the RTL
+
+   function [4:0] address_crc (input [10:0] page);
+      integer i;
+      reg [5:0] crc;
+      begin
+         crc = 0;
+         for (i = 10; i >= 0; i = i - 1) begin
+            crc = crc << 1;
+            if (page[i] == 0) begin
+               if (crc[5]) crc = crc ^ 6'h 15;
+            end else begin
+               if (crc[5]) crc = crc ^ 6'h 14;
+               else crc = crc + 1;
+            end
+         end
+         for (i = 0; i < 5; i = i + 1) begin
+            crc = crc << 1;
+            if (crc[5]) crc = crc ^ 6'h 15;
+         end
+         address_crc = crc[4:0];
+      end
+   endfunction
+
+   function [7:0] data_crc_update (input [7:0] crc_in, input [7:0] b);
+      integer i;
+      reg [8:0] crc;
+      begin
+         crc = {1'b 0, crc_in};
+         for (i = 7; i >= 0; i = i - 1) begin
+            crc = crc << 1;
+            if (b[i] == 0) begin
+               if (crc[8]) crc = crc ^ 9'h 85;
+            end else begin
+               if (crc[8]) crc = crc ^ 9'h 84;
+               else crc = crc + 1;
+            end
+         end
+         data_crc_update = crc[7:0];
+      end
+   endfunction
+
+   function [7:0] data_crc_finish (input [7:0] crc_in);
+      integer i;
+      reg [8:0] crc;
+      begin
+         crc = {1'b 0, crc_in};
+         for (i = 0; i < 8; i = i + 1) begin
+            crc = crc << 1;
+            if (crc[8]) crc = crc ^ 9'h 85;
+         end
+         data_crc_finish = crc[7:0];
+      end
+   endfunction
+
+   // Data CRC of the 32 byte pak chunk at addr
+   function [7:0] chunk_crc (input [15:0] addr);
+      integer i;
+      reg [7:0] crc;
+      begin
+         crc = 0;
+         for (i = 0; i < 32; i = i + 1)
+           crc = data_crc_update(crc, pak_mem[addr[14:0] + i]);
+         chunk_crc = data_crc_finish(crc);
+      end
+   endfunction
+
+   // longest command is a pak write, plus its stop bit
+   reg [7:0] cmd [0:36];
+   reg [7:0] resp [0:32];
+   integer   cmd_bits;
+
+   // Receive a console command; the final bit is the stop bit
+   task receive;
+      time    fall;
+      reg     done;
+      begin
+         cmd_bits = 0;
+         done = 0;
+         @(negedge line);
+         while (!done) begin
+            fall = $time;
+            @(posedge line);
+            cmd[cmd_bits / 8][7 - cmd_bits % 8] = ($time - fall) < 2000;
+            cmd_bits = cmd_bits + 1;
+
+            done = 1;
+            fork : next_bit
+               begin
+                  @(negedge line);
+                  done = 0;
+                  disable next_bit;
+               end
+               begin
+                  #(IDLE_TIME);
+                  disable next_bit;
+               end
+            join
+         end
+         // drop the stop bit
+         cmd_bits = cmd_bits - 1;
+      end
+   endtask
+
+   task send_bit (input b);
+      begin
+         drive_low = 1;
+         #(b ? SHORT_LOW : LONG_LOW);
+         drive_low = 0;
+         #(BIT_TIME - (b ? SHORT_LOW : LONG_LOW));
+      end
+   endtask
+
+   task send (input integer n_bytes);
+      integer i, j;
+      begin
+         #(RESPONSE_DELAY);
+         for (i = 0; i < n_bytes; i = i + 1)
+           for (j = 7; j >= 0; j = j - 1)
+             send_bit(resp[i][j]);
+         // stop bit
+         send_bit(1);
+      end
+   endtask
+
+   reg [15:0] addr;
+   reg [7:0]  crc;
+   integer    k;
+   always begin
+      receive;
+      n_commands = n_commands + 1;
+
+      if (cmd_bits == 8 && (cmd[0] == 8'h 00 || cmd[0] == 8'h ff)) begin
+         // info: standard controller, pak present
+         resp[0] = 8'h 05;
+         resp[1] = 8'h 00;
+         resp[2] = 8'h 01;
+         send(3);
+      end else if (cmd_bits == 8 && cmd[0] == 8'h 01) begin
+         // state: no buttons, stick centered
+         for (k = 0; k < 4; k = k + 1)
+           resp[k] = 8'h 00;
+         send(4);
+      end else if ((cmd_bits == 24 && cmd[0] == 8'h 02) ||
+                   (cmd_bits == 280 && cmd[0] == 8'h 03)) begin
+         addr = {cmd[1], cmd[2][7:5], 5'b 00000};
+         if (cmd[2][4:0] != address_crc(addr[15:5])) begin
+            $display("bad address CRC %02x for %04x", cmd[2][4:0], addr);
+            n_addr_crc_errors = n_addr_crc_errors + 1;
+         end
+
+         if (cmd[0] == 8'h 02) begin
+            for (k = 0; k < 32; k = k + 1)
+              resp[k] = pak_mem[addr[14:0] + k];
+            resp[32] = chunk_crc(addr);
+            if (addr == corrupt_addr)
+              resp[32] = ~resp[32];
+            n_pak_reads = n_pak_reads + 1;
+            send(33);
+         end else begin
+            crc = 0;
+            for (k = 0; k < 32; k = k + 1) begin
+               pak_mem[addr[14:0] + k] = cmd[3 + k];
+               crc = data_crc_update(crc, cmd[3 + k]);
+            end
+            resp[0] = data_crc_finish(crc);
+            n_pak_writes = n_pak_writes + 1;
+            send(1);
+         end
+      end else begin
+         $display("unexpected JoyBus command %02x, %0d bits", cmd[0],
+                  cmd_bits);
+         n_unknown = n_unknown + 1;
+      end
+   end
+
+endmodule // joybus_device_model
@@ -1,10 +1,40 @@
+import contextlib
+import mmap
+import os
 from .accessory import Accessory
-from gb_cart import GBHeader
+from itertools import groupby
+from dump_verify import DumpHasher, block_digest
+from gb_cart import GBHeader, GlobalChecksum
+from gb_mbc import make_mbc
 from tqdm import tqdm
+from controller import BadCRCException
 
 GB_ROM_BANK_SZ = 0x4000
 GB_RAM_BANK_SZ = 0x2000
 
+# Transfer Pak window onto the cart address space
+TPAK_BANK_SZ = 0x4000
+
+
+def align_range(address, length):
+    """Smallest 32 byte aligned (start, end) covering a byte range"""
+    return address & ~0x1f, (address + length + 0x1f) & ~0x1f
+
+
+def merge_ranges(ranges):
+    """Merge (address, length) ranges into sorted aligned (start, end) spans
+
+    Ranges that overlap or touch after alignment share a span, so every
+    32 byte block is only transferred once.
+    """
+    spans = []
+    for start, end in sorted(align_range(a, n) for a, n in ranges if n > 0):
+        if spans and start <= spans[-1][1]:
+            spans[-1][1] = max(spans[-1][1], end)
+        else:
+            spans.append([start, end])
+    return [tuple(span) for span in spans]
+
 
 class TransferPak(Accessory):
 
@@ -15,6 +45,7 @@ class TransferPak(Accessory):
         self.verbose = verbose
 
         self.gb_header = None
+        self.mbc = None
         self.cart_powered = False
 
         self.last_tpak_bank = None
@@ -28,14 +59,21 @@ class TransferPak(Accessory):
         tpak_addr += 0xc000
         return bank, tpak_addr
 
-    def cart_present(self):
-        """Check if cartridge is present"""
+    def cart_present(self, refresh=False):
+        """Check if cartridge is present
+
+        The result is cached in the pad session until the pak is changed.
+        """
+        session = self.pad.session
+        if session.cart_present is not None and not refresh:
+            return session.cart_present
 
         check_mode = self.pad.pak_read(0xb000)
         if self.verbose:
             print(f'check mode: {check_mode.hex()}')
 
-        return check_mode[31] == 0x80
+        session.cart_present = check_mode[31] == 0x80
+        return session.cart_present
 
     def cart_enable(self, enable):
         """Enable/power cartridge"""
@@ -49,35 +87,44 @@ class TransferPak(Accessory):
         # set access mode
         self.pad.pak_write(0xb000, data)
 
+        # MBC registers are reset by the power cycle
+        if self.mbc is not None:
+            self.mbc.reset()
+
     def cart_enable_ram(self, enable):
         """Enable read/write to external RAM"""
         if self.gb_header.get_ram_size() == 0:
             raise Exception('Cartridge has no RAM')
 
-        if enable:
-            data = b'\x0a'
-        else:
-            data = b'\x00'
-
-        self.cart_write_fill(0, data)
+        self.mbc.enable_ram(enable)
 
     def switch_tpak_bank(self, bank):
         if self.last_tpak_bank != bank:
             self.last_tpak_bank = bank
             self.pad.pak_write(0xa000, bytes([bank]) * 32)
 
-    def cart_read(self, address):
-        """Read from GB cart address"""
+    def check_cart_read(self, address):
         if not self.cart_powered:
             raise Exception('cart not powered on')
 
         if address < 0 or address > 0xffff:
             raise ValueError('address out of range')
         elif address & 0x1f != 0:
-            # TODO allow arbitrary address
+            # see cart_read_range for arbitrary addresses
             raise ValueError('address must be multiple of 32')
 
-        # TODO count of bytes to read
+    def check_cart_range(self, address, length):
+        if not self.cart_powered:
+            raise Exception('cart not powered on')
+
+        if length < 0:
+            raise ValueError('length must not be negative')
+        elif address < 0 or address + length > 0x10000:
+            raise ValueError('address out of range')
+
+    def cart_read(self, address):
+        """Read from GB cart address"""
+        self.check_cart_read(address)
 
         # automatic Transfer Pak bank switching
         tpak_bank, tpak_addr = self.translate_cart_addr(address)
@@ -86,20 +133,138 @@ class TransferPak(Accessory):
         self.switch_tpak_bank(tpak_bank)
         return self.pad.pak_read(tpak_addr)
 
-    def cart_write(self, address, data):
-        """Write to GB cart address"""
+    def cart_read_into(self, address, view):
+        """Read 32 bytes from GB cart address into a writable view"""
+        self.check_cart_read(address)
 
-        if not self.cart_powered:
-            raise Exception('cart not powered on')
+        tpak_bank, tpak_addr = self.translate_cart_addr(address)
+        self.switch_tpak_bank(tpak_bank)
+        self.pad.pak_read_into(tpak_addr, view)
 
-        if address < 0 or address > 0xffff:
-            raise ValueError('address out of range')
-        elif address & 0x1f != 0:
-            # TODO allow arbitrary address
-            raise ValueError('address must be multiple of 32')
-        elif len(data) != 32:
+    def cart_read_many(self, addresses, progress=None):
+        """Read a sequence of 32 byte chunks from GB cart addresses"""
+        for address in addresses:
+            self.check_cart_read(address)
+
+        chunks = []
+
+        # Hand each run of reads within one Transfer Pak bank to the
+        # controller at once so it can pipeline them
+        for tpak_bank, run in groupby(addresses, key=lambda a: a // 0x4000):
+            tpak_addrs = [self.translate_cart_addr(a)[1] for a in run]
+            self.switch_tpak_bank(tpak_bank)
+            chunks += self.pad.pak_read_many(tpak_addrs, progress)
+
+        return chunks
+
+    def cart_read_many_into(self, addresses, view, progress=None):
+        """Read 32 byte chunks from GB cart addresses into view
+
+        Chunks land in consecutive 32 byte parts of view, which must be
+        exactly large enough to hold them.
+        """
+        addresses = list(addresses)
+        for address in addresses:
+            self.check_cart_read(address)
+
+        if len(view) != len(addresses) * 32:
+            raise ValueError(f'view must be {len(addresses) * 32} bytes')
+
+        view = memoryview(view)
+        start = 0
+        for tpak_bank, run in groupby(addresses, key=lambda a: a // 0x4000):
+            tpak_addrs = [self.translate_cart_addr(a)[1] for a in run]
+            end = start + len(tpak_addrs) * 32
+            self.switch_tpak_bank(tpak_bank)
+            self.pad.pak_read_many_into(tpak_addrs, view[start:end], progress)
+            start = end
+
+    def cart_read_range(self, address, length, progress=None):
+        """Read length bytes from any GB cart address
+
+        The covering 32 byte blocks are read in one pipelined batch,
+        switching Transfer Pak banks where the range crosses them.
+        """
+        self.check_cart_range(address, length)
+        if length == 0:
+            return b''
+
+        start, end = align_range(address, length)
+        data = bytearray(end - start)
+        self.cart_read_many_into(range(start, end, 32), data, progress)
+        return bytes(data[address - start:address - start + length])
+
+    def cart_read_ranges(self, ranges, progress=None):
+        """Read several (address, length) ranges, return their data
+
+        Overlapping and adjacent ranges are merged so shared blocks are
+        read once, and all of them are read in one batch.
+        """
+        ranges = list(ranges)
+        for address, length in ranges:
+            self.check_cart_range(address, length)
+
+        spans = merge_ranges(ranges)
+        addresses = [a for start, end in spans for a in range(start, end, 32)]
+        data = bytearray(len(addresses) * 32)
+        self.cart_read_many_into(addresses, data, progress)
+
+        # offset of each span in data
+        offsets = []
+        offset = 0
+        for start, end in spans:
+            offsets.append(offset)
+            offset += end - start
+
+        results = []
+        for address, length in ranges:
+            for (start, end), offset in zip(spans, offsets):
+                if start <= address < end:
+                    break
+            else:
+                results.append(b'')
+                continue
+            offset += address - start
+            results.append(bytes(data[offset:offset + length]))
+        return results
+
+    def cart_read_iter(self, address, length, chunk_size=0x400,
+                       progress=None):
+        """Yield (address, data) pieces of a range as they are read
+
+        Pieces are at most chunk_size bytes and never cross a Transfer
+        Pak bank, so each one is a single pipelined batch of reads.
+        """
+        self.check_cart_range(address, length)
+        if chunk_size <= 0 or chunk_size & 0x1f:
+            raise ValueError('chunk size must be a multiple of 32')
+
+        start, end = align_range(address, length)
+        stop = address + length
+        buf = bytearray(chunk_size)
+        pos = start
+        while pos < end:
+            next_bank = (pos // TPAK_BANK_SZ + 1) * TPAK_BANK_SZ
+            piece_end = min(pos + chunk_size, next_bank, end)
+
+            with memoryview(buf)[:piece_end - pos] as view:
+                self.cart_read_many_into(range(pos, piece_end, 32), view,
+                                         progress)
+
+            lo = max(pos, address)
+            hi = min(piece_end, stop)
+            yield lo, bytes(buf[lo - pos:hi - pos])
+            pos = piece_end
+
+    def check_cart_write(self, address, data):
+        self.check_cart_read(address)
+        if len(data) != 32:
             raise ValueError('data must be 32 bytes')
 
+    def cart_write(self, address, data):
+        """Write to GB cart address"""
+        self.check_cart_write(address, data)
+
         # automatic Transfer Pak bank switching
         tpak_bank, tpak_addr = self.translate_cart_addr(address)
 
@@ -107,6 +272,54 @@ class TransferPak(Accessory):
         self.switch_tpak_bank(tpak_bank)
         return self.pad.pak_write(tpak_addr, data)
 
+    def cart_write_many(self, blocks, progress=None, return_exceptions=False):
+        """Write a sequence of (address, 32 byte chunk) to GB cart addresses
+
+        With return_exceptions, a failed write gives its BadCRCException
+        in place of the response instead of raising.
+        """
+        blocks = list(blocks)
+        for address, data in blocks:
+            self.check_cart_write(address, data)
+
+        responses = []
+        for tpak_bank, run in groupby(blocks, key=lambda b: b[0] // 0x4000):
+            tpak_blocks = [(self.translate_cart_addr(a)[1], data)
+                           for a, data in run]
+            self.switch_tpak_bank(tpak_bank)
+            responses += self.pad.pak_write_many(tpak_blocks, progress,
+                                                 return_exceptions)
+        return responses
+
+    def cart_write_range(self, address, data, progress=None):
+        """Write data to any GB cart address
+
+        Blocks only partly covered by data are read first and written
+        back with the rest of their bytes unchanged, so unaligned writes
+        are only meaningful for cart RAM, not MBC registers.
+        """
+        self.check_cart_range(address, len(data))
+        if len(data) == 0:
+            return
+
+        start, end = align_range(address, len(data))
+        image = bytearray(end - start)
+
+        # partial blocks at either end
+        edges = set()
+        if address != start:
+            edges.add(start)
+        if address + len(data) != end:
+            edges.add(end - 32)
+        for block in sorted(edges):
+            self.cart_read_into(block, memoryview(image)[block - start:
+                                                         block - start + 32])
+
+        image[address - start:address - start + len(data)] = data
+        self.cart_write_many(
+            [(a, bytes(image[a - start:a - start + 32]))
+             for a in range(start, end, 32)], progress)
+
     def cart_write_fill(self, address, byte):
         """Write repeating byte to GB cart address"""
         if type(byte) is int:
@@ -119,10 +332,7 @@ class TransferPak(Accessory):
         self.cart_write(address, byte * 32)
 
     def load_rom_header(self, verify=True):
-        data = self.cart_read(0x100) + \
-            self.cart_read(0x120) + \
-            self.cart_read(0x140)
-        data = data[:80]
+        data = self.cart_read_range(0x100, 0x50)
         gb_header = GBHeader(data)
 
         if verify and not gb_header.verify_logo():
@@ -136,139 +346,247 @@ class TransferPak(Accessory):
             return False
 
         self.gb_header = gb_header
+        self.mbc = make_mbc(self, gb_header)
         return True
 
+    def check_mbc(self):
+        if self.mbc is None:
+            raise NotImplementedError(
+                f'Unsupported MBC type {self.gb_header.get_mbc_type()}')
+
     def switch_rom_bank(self, rom_bank):
-        if rom_bank < 0:
-            raise ValueError('ROM bank must be positive')
-
-        mbc_type = self.gb_header.get_mbc_type()
-
-        if mbc_type == 'NO_MBC':
-            if rom_bank > 1:
-                raise ValueError('No MBC, only banks 0 and 1 allowed')
-        elif mbc_type == 'MBC1':
-            # There's a lot of special case handling for banks 0x20/0x40/0x60.
-            # It would probably be better to implement MBC classes to abstract
-            # out bank reads instead of just bank switching.
-            if rom_bank > 0x1f:
-                raise NotImplementedError('MBC1 handling 0x20, 0x40, 0x60 not implemented')
-
-            # Select simple ROM banking mode
-            self.cart_write_fill(0x6000, b'\x00')
-
-            # Low 5 bits
-            low_n = rom_bank & 0x1f
-            self.cart_write_fill(0x2000, low_n)
-        elif mbc_type == 'MBC3':
-            # 7 bit ROM bank number
-            low_n = rom_bank & 0x7f
-            self.cart_write_fill(0x2000, low_n)
-        elif mbc_type == 'MBC5':
-            # Low 8 bits of ROM bank number
-            low_n = rom_bank & 0xff
-            self.cart_write_fill(0x2000, low_n)
-
-            # High bit of ROM bank number
-            high_n = (rom_bank >> 8) & 1
-            self.cart_write_fill(0x3000, high_n)
-        else:
-            raise NotImplementedError('Unsupported MBC type {mbc_type}')
+        """Map ROM bank, return the cart address it is visible at"""
+        self.check_mbc()
+        return self.mbc.select_rom_bank(rom_bank)
 
     def read_rom_bank(self, rom_bank, progress=None):
         """Read full ROM bank from cartridge"""
+        data = bytearray(GB_ROM_BANK_SZ)
+        self.read_rom_bank_into(rom_bank, data, progress)
+        return bytes(data)
 
-        if rom_bank == 0:
-            # Bank 0 always at 0000-3fff
-            chunks = []
-            for addr in range(0x0000, 0x4000, 32):
-                chunks.append(self.cart_read(addr))
-                if progress is not None:
-                    progress.update(32)
-            return b''.join(chunks)
-        else:
-            # Switched banks at 4000-7fff
-            # (TODO: except special cases for MBC1)
-            self.switch_rom_bank(rom_bank)
+    def read_rom_bank_into(self, rom_bank, view, progress=None):
+        """Read full ROM bank into a 16 KB writable view"""
+
+        # Bank 0 and MBC1 banks 20/40/60 are at 0000-3fff,
+        # switched banks at 4000-7fff
+        base = self.switch_rom_bank(rom_bank)
 
-            chunks = []
-            for addr in range(0x4000, 0x8000, 32):
-                chunks.append(self.cart_read(addr))
-                if progress is not None:
-                    progress.update(32)
-            return b''.join(chunks)
+        self.cart_read_many_into(
+            range(base, base + GB_ROM_BANK_SZ, 32), view, progress)
 
     def switch_ram_bank(self, ram_bank):
-        mbc_type = self.gb_header.get_mbc_type()
-
-        if mbc_type == 'NO_MBC':
-            if ram_bank != 0:
-                raise ValueError('Only one RAM bank with no MBC')
-        elif mbc_type == 'MBC1':
-            # Select RAM banking mode
-            self.cart_write_fill(0x6000, b'\x01')
-
-            # Set 2 bit RAM bank number
-            ram_bank &= 3
-            self.cart_write_fill(0x4000, ram_bank)
-        elif mbc_type == 'MBC3':
-            # Set 2 bit RAM bank number
-            ram_bank &= 3
-            self.cart_write_fill(0x4000, ram_bank)
-        elif mbc_type == 'MBC5':
-            self.cart_write_fill(0x4000, ram_bank)
-        else:
-            raise NotImplementedError()
+        self.check_mbc()
+        self.mbc.select_ram_bank(ram_bank)
+
+    def ram_bank_size(self):
+        # MBC2 has less than a full bank of RAM
+        return min(self.gb_header.get_ram_size(), GB_RAM_BANK_SZ)
 
     def read_ram_bank(self, ram_bank, progress=None):
         """Read full RAM bank from cartridge"""
+        data = bytearray(self.ram_bank_size())
+        self.read_ram_bank_into(ram_bank, data, progress)
+        return bytes(data)
+
+    def read_ram_bank_into(self, ram_bank, view, progress=None):
+        """Read full RAM bank into a writable view of the bank size"""
 
         self.switch_ram_bank(ram_bank)
 
-        chunks = []
-        for addr in range(0xa000, 0xc000, 32):
-            chunks.append(self.cart_read(addr))
-            if progress is not None:
-                progress.update(32)
+        size = self.ram_bank_size()
+        self.cart_read_many_into(range(0xa000, 0xa000 + size, 32), view,
+                                 progress)
 
-        return b''.join(chunks)
+    def dump_rom(self, rom_filename, verify=True, max_rereads=3,
+                 progress=None, expected=None, archive=None):
+        """Dump cartridge ROM banks to file
 
-    def dump_rom(self, rom_filename):
-        """Dump cartridge ROM banks to file"""
+        Banks are hashed as they arrive and the result is checked against
+        the header global checksum, and against the expected digests
+        (e.g. from a cart database entry) if given. On a mismatch the cart
+        is read a second time and only banks that differ between the
+        passes are re-read. With an archive, rom_filename is the dump name
+        and banks are stored in the archive instead of a file.
+        Returns the verification report, or None if nothing was dumped.
+        """
 
         rom_size = self.gb_header.get_rom_size()
         if rom_size == 0:
             print('No ROM banks to dump')
-            return
+            return None
 
         # Check MBC type is supported
-        try:
-            self.switch_rom_bank(1)
-        except NotImplementedError:
+        if self.mbc is None:
             print('ROM bank switching for MBC type not implemented')
-            return
-        except Exception:
-            # Skip cart power exception
-            pass
+            return None
 
-        rom_file = open(rom_filename, 'wb')
         n_rom_banks = rom_size // GB_ROM_BANK_SZ
-        print(f'Dumping {n_rom_banks} ROM banks to {rom_filename}...')
-
-        # progress bar
-        progress = tqdm(total=rom_size)
+        if n_rom_banks > self.mbc.max_rom_banks:
+            print(f'{self.mbc.name} cannot address {n_rom_banks} ROM banks')
+            return None
+
+        with contextlib.ExitStack() as stack:
+            writer = None
+            if archive is None:
+                rom_file = stack.enter_context(open(rom_filename, 'w+b'))
+                rom_file.truncate(rom_size)
+                # banks are read straight into the mapped file
+                rom_image = stack.enter_context(
+                    mmap.mmap(rom_file.fileno(), rom_size))
+            else:
+                # banks are stored as they arrive, the image is only kept
+                # for hashing and re-reads
+                rom_image = stack.enter_context(mmap.mmap(-1, rom_size))
+                writer = archive.writer(rom_filename, 'rom', rom_size)
+            rom_view = stack.enter_context(memoryview(rom_image))
+            print(f'Dumping {n_rom_banks} ROM banks to {rom_filename}...')
+
+            hasher = DumpHasher()
+            # drop views of banks still waiting to be hashed if a read
+            # fails, so the image can be unmapped
+            stack.callback(hasher.pending.clear)
+
+            checksum = GlobalChecksum()
+            bank_digests = [None] * n_rom_banks
+
+            # progress bar
+            if progress is None:
+                progress = tqdm(total=rom_size)
+            else:
+                progress.reset(total=rom_size)
+
+            self.cart_enable(True)
+            for rom_bank in self.mbc.plan_rom_reads(range(n_rom_banks)):
+                offset = rom_bank * GB_ROM_BANK_SZ
+                with rom_view[offset:offset + GB_ROM_BANK_SZ] as bank_data:
+                    self.read_rom_bank_into(rom_bank, bank_data,
+                                            progress=progress)
+                    checksum.update(offset, bank_data)
+                    bank_digests[rom_bank] = block_digest(bank_data)
+                    if writer is not None:
+                        writer.write(offset, bank_data)
+
+                # held by the hasher until the banks before it are hashed
+                hasher.update(rom_view[offset:offset + GB_ROM_BANK_SZ], offset)
+            self.cart_enable(False)
+
+            progress.close()
+
+            report = hasher.digests()
+            report['global_checksum'] = checksum.value()
+            report['reread_banks'] = []
+            if expected is not None:
+                report['expected_sha1'] = expected['sha1']
+
+            if verify and not self.rom_report_ok(report):
+                print('ROM does not verify, reading ROM a second time...')
+                report['reread_banks'] = self.reread_rom_banks(
+                    rom_view, bank_digests, max_rereads)
+
+                # hash the patched image
+                hasher = DumpHasher()
+                hasher.update(rom_view)
+                checksum = GlobalChecksum()
+                checksum.update(0, rom_view)
+                report.update(hasher.digests())
+                report['global_checksum'] = checksum.value()
+
+                if writer is not None:
+                    for rom_bank in report['reread_banks']:
+                        offset = rom_bank * GB_ROM_BANK_SZ
+                        writer.write(offset,
+                                     rom_view[offset:offset + GB_ROM_BANK_SZ])
+
+            if writer is not None:
+                writer.commit(dict(report, title=self.title()))
+
+        if verify:
+            self.print_rom_report(report)
+
+        return report
+
+    def reread_rom_banks(self, rom_view, bank_digests, max_rereads):
+        """Read every bank again, fix the ones that differ between passes
+
+        A differing bank is re-read until two reads in a row agree, then
+        written over its slot in rom_view.
+        Returns the list of banks that were fixed.
+        """
+        n_rom_banks = len(bank_digests)
+        progress = tqdm(total=n_rom_banks * GB_ROM_BANK_SZ)
+
+        # one bank buffer reused for every read
+        bank_data = bytearray(GB_ROM_BANK_SZ)
 
         self.cart_enable(True)
-        for rom_bank in range(n_rom_banks):
-            bank_data = self.read_rom_bank(rom_bank, progress=progress)
-            rom_file.write(bank_data)
+        unstable = []
+        for rom_bank in self.mbc.plan_rom_reads(range(n_rom_banks)):
+            self.read_rom_bank_into(rom_bank, bank_data, progress=progress)
+            digest = block_digest(bank_data)
+            if digest != bank_digests[rom_bank]:
+                unstable.append(rom_bank)
+                bank_digests[rom_bank] = digest
+        progress.close()
+
+        fixed = []
+        for rom_bank in unstable:
+            print(f'bank {rom_bank:#x} differs between passes, re-reading')
+            for attempt in range(max_rereads):
+                self.read_rom_bank_into(rom_bank, bank_data)
+                digest = block_digest(bank_data)
+                if digest == bank_digests[rom_bank]:
+                    offset = rom_bank * GB_ROM_BANK_SZ
+                    rom_view[offset:offset + GB_ROM_BANK_SZ] = bank_data
+                    fixed.append(rom_bank)
+                    break
+                bank_digests[rom_bank] = digest
+            else:
+                print(f'bank {rom_bank:#x} did not read back consistently')
         self.cart_enable(False)
 
-        progress.close()
-        rom_file.close()
+        return fixed
 
-    def dump_ram(self, ram_filename):
-        """Dump cartridge RAM banks to file"""
+    def rom_report_ok(self, report):
+        """Global checksum and any expected SHA-1 match the dump"""
+        if report['global_checksum'] != self.gb_header.global_checksum:
+            return False
+        return report.get('expected_sha1', report['sha1']) == report['sha1']
+
+    def print_rom_report(self, report):
+        expected = self.gb_header.global_checksum
+        calculated = report['global_checksum']
+
+        print('ROM verification:')
+        print(f'  CRC32: {report["crc32"]}')
+        print(f'  MD5:   {report["md5"]}')
+        print(f'  SHA-1: {report["sha1"]}')
+
+        status = 'OK' if calculated == expected else 'MISMATCH'
+        print(f'  global checksum: {calculated:04x} '
+              f'(header {expected:04x}) {status}')
+
+        if 'expected_sha1' in report:
+            status = 'OK' if report['sha1'] == report['expected_sha1'] \
+                else 'MISMATCH'
+            print(f'  database SHA-1: {report["expected_sha1"]} {status}')
+
+        if report['reread_banks']:
+            banks = ', '.join(f'{b:#x}' for b in report['reread_banks'])
+            print(f'  re-read banks: {banks}')
+        elif not self.rom_report_ok(report):
+            print('  dump is consistent between passes, '
+                  'header checksum or database entry may be wrong')
+
+    def title(self):
+        return self.gb_header.title_guess().decode('ascii', 'replace')
+
+    def dump_ram(self, ram_filename, progress=None, archive=None):
+        """Dump cartridge RAM banks to file
+
+        With an archive, ram_filename is the dump name and the banks are
+        stored in the archive instead of a file.
+        """
 
         ram_size = self.gb_header.get_ram_size()
         if ram_size == 0:
@@ -276,31 +594,146 @@ class TransferPak(Accessory):
             return
 
         # Check MBC type is supported
-        try:
-            self.switch_ram_bank(0)
-        except NotImplementedError:
+        if self.mbc is None:
             print('RAM bank switching for MBC type not implemented')
             return
-        except Exception:
-            # Skip cart power exception
-            pass
 
-        ram_file = open(ram_filename, 'wb')
-        n_ram_banks = ram_size // GB_RAM_BANK_SZ
+        ram_file = open(ram_filename, 'wb') if archive is None else None
+        n_ram_banks = max(ram_size // GB_RAM_BANK_SZ, 1)
+        bank_size = self.ram_bank_size()
+        # banks are read straight into one image, written out at the end
+        ram_image = bytearray(n_ram_banks * bank_size)
+        ram_view = memoryview(ram_image)
         print(f'Dumping {n_ram_banks} RAM banks to {ram_filename}...')
 
         # progress bar
-        progress = tqdm(total=ram_size)
+        if progress is None:
+            progress = tqdm(total=ram_size)
+        else:
+            progress.reset(total=ram_size)
 
         self.cart_enable(True)
         self.cart_enable_ram(True)
 
         for ram_bank in range(n_ram_banks):
-            ram_data = self.read_ram_bank(ram_bank, progress=progress)
-            ram_file.write(ram_data)
+            offset = ram_bank * bank_size
+            self.read_ram_bank_into(ram_bank,
+                                    ram_view[offset:offset + bank_size],
+                                    progress=progress)
 
         self.cart_enable_ram(False)
         self.cart_enable(False)
 
         progress.close()
-        ram_file.close()
+        if ram_file is None:
+            archive.put(ram_filename, 'ram', ram_image,
+                        {'title': self.title()})
+        else:
+            ram_file.write(ram_image)
+            ram_file.close()
+
+    def restore_ram(self, ram_filename, reference_filename=None,
+                    progress=None):
+        """Write a save file to cartridge RAM, skipping unchanged blocks
+
+        The file is written one bank at a time. The current contents are
+        taken from the reference image if given (for example the last
+        dump of the cart), otherwise each bank is read before it is
+        written. The CRC returned by each write verifies it, so there is
+        no read-back pass. The reference is updated after the restore.
+        Returns the number of blocks written, or None if nothing was.
+        """
+
+        ram_size = self.gb_header.get_ram_size()
+        if ram_size == 0:
+            print('No RAM to restore')
+            return None
+
+        # Check MBC type is supported
+        if self.mbc is None:
+            print('RAM bank switching for MBC type not implemented')
+            return None
+
+        n_ram_banks = max(ram_size // GB_RAM_BANK_SZ, 1)
+        bank_size = self.ram_bank_size()
+        image_size = n_ram_banks * bank_size
+
+        if os.path.getsize(ram_filename) != image_size:
+            print(f'save file must be {image_size:#x} bytes')
+            return None
+
+        reference = None
+        if reference_filename is not None and \
+           os.path.exists(reference_filename):
+            with open(reference_filename, 'rb') as f:
+                reference = f.read()
+            if len(reference) != image_size:
+                print(f'reference image must be {image_size:#x} bytes')
+                return None
+
+        print(f'Restoring {ram_filename} to {n_ram_banks} RAM banks...')
+
+        # progress bar
+        if progress is None:
+            progress = tqdm(total=image_size)
+        else:
+            progress.reset(total=image_size)
+
+        current = bytearray(bank_size)
+        n_written = 0
+
+        self.cart_enable(True)
+        self.cart_enable_ram(True)
+
+        try:
+            with open(ram_filename, 'rb') as ram_file:
+                for ram_bank in range(n_ram_banks):
+                    data = ram_file.read(bank_size)
+                    offset = ram_bank * bank_size
+
+                    if reference is None:
+                        self.read_ram_bank_into(ram_bank, current)
+                    else:
+                        self.switch_ram_bank(ram_bank)
+                        current[:] = reference[offset:offset + bank_size]
+
+                    blocks = [(0xa000 + i, data[i:i + 32])
+                              for i in range(0, bank_size, 32)
+                              if data[i:i + 32] != current[i:i + 32]]
+                    progress.update(bank_size - len(blocks) * 32)
+
+                    self.write_ram_blocks(blocks, progress)
+                    n_written += len(blocks)
+        finally:
+            self.cart_enable_ram(False)
+            self.cart_enable(False)
+            progress.close()
+
+        print(f'{n_written} of {image_size // 32} blocks changed')
+
+        if reference_filename is not None:
+            with open(ram_filename, 'rb') as f:
+                image = f.read()
+            with open(reference_filename, 'wb') as f:
+                f.write(image)
+
+        return n_written
+
+    def write_ram_blocks(self, blocks, progress=None, max_attempts=3):
+        """Write blocks to the selected RAM bank, retrying bad CRCs"""
+        for attempt in range(max_attempts):
+            results = self.cart_write_many(blocks, progress,
+                                           return_exceptions=True)
+            blocks = [block for block, result in zip(blocks, results)
+                      if isinstance(result, BadCRCException)]
+            if not blocks:
+                return
+
+            if self.pad.metrics is not None:
+                self.pad.metrics.count('retry', 'pak_write', len(blocks))
+            for address, data in blocks:
+                progress.write(f'bad CRC, retrying address {address:04x}')
+
+        raise BadCRCException(
+            f'{len(blocks)} blocks failed to write, first at '
+            f'{blocks[0][0]:04x}')
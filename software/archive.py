@@ -0,0 +1,310 @@
+#!/usr/bin/env python3
+import argparse
+import json
+import os
+import struct
+import threading
+import time
+import zlib
+from dump_verify import block_digest
+
+# Block size per kind of dump: ROM banks, RAM banks, Controller Pak pages
+BLOCK_SIZES = {'rom': 0x4000, 'ram': 0x2000, 'cpak': 0x100}
+
+MANIFEST_VERSION = 1
+
+# Pack records: block digest, compressed length, then the zlib data
+RECORD = struct.Struct('<16sI')
+
+# Pack index entries: block digest, record offset in the pack
+INDEX_ENTRY = struct.Struct('<16sQ')
+
+
+class DumpWriter:
+    """Stores the blocks of one dump as they arrive
+
+    Blocks can be written in any order, and written again (e.g. after a
+    re-read); the last write counts. commit() writes the manifest.
+    """
+
+    def __init__(self, archive, name, kind, size):
+        if kind not in BLOCK_SIZES:
+            raise ValueError(f'unknown dump kind {kind}')
+
+        # check the name before any blocks are stored for it
+        archive.manifest_path(name)
+
+        self.archive = archive
+        self.name = name
+        self.kind = kind
+        self.size = size
+        self.block_size = BLOCK_SIZES[kind]
+        self.digests = [None] * -(-size // self.block_size)
+
+    def write(self, offset, data):
+        if offset % self.block_size != 0:
+            raise ValueError('offset must be a multiple of the block size')
+        if offset + len(data) > self.size:
+            raise ValueError('data extends past the end of the dump')
+
+        for i in range(0, len(data), self.block_size):
+            self.digests[(offset + i) // self.block_size] = \
+                self.archive.put_block(data[i:i + self.block_size])
+
+    def commit(self, meta=None):
+        """Write the manifest, return it"""
+        if None in self.digests:
+            missing = self.digests.index(None)
+            raise Exception(f'{self.name}: block {missing} was not written')
+
+        manifest = {
+            'version': MANIFEST_VERSION,
+            'kind': self.kind,
+            'size': self.size,
+            'block_size': self.block_size,
+            'created': time.strftime('%Y-%m-%dT%H:%M:%S%z'),
+            'blocks': self.digests,
+            'meta': meta or {},
+        }
+        self.archive.save_manifest(self.name, manifest)
+        return manifest
+
+
+class Archive:
+    """Content-addressed, deduplicating store of dumps
+
+    Dumps are split into blocks of their kind's size. Each distinct block
+    is stored once, zlib compressed, in an append-only pack file, and a
+    dump is a JSON manifest listing its block digests. Repeated snapshots
+    of the same save or pak only add the blocks that changed.
+
+    One process at a time may use an archive; threads can share it.
+    """
+
+    def __init__(self, root):
+        self.root = root
+        self.manifests_dir = os.path.join(root, 'manifests')
+        self.staging_dir = os.path.join(root, 'staging')
+        os.makedirs(self.manifests_dir, exist_ok=True)
+        os.makedirs(self.staging_dir, exist_ok=True)
+
+        self.lock = threading.Lock()
+        self.pack = open(os.path.join(root, 'blocks.pack'), 'a+b')
+        self.index_file = open(os.path.join(root, 'blocks.idx'), 'a+b')
+        self.index = {}
+        # index entries are only written once their records are synced
+        self.unsynced = []
+        self.load_index()
+
+    def load_index(self):
+        """Read the pack index, then index any records written after it"""
+        self.index_file.seek(0)
+        data = self.index_file.read()
+        n_entries = len(data) // INDEX_ENTRY.size
+        if len(data) != n_entries * INDEX_ENTRY.size:
+            # entry cut short by a crash
+            self.index_file.truncate(n_entries * INDEX_ENTRY.size)
+
+        end = 0
+        for digest, offset in INDEX_ENTRY.iter_unpack(
+                data[:n_entries * INDEX_ENTRY.size]):
+            self.index[digest] = offset
+            end = max(end, offset + RECORD.size + self.record_length(offset))
+
+        pack_size = os.fstat(self.pack.fileno()).st_size
+        while end + RECORD.size <= pack_size:
+            digest, length = RECORD.unpack(
+                os.pread(self.pack.fileno(), RECORD.size, end))
+            if end + RECORD.size + length > pack_size:
+                break
+            self.index[digest] = end
+            self.unsynced.append((digest, end))
+            end += RECORD.size + length
+
+        # drop a record cut short by a crash
+        if end != pack_size:
+            self.pack.truncate(end)
+        self.pack_end = end
+
+    def record_length(self, offset):
+        digest, length = RECORD.unpack(
+            os.pread(self.pack.fileno(), RECORD.size, offset))
+        return length
+
+    def put_block(self, data):
+        """Store a block unless already present, return its digest as hex"""
+        digest = block_digest(data)
+        with self.lock:
+            if digest not in self.index:
+                compressed = zlib.compress(data)
+                self.pack.write(RECORD.pack(digest, len(compressed)))
+                self.pack.write(compressed)
+                self.index[digest] = self.pack_end
+                self.unsynced.append((digest, self.pack_end))
+                self.pack_end += RECORD.size + len(compressed)
+        return digest.hex()
+
+    def get_block(self, digest):
+        digest = bytes.fromhex(digest)
+        offset = self.index.get(digest)
+        if offset is None:
+            raise Exception(f'block {digest.hex()} is not in the archive')
+
+        with self.lock:
+            # blocks written since the last sync may still be buffered
+            self.pack.flush()
+        length = self.record_length(offset)
+        data = zlib.decompress(os.pread(self.pack.fileno(), length,
+                                        offset + RECORD.size))
+        if block_digest(data) != digest:
+            raise Exception(f'block {digest.hex()} is corrupt')
+        return data
+
+    def sync(self):
+        """Make stored blocks durable before a manifest refers to them"""
+        with self.lock:
+            self.pack.flush()
+            os.fsync(self.pack.fileno())
+
+            for digest, offset in self.unsynced:
+                self.index_file.write(INDEX_ENTRY.pack(digest, offset))
+            self.unsynced = []
+            self.index_file.flush()
+            os.fsync(self.index_file.fileno())
+
+    def manifest_path(self, name):
+        parts = name.split('/')
+        if name.startswith('/') or any(p in ['', '.', '..'] for p in parts):
+            raise ValueError(f'bad dump name {name}')
+        return os.path.join(self.manifests_dir, *parts) + '.json'
+
+    def save_manifest(self, name, manifest):
+        self.sync()
+
+        path = self.manifest_path(name)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path + '.tmp', 'w') as f:
+            json.dump(manifest, f, indent=1)
+        os.replace(path + '.tmp', path)
+
+    def manifest(self, name):
+        with open(self.manifest_path(name)) as f:
+            return json.load(f)
+
+    def names(self):
+        """Names of all dumps, sorted"""
+        names = []
+        for root, dirs, files in os.walk(self.manifests_dir):
+            for filename in files:
+                if filename.endswith('.json'):
+                    path = os.path.join(root, filename[:-len('.json')])
+                    names.append(os.path.relpath(path, self.manifests_dir)
+                                 .replace(os.sep, '/'))
+        return sorted(names)
+
+    def writer(self, name, kind, size):
+        return DumpWriter(self, name, kind, size)
+
+    def put(self, name, kind, data, meta=None):
+        """Store a complete dump held in memory"""
+        writer = self.writer(name, kind, len(data))
+        writer.write(0, data)
+        return writer.commit(meta)
+
+    def put_file(self, name, kind, filename, meta=None):
+        """Store a dump from a file, one block at a time"""
+        writer = self.writer(name, kind, os.path.getsize(filename))
+        with open(filename, 'rb') as f:
+            for offset in range(0, writer.size, writer.block_size):
+                writer.write(offset, f.read(writer.block_size))
+        return writer.commit(meta)
+
+    def staging_filename(self, name):
+        """Work file for a dump that is assembled on disk first
+
+        Staging mirrors the manifest layout, so each name has its own file
+        and the same one on every run, which an interrupted dump resumes.
+        """
+        self.manifest_path(name)
+        filename = os.path.join(self.staging_dir, *name.split('/')) + '.img'
+        os.makedirs(os.path.dirname(filename), exist_ok=True)
+        return filename
+
+    def read_blocks(self, name):
+        """Yield the blocks of a dump in order"""
+        for digest in self.manifest(name)['blocks']:
+            yield self.get_block(digest)
+
+    def export(self, name, filename):
+        with open(filename, 'wb') as f:
+            for block in self.read_blocks(name):
+                f.write(block)
+
+    def stats(self):
+        """Number of dumps and blocks, dump bytes and stored bytes"""
+        logical = 0
+        names = self.names()
+        for name in names:
+            logical += self.manifest(name)['size']
+        return {
+            'dumps': len(names),
+            'blocks': len(self.index),
+            'dump_bytes': logical,
+            'stored_bytes': self.pack_end,
+        }
+
+    def close(self):
+        self.sync()
+        self.pack.close()
+        self.index_file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Store, list and export dumps in a deduplicating archive')
+    parser.add_argument('archive', type=str, help='archive directory')
+    mode_group = parser.add_mutually_exclusive_group(required=True)
+    mode_group.add_argument('--list', action='store_true', default=False,
+                            help='list dumps')
+    mode_group.add_argument('--stats', action='store_true', default=False,
+                            help='print storage totals')
+    mode_group.add_argument('--import', type=str, nargs=3, default=None,
+                            dest='import_args',
+                            metavar=('NAME', 'KIND', 'FILE'),
+                            help='store a dump file, KIND one of '
+                            f'{", ".join(BLOCK_SIZES)}')
+    mode_group.add_argument('--export', type=str, nargs=2, default=None,
+                            metavar=('NAME', 'FILE'),
+                            help='write a dump back out to a file')
+    args = parser.parse_args()
+
+    with Archive(args.archive) as archive:
+        if args.list:
+            for name in archive.names():
+                manifest = archive.manifest(name)
+                print(f'{name:40} {manifest["kind"]:5} '
+                      f'{manifest["size"]:#9x} {manifest["created"]}')
+        elif args.stats:
+            stats = archive.stats()
+            print(f'{stats["dumps"]} dumps, {stats["blocks"]} blocks')
+            print(f'{stats["dump_bytes"]} bytes of dumps stored in '
+                  f'{stats["stored_bytes"]} bytes')
+        elif args.import_args:
+            name, kind, filename = args.import_args
+            manifest = archive.put_file(name, kind, filename)
+            print(f'stored {filename} as {name}, '
+                  f'{len(manifest["blocks"])} blocks')
+        else:
+            name, filename = args.export
+            archive.export(name, filename)
+            print(f'exported {name} to {filename}')
+
+
+if __name__ == '__main__':
+    main()
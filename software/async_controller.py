@@ -0,0 +1,177 @@
+import asyncio
+import struct
+from controller import (BadCRCException, Controller, CMD_INFO,
+                        CMD_INFO_RESET, CMD_STATE, check_crc,
+                        check_pak_write, pak_read_cmd, pak_write_cmd,
+                        parse_pak_read)
+from uart_async import AsyncTransport, DEFAULT_WINDOW
+
+
+class AsyncController:
+    """asyncio version of Controller with pipelined commands"""
+
+    def __init__(self, ser, window=DEFAULT_WINDOW, verbose=False,
+                 metrics=None):
+        self.ser = ser
+        self.verbose = verbose
+        self.metrics = metrics
+        self.transport = AsyncTransport(ser, window, verbose, metrics)
+
+    async def send_cmd(self, cmd):
+        return await self.transport.send_cmd(cmd)
+
+    async def pak_read(self, address):
+        """read a 32 byte chunk from controller pak"""
+        response = await self.send_cmd(pak_read_cmd(address))
+        return check_crc(self.metrics, 'pak_read', parse_pak_read, response)
+
+    async def pak_read_many(self, addresses, progress=None,
+                            return_exceptions=False):
+        """read a sequence of 32 byte chunks with the window kept full"""
+
+        async def read_one(address):
+            chunk = await self.pak_read(address)
+            if progress is not None:
+                progress.update(32)
+            return chunk
+
+        # wait for every read so nothing is left in flight on error
+        results = await asyncio.gather(
+            *[read_one(address) for address in addresses],
+            return_exceptions=True)
+
+        for result in results:
+            if isinstance(result, Exception):
+                if not return_exceptions or \
+                   not isinstance(result, BadCRCException):
+                    raise result
+
+        return results
+
+    async def pak_read_many_into(self, addresses, view, progress=None):
+        """read a sequence of 32 byte chunks into view, window kept full"""
+        view = memoryview(view)
+
+        async def read_one(offset, address):
+            view[offset:offset + 32] = await self.pak_read(address)
+            if progress is not None:
+                progress.update(32)
+
+        results = await asyncio.gather(
+            *[read_one(i * 32, address)
+              for i, address in enumerate(addresses)],
+            return_exceptions=True)
+
+        for result in results:
+            if isinstance(result, Exception):
+                raise result
+
+    async def pak_write(self, address, data):
+        response = await self.send_cmd(pak_write_cmd(address, data))
+        check_crc(self.metrics, 'pak_write', check_pak_write, data, response)
+        return response
+
+    async def pak_write_many(self, blocks, progress=None,
+                             return_exceptions=False):
+        """write a sequence of (address, 32 byte chunk) with the window kept full"""
+
+        async def write_one(address, data):
+            response = await self.pak_write(address, data)
+            if progress is not None:
+                progress.update(32)
+            return response
+
+        results = await asyncio.gather(
+            *[write_one(address, data) for address, data in blocks],
+            return_exceptions=True)
+
+        for result in results:
+            if isinstance(result, Exception):
+                if not return_exceptions or \
+                   not isinstance(result, BadCRCException):
+                    raise result
+
+        return results
+
+    async def check_accessory_id(self, accessory_id):
+        """Check if this type of accessory is connected"""
+        pad_type, joyport_status = await self.pad_query()
+
+        if joyport_status & 1 == 0:
+            if self.verbose:
+                print('no accessory pak detected')
+            return False
+
+        await self.pak_write(0x8000, b'\xfe' * 32)
+        reset_response = await self.pak_read(0x8000)
+
+        if self.verbose:
+            print(f'accessory reset response: {reset_response.hex()}')
+
+        acc_id_byte = accessory_id.to_bytes(1, 'big')
+        await self.pak_write(0x8000, acc_id_byte * 32)
+        response = await self.pak_read(0x8000)
+
+        if self.verbose:
+            print(f'accessory ID check for {acc_id_byte.hex()}: {response.hex()}')
+
+        return response[31] == accessory_id
+
+    async def pad_query(self, reset=False):
+        if reset:
+            cmd_id = CMD_INFO_RESET
+        else:
+            cmd_id = CMD_INFO
+
+        cmd = struct.pack('>B', cmd_id)
+
+        response_bytez = await self.send_cmd(cmd)
+
+        pad_type, joyport_status = struct.unpack('<HB', response_bytez)
+        return (pad_type, joyport_status)
+
+    async def poll_state(self):
+        # Poll button state
+        cmd = struct.pack('>B', CMD_STATE)
+        return await self.send_cmd(cmd)
+
+    def close(self):
+        self.transport.close()
+
+
+class PipelinedController(Controller):
+    """Controller that pipelines bulk pak reads
+
+    Single commands go through the normal blocking path, while
+    pak_read_many and pak_write_many are run on an AsyncController so that
+    TransferPak bank reads, pak dumps and restores keep the link busy.
+    """
+
+    def __init__(self, ser, window=DEFAULT_WINDOW, verbose=False,
+                 metrics=None):
+        super().__init__(ser, verbose, metrics)
+        self.loop = asyncio.new_event_loop()
+        self.async_pad = AsyncController(ser, window, verbose, metrics)
+
+        # share buffered bytes between the blocking and pipelined paths
+        self.async_pad.transport.decoder = self.decoder
+
+    def pak_read_many(self, addresses, progress=None, return_exceptions=False):
+        return self.loop.run_until_complete(
+            self.async_pad.pak_read_many(addresses, progress,
+                                         return_exceptions))
+
+    def pak_read_many_into(self, addresses, view, progress=None):
+        # responses come back in request order; each chunk is copied
+        # into its slot as its read completes
+        self.loop.run_until_complete(
+            self.async_pad.pak_read_many_into(addresses, view, progress))
+
+    def pak_write_many(self, blocks, progress=None, return_exceptions=False):
+        return self.loop.run_until_complete(
+            self.async_pad.pak_write_many(blocks, progress,
+                                          return_exceptions))
+
+    def close(self):
+        self.async_pad.close()
+        self.loop.close()
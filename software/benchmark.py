@@ -0,0 +1,322 @@
+#!/usr/bin/env python3
+import argparse
+import contextlib
+import io
+import json
+import os
+import statistics
+import sys
+import tempfile
+import time
+from accessories.transferpak import TransferPak
+from async_controller import PipelinedController
+from controller import Controller
+from crc_util import data_crc_batch, data_crc_lookup, pack_addr
+from uart_util import FrameDecoder, open_port
+
+DEFAULT_PORT = 'emu://cpak'
+DEFAULT_TPAK_PORT = 'emu://tpak?mbc=MBC5&rom_banks=8&ram_banks=4'
+
+
+class Timer:
+    """Collects per-operation times from the wall clock and the port clock
+
+    The port clock is the emulator's modelled time, which shows what the
+    same traffic would cost on hardware. Real ports only have wall time.
+    """
+
+    def __init__(self, ser=None):
+        self.port_clock = getattr(ser, 'elapsed', None)
+        self.wall = []
+        self.modelled = []
+
+    @contextlib.contextmanager
+    def op(self):
+        wall_start = time.perf_counter()
+        if self.port_clock is not None:
+            port_start = self.port_clock()
+        yield
+        self.wall.append(time.perf_counter() - wall_start)
+        if self.port_clock is not None:
+            self.modelled.append(self.port_clock() - port_start)
+
+
+def percentiles(samples):
+    ordered = sorted(samples)
+
+    def pick(p):
+        return ordered[min(int(p * len(ordered)), len(ordered) - 1)]
+
+    return {
+        'mean': statistics.fmean(ordered),
+        'p50': pick(0.50),
+        'p90': pick(0.90),
+        'p99': pick(0.99),
+        'max': ordered[-1],
+    }
+
+
+def summarize(timer, n_bytes_per_op=None):
+    """Latency percentiles and throughput for one benchmark"""
+    result = {'count': len(timer.wall), 'wall': percentiles(timer.wall)}
+    if timer.modelled:
+        result['modelled'] = percentiles(timer.modelled)
+
+    # throughput comes from modelled time when the port provides it
+    samples = timer.modelled or timer.wall
+    total = sum(samples)
+    if total > 0:
+        result['ops_per_s'] = len(samples) / total
+        if n_bytes_per_op is not None:
+            result['bytes_per_s'] = len(samples) * n_bytes_per_op / total
+
+    return result
+
+
+@contextlib.contextmanager
+def quiet():
+    """Hide dump progress output"""
+    with contextlib.redirect_stdout(io.StringIO()), \
+         contextlib.redirect_stderr(io.StringIO()):
+        yield
+
+
+def open_pad(port, window):
+    ser = open_port(port, 1500000)
+    if window > 1:
+        pad = PipelinedController(ser, window)
+    else:
+        pad = Controller(ser)
+    return ser, pad
+
+
+def close_pad(ser, pad):
+    # PipelinedController has an event loop and reader thread to stop
+    if isinstance(pad, PipelinedController):
+        pad.close()
+    ser.close()
+
+
+def bench_pad(port, window, count, tmpdir):
+    ser, pad = open_pad(port, window)
+    results = {}
+
+    pad.pad_query(reset=True)
+
+    timer = Timer(ser)
+    for i in range(count):
+        with timer.op():
+            pad.poll_state()
+    results['poll_state'] = summarize(timer)
+
+    timer = Timer(ser)
+    for i in range(count):
+        with timer.op():
+            pad.pak_read((i * 32) % 0x8000)
+    results['pak_read'] = summarize(timer, 32)
+
+    timer = Timer(ser)
+    for i in range(count):
+        with timer.op():
+            pad.pak_write((i * 32) % 0x8000, bytes([i & 0xff]) * 32)
+    results['pak_write'] = summarize(timer, 32)
+
+    timer = Timer(ser)
+    with timer.op(), quiet():
+        pad.dump_cpak(os.path.join(tmpdir, 'cpak.bin'))
+    results['dump_cpak'] = summarize(timer, 0x8000)
+
+    close_pad(ser, pad)
+    return results
+
+
+def bench_tpak(port, window, tmpdir):
+    ser, pad = open_pad(port, window)
+    results = {}
+
+    pad.pad_query(reset=True)
+    tpak = TransferPak(pad)
+    if not tpak.check_pak() or not tpak.cart_present():
+        raise Exception('no Transfer Pak cart on benchmark port')
+
+    tpak.cart_enable(True)
+    tpak.load_rom_header()
+    tpak.cart_enable(False)
+    rom_size = tpak.gb_header.get_rom_size()
+    ram_size = tpak.gb_header.get_ram_size()
+
+    timer = Timer(ser)
+    with timer.op(), quiet():
+        tpak.dump_rom(os.path.join(tmpdir, 'rom.gb'))
+    results['dump_rom'] = summarize(timer, rom_size)
+
+    if ram_size > 0:
+        timer = Timer(ser)
+        with timer.op(), quiet():
+            tpak.dump_ram(os.path.join(tmpdir, 'ram.sav'))
+        results['dump_ram'] = summarize(timer, ram_size)
+
+    close_pad(ser, pad)
+    return results
+
+
+def bench_cpu(count):
+    results = {}
+    chunk = bytes(range(32))
+    bank = os.urandom(0x4000)
+
+    timer = Timer()
+    for i in range(count):
+        with timer.op():
+            data_crc_lookup(chunk)
+    results['data_crc_lookup'] = summarize(timer, 32)
+
+    timer = Timer()
+    for i in range(max(count // 32, 1)):
+        with timer.op():
+            data_crc_batch(bank)
+    results['data_crc_batch'] = summarize(timer, len(bank))
+
+    timer = Timer()
+    for i in range(count):
+        with timer.op():
+            pack_addr((i * 32) % 0x10000)
+    results['pack_addr'] = summarize(timer)
+
+    # pak read frames as the bridge sends them, about 4 KiB per read
+    frame = b'\xaa\x55\x03\x21' + b'\x02\x00\x00' + chunk + b'\x00'
+    block = frame * (4096 // len(frame))
+
+    timer = Timer()
+    decoder = FrameDecoder()
+    for i in range(count):
+        with timer.op():
+            decoder.feed(block)
+            for f in decoder.frames():
+                pass
+    results['frame_decode'] = summarize(timer, len(block))
+
+    return results
+
+
+def compare(results, baseline, tolerance):
+    """Compare results against a baseline
+
+    Returns (regressions, wall_changes). Only benchmarks with modelled
+    time can regress, since it does not depend on the machine running
+    the benchmark. Wall time changes beyond the tolerance are listed
+    separately for information.
+    """
+    regressions = []
+    wall_changes = []
+
+    for name, base in baseline['results'].items():
+        current = results['results'].get(name)
+        if current is None:
+            continue
+
+        p50 = current['wall']['p50']
+        base_p50 = base['wall']['p50']
+        if abs(p50 - base_p50) > base_p50 * tolerance:
+            wall_changes.append(
+                f'{name} wall p50: {p50 * 1e6:.1f} us '
+                f'(baseline {base_p50 * 1e6:.1f} us)')
+
+        if 'modelled' not in base or 'modelled' not in current:
+            continue
+
+        # throughput is from modelled time here, see summarize()
+        for key in ['ops_per_s', 'bytes_per_s']:
+            if key in base and key in current and \
+               current[key] < base[key] * (1 - tolerance):
+                regressions.append(
+                    f'{name} {key}: {current[key]:.1f} '
+                    f'(baseline {base[key]:.1f})')
+
+        p50 = current['modelled']['p50']
+        base_p50 = base['modelled']['p50']
+        if p50 > base_p50 * (1 + tolerance):
+            regressions.append(
+                f'{name} modelled p50: {p50 * 1e6:.1f} us '
+                f'(baseline {base_p50 * 1e6:.1f} us)')
+
+    return regressions, wall_changes
+
+
+def print_report(results):
+    for name, result in results['results'].items():
+        latency = result.get('modelled', result['wall'])
+        line = f'{name:16} n={result["count"]:<6} ' \
+            f'p50={latency["p50"] * 1e6:9.1f} us ' \
+            f'p99={latency["p99"] * 1e6:9.1f} us'
+        if 'bytes_per_s' in result:
+            line += f' {result["bytes_per_s"] / 1024:9.1f} KiB/s'
+        elif 'ops_per_s' in result:
+            line += f' {result["ops_per_s"]:9.1f} ops/s'
+        print(line)
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Benchmark host-mode operations')
+    parser.add_argument('--port', type=str, default=DEFAULT_PORT,
+                        help='port for controller benchmarks')
+    parser.add_argument('--tpak-port', type=str, default=DEFAULT_TPAK_PORT,
+                        help='port with a Transfer Pak and cart')
+    parser.add_argument('-w', '--window', type=int, default=1,
+                        help='number of pak reads to keep in flight')
+    parser.add_argument('-n', '--count', type=int, default=1000,
+                        help='operations per latency benchmark')
+    parser.add_argument('-o', '--output', type=str, default=None,
+                        help='write results JSON to file')
+    parser.add_argument('--baseline', type=str, default=None,
+                        help='compare against results JSON')
+    parser.add_argument('--tolerance', type=float, default=0.2,
+                        help='allowed fractional regression')
+    parser.add_argument('--skip-tpak', action='store_true', default=False)
+    args = parser.parse_args()
+
+    results = {
+        'meta': {
+            'port': args.port,
+            'tpak_port': None if args.skip_tpak else args.tpak_port,
+            'window': args.window,
+            'count': args.count,
+            'python': sys.version.split()[0],
+            'time': time.time(),
+        },
+        'results': {},
+    }
+
+    with tempfile.TemporaryDirectory() as tmpdir:
+        results['results'].update(
+            bench_pad(args.port, args.window, args.count, tmpdir))
+        if not args.skip_tpak:
+            results['results'].update(
+                bench_tpak(args.tpak_port, args.window, tmpdir))
+    results['results'].update(bench_cpu(args.count))
+
+    print_report(results)
+
+    if args.output is not None:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2)
+
+    if args.baseline is not None:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+
+        regressions, wall_changes = compare(results, baseline,
+                                            args.tolerance)
+        for change in wall_changes:
+            print(f'wall time changed: {change}')
+        for regression in regressions:
+            print(f'REGRESSION {regression}')
+
+        if regressions:
+            sys.exit(1)
+        print('no regressions against baseline')
+
+
+if __name__ == '__main__':
+    main()
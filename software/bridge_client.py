@@ -0,0 +1,99 @@
+#!/usr/bin/env python3
+import argparse
+import json
+import os
+import socket
+import sys
+
+# kept free of serial and controller imports so it starts quickly
+DEFAULT_SOCKET = os.environ.get('COJIRO_SOCKET', '/tmp/cojiro.sock')
+
+# request arguments naming files, which the daemon opens itself
+PATH_ARGS = ['filename', 'reference', 'notes_dir']
+
+
+class BridgeClient:
+    """Send requests to a running bridge_daemon.py"""
+
+    def __init__(self, socket_path=DEFAULT_SOCKET):
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.connect(socket_path)
+        self.file = self.sock.makefile('rwb')
+
+    def call(self, op, **kwargs):
+        # the daemon has its own working directory
+        for key in PATH_ARGS:
+            if isinstance(kwargs.get(key), str):
+                kwargs[key] = os.path.abspath(kwargs[key])
+
+        request = dict(kwargs, op=op)
+        self.file.write(json.dumps(request).encode() + b'\n')
+        self.file.flush()
+
+        line = self.file.readline()
+        if not line:
+            raise Exception('daemon closed the connection')
+
+        response = json.loads(line)
+        if not response['ok']:
+            raise Exception(response['error'])
+        return response['result']
+
+    def close(self):
+        self.file.close()
+        self.sock.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def parse_value(value):
+    """Request argument from the command line
+
+    Booleans and null are decoded, anything else is sent as a string
+    and converted by the daemon, so hex data is never read as a number.
+    """
+    if value in ['true', 'false', 'null']:
+        return json.loads(value)
+    return value
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Run one request on a bridge daemon')
+    parser.add_argument('-s', '--socket', type=str, default=DEFAULT_SOCKET,
+                        help='Unix socket path')
+    parser.add_argument('op', type=str,
+                        help='info, state, pak_read, pak_write, detect, '
+                        'rumble, cart_info, cart_read, dump_rom, dump_ram, '
+                        'restore_ram, dump_cpak, restore_cpak, reset or '
+                        'shutdown')
+    parser.add_argument('args', type=str, nargs='*',
+                        help='request arguments as key=value')
+    args = parser.parse_args()
+
+    kwargs = {}
+    for arg in args.args:
+        key, sep, value = arg.partition('=')
+        if not sep:
+            parser.error(f'argument {arg} is not key=value')
+        kwargs[key] = parse_value(value)
+
+    try:
+        with BridgeClient(args.socket) as client:
+            result = client.call(args.op, **kwargs)
+    except Exception as e:
+        print(f'error: {e}', file=sys.stderr)
+        sys.exit(1)
+
+    if isinstance(result, (dict, list)):
+        print(json.dumps(result, indent=2))
+    elif result is not None:
+        print(result)
+
+
+if __name__ == '__main__':
+    main()
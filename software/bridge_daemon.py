@@ -0,0 +1,287 @@
+#!/usr/bin/env python3
+import argparse
+import json
+import os
+import socketserver
+import threading
+from accessories.rumblepak import RumblePak
+from accessories.transferpak import TransferPak
+from async_controller import PipelinedController
+from controller import Controller
+from uart_util import open_port
+
+DEFAULT_SOCKET = os.environ.get('COJIRO_SOCKET', '/tmp/cojiro.sock')
+
+
+class RequestError(Exception):
+    pass
+
+
+def as_int(value):
+    """Integer argument, also accepted as a string such as '0x8000'"""
+    if isinstance(value, str):
+        return int(value, 0)
+    return int(value)
+
+
+def as_bool(value):
+    if isinstance(value, str):
+        return value.lower() in ['1', 'true', 'yes', 'on']
+    return bool(value)
+
+
+def as_path(value):
+    """File path argument, None is passed through
+
+    Relative paths are refused, they would resolve against the daemon's
+    working directory rather than the client's.
+    """
+    if value is None:
+        return None
+    if not isinstance(value, str) or not os.path.isabs(value):
+        raise RequestError(f'path {value} must be absolute')
+    return value
+
+
+class Bridge:
+    """Controller and accessory state kept between requests
+
+    The port stays open and the Transfer Pak keeps its bank and MBC
+    register shadows, so requests only pay for their own commands.
+    Pak state is dropped when the pad session reports a pak change.
+    """
+
+    def __init__(self, ser, window=1, verbose=False):
+        self.ser = ser
+        if window > 1:
+            self.pad = PipelinedController(ser, window, verbose)
+        else:
+            self.pad = Controller(ser, verbose)
+
+        self.lock = threading.Lock()
+        self.tpak = None
+        self.tpak_generation = None
+
+        self.pad.pad_query(reset=True)
+
+    def get_tpak(self):
+        """Transfer Pak with a loaded cart header"""
+        if not self.pad.check_accessory_id(TransferPak.accessory_id):
+            raise RequestError('no Transfer Pak present')
+
+        session = self.pad.session
+        if self.tpak is not None and \
+           self.tpak_generation == session.generation:
+            return self.tpak
+
+        tpak = TransferPak(self.pad)
+        if not tpak.cart_present():
+            raise RequestError('no cart present')
+
+        tpak.cart_enable(True)
+        header_ok = tpak.load_rom_header()
+        tpak.cart_enable(False)
+        if not header_ok:
+            raise RequestError('failed to get valid ROM header')
+
+        self.tpak = tpak
+        self.tpak_generation = session.generation
+        return tpak
+
+    def raw_pak_access(self, address, length):
+        """Drop pak state that raw reads and writes can invalidate
+
+        Accessory registers sit at 8000 and up: a raw access there may
+        power the pak or cart off, or switch the Transfer Pak bank or
+        cart mode behind the cached Transfer Pak's back.
+        """
+        if address + length > 0x8000:
+            self.pad.reset_session()
+            self.tpak = None
+
+    # Request handlers: keyword arguments come from the request,
+    # return values must be JSON serializable.
+
+    def op_info(self, reset=False):
+        pad_type, joyport_status = self.pad.pad_query(reset=as_bool(reset))
+        return {'pad_type': pad_type, 'joyport_status': joyport_status}
+
+    def op_state(self):
+        return self.pad.poll_state().hex()
+
+    def op_pak_read(self, address, count=1):
+        address = as_int(address)
+        count = as_int(count)
+        self.raw_pak_access(address, count * 32)
+        chunks = self.pad.pak_read_many(
+            range(address, address + count * 32, 32))
+        return b''.join(chunks).hex()
+
+    def op_pak_write(self, address, data):
+        address = as_int(address)
+        data = bytes.fromhex(data)
+        if len(data) % 32 != 0:
+            raise RequestError('data must be a multiple of 32 bytes')
+
+        self.raw_pak_access(address, len(data))
+        self.pad.pak_write_many(
+            [(address + i, data[i:i + 32]) for i in range(0, len(data), 32)])
+        return len(data)
+
+    def op_detect(self):
+        for name, cls in [('rumble', RumblePak), ('tpak', TransferPak)]:
+            if self.pad.check_accessory_id(cls.accessory_id):
+                return name
+        return None
+
+    def op_rumble(self, on=True):
+        rpak = RumblePak(self.pad)
+        if not rpak.check_pak():
+            raise RequestError('no Rumble Pak present')
+        rpak.set_rumble(as_bool(on))
+        return as_bool(on)
+
+    def op_cart_info(self):
+        header = self.get_tpak().gb_header
+        return {
+            'title': header.title_guess().decode('ascii', 'replace'),
+            'mbc': header.get_mbc_type(),
+            'rom_size': header.get_rom_size(),
+            'ram_size': header.get_ram_size(),
+            'global_checksum': header.global_checksum,
+        }
+
+    def op_cart_read(self, address, length=32):
+        address = as_int(address)
+        length = as_int(length)
+        tpak = self.get_tpak()
+
+        tpak.cart_enable(True)
+        try:
+            return tpak.cart_read_range(address, length).hex()
+        finally:
+            tpak.cart_enable(False)
+
+    def op_dump_rom(self, filename, verify=True):
+        filename = as_path(filename)
+        report = self.get_tpak().dump_rom(filename, verify=as_bool(verify))
+        if report is None:
+            raise RequestError('ROM not dumped')
+        return report
+
+    def op_dump_ram(self, filename):
+        filename = as_path(filename)
+        tpak = self.get_tpak()
+        if tpak.gb_header.get_ram_size() == 0:
+            raise RequestError('cart has no RAM')
+        tpak.dump_ram(filename)
+        return filename
+
+    def op_restore_ram(self, filename, reference=None):
+        n_written = self.get_tpak().restore_ram(as_path(filename),
+                                                as_path(reference))
+        if n_written is None:
+            raise RequestError('RAM not restored')
+        return n_written
+
+    def op_dump_cpak(self, filename, resume=True, sparse=False,
+                     notes_dir=None):
+        filename = as_path(filename)
+        if not self.pad.dump_cpak(filename, resume=as_bool(resume),
+                                  sparse=as_bool(sparse),
+                                  notes_dir=as_path(notes_dir)):
+            raise RequestError('no Controller Pak present')
+        return filename
+
+    def op_restore_cpak(self, filename, reference=None):
+        n_written = self.pad.restore_cpak(as_path(filename),
+                                          as_path(reference))
+        if n_written is None:
+            raise RequestError('controller pak not restored')
+        return n_written
+
+    def op_reset(self):
+        """Forget cached pak state and reset the pad"""
+        self.pad.reset_session()
+        self.tpak = None
+        return self.op_info(reset=True)
+
+    def handle(self, request):
+        op = request.pop('op', None)
+        handler = getattr(self, f'op_{op}', None)
+        if handler is None:
+            raise RequestError(f'unknown op {op}')
+
+        with self.lock:
+            return handler(**request)
+
+
+class RequestHandler(socketserver.StreamRequestHandler):
+    """One JSON request per line, one JSON response per line"""
+
+    def handle(self):
+        for line in self.rfile:
+            shutdown = False
+            try:
+                request = json.loads(line)
+                if request.get('op') == 'shutdown':
+                    response = {'ok': True, 'result': None}
+                    shutdown = True
+                else:
+                    result = self.server.bridge.handle(request)
+                    response = {'ok': True, 'result': result}
+            except Exception as e:
+                response = {'ok': False, 'error': str(e)}
+
+            self.wfile.write(json.dumps(response).encode() + b'\n')
+            self.wfile.flush()
+
+            if shutdown:
+                # answered first, the process may exit once serving stops
+                threading.Thread(target=self.server.shutdown).start()
+                return
+
+
+class BridgeServer(socketserver.ThreadingUnixStreamServer):
+
+    daemon_threads = True
+
+    def __init__(self, socket_path, bridge):
+        # remove a socket left behind by a previous daemon
+        if os.path.exists(socket_path):
+            os.remove(socket_path)
+        super().__init__(socket_path, RequestHandler)
+        self.bridge = bridge
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Keep a bridge open and serve requests on a Unix socket')
+    parser.add_argument('port', type=str,
+                        help='serial port, or emu:// URL for the emulator')
+    parser.add_argument('-b', '--baudrate', type=int, default=1500000)
+    parser.add_argument('-s', '--socket', type=str, default=DEFAULT_SOCKET,
+                        help='Unix socket path')
+    parser.add_argument('-w', '--window', type=int, default=1,
+                        help='number of pak reads to keep in flight')
+    parser.add_argument('-v', '--verbose', action='store_true',
+                        default=False)
+    args = parser.parse_args()
+
+    with open_port(args.port, args.baudrate) as ser:
+        ser.reset_input_buffer()
+        ser.reset_output_buffer()
+
+        bridge = Bridge(ser, args.window, args.verbose)
+        with BridgeServer(args.socket, bridge) as server:
+            print(f'serving {ser.name} on {args.socket}')
+            try:
+                server.serve_forever()
+            except KeyboardInterrupt:
+                pass
+            finally:
+                os.remove(args.socket)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,221 @@
+import mmap
+import queue
+import struct
+import threading
+import time
+from uart_util import FrameDecoder
+
+# File header: magic, format version, capture start as wall clock time
+# and as monotonic nanoseconds, so record timestamps can be mapped back
+# to wall time.
+CAPTURE_MAGIC = b'COJIRCAP'
+CAPTURE_VERSION = 1
+HEADER = struct.Struct('<8sHdQ')
+
+# Record header: monotonic timestamp in nanoseconds, command length,
+# response length. Command and response bytes follow.
+RECORD = struct.Struct('<QBB')
+
+
+class CaptureWriter:
+    """Append timestamped frames to a binary capture file"""
+
+    def __init__(self, filename, flush_interval=1.0):
+        self.file = open(filename, 'wb')
+        self.flush_interval = flush_interval
+        self.n_records = 0
+
+        self.start_ns = time.monotonic_ns()
+        self.file.write(HEADER.pack(CAPTURE_MAGIC, CAPTURE_VERSION,
+                                    time.time(), self.start_ns))
+        self.last_flush = time.monotonic()
+
+    def write(self, timestamp_ns, command, response):
+        self.file.write(RECORD.pack(timestamp_ns, len(command), len(response)))
+        self.file.write(command)
+        self.file.write(response)
+        self.n_records += 1
+
+        # keep the file usable if the capture is killed
+        now = time.monotonic()
+        if now - self.last_flush >= self.flush_interval:
+            self.file.flush()
+            self.last_flush = now
+
+    def close(self):
+        self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+class CaptureReader:
+    """Iterate over (timestamp_ns, command, response) records
+
+    The capture is memory-mapped, so records can also be read directly
+    by file offset, e.g. from a CaptureIndex.
+    """
+
+    def __init__(self, filename):
+        self.file = open(filename, 'rb')
+
+        header = self.file.read(HEADER.size)
+        if len(header) < HEADER.size:
+            self.file.close()
+            raise Exception('capture file too short')
+
+        magic, version, self.start_time, self.start_ns = HEADER.unpack(header)
+        if magic != CAPTURE_MAGIC:
+            self.file.close()
+            raise Exception('not a capture file')
+        if version != CAPTURE_VERSION:
+            self.file.close()
+            raise Exception(f'unsupported capture version {version}')
+
+        self.data = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+
+    def wall_time(self, timestamp_ns):
+        """Wall clock time of a record timestamp"""
+        return self.start_time + (timestamp_ns - self.start_ns) / 1e9
+
+    def read_at(self, offset):
+        """Read the record at a file offset, None if it is incomplete"""
+        if offset + RECORD.size > len(self.data):
+            return None
+
+        timestamp_ns, cmd_len, resp_len = RECORD.unpack_from(self.data, offset)
+        start = offset + RECORD.size
+        end = start + cmd_len + resp_len
+        if end > len(self.data):
+            return None
+
+        return (timestamp_ns, self.data[start:start + cmd_len],
+                self.data[start + cmd_len:end])
+
+    def records(self, offset=HEADER.size):
+        """Yield (offset, record) for each complete record from offset"""
+        while True:
+            record = self.read_at(offset)
+            if record is None:
+                # end of file, or a record cut short by a killed capture
+                return
+
+            yield offset, record
+            offset += RECORD.size + len(record[1]) + len(record[2])
+
+    def __iter__(self):
+        for offset, record in self.records():
+            yield record
+
+    def close(self):
+        self.data.close()
+        self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+class PortReader(threading.Thread):
+    """Drain a serial port into a queue of timestamped chunks
+
+    Does nothing but read, so the OS buffer is emptied as fast as the
+    bytes arrive whatever the consumer is doing.
+    """
+
+    def __init__(self, ser, chunks=None):
+        super().__init__(daemon=True)
+        self.ser = ser
+        self.chunks = chunks if chunks is not None else queue.SimpleQueue()
+        self.running = True
+        self.error = None
+
+    def run(self):
+        try:
+            while self.running:
+                data = self.ser.read(max(self.ser.in_waiting, 1))
+                if data:
+                    self.chunks.put((time.monotonic_ns(), data))
+        except Exception as e:
+            self.error = e
+        finally:
+            # wake up the consumer
+            self.chunks.put(None)
+
+    def stop(self):
+        self.running = False
+
+
+class FrameRenderer(threading.Thread):
+    """Render frames on a separate thread without stalling the capture
+
+    Frames arriving while the render queue is full are counted and
+    skipped instead of blocking; they are still in the capture file.
+    """
+
+    def __init__(self, render, max_pending=1024):
+        super().__init__(daemon=True)
+        self.render = render
+        self.frames = queue.Queue(max_pending)
+        self.skipped = 0
+
+    def submit(self, timestamp_ns, command, response):
+        try:
+            self.frames.put_nowait((timestamp_ns, command, response))
+        except queue.Full:
+            self.skipped += 1
+
+    def run(self):
+        while True:
+            frame = self.frames.get()
+            if frame is None:
+                return
+            self.render(*frame)
+
+    def stop(self):
+        self.frames.put(None)
+        self.join()
+
+
+def capture(ser, writer=None, renderer=None, verbose=False, observers=()):
+    """Capture frames until interrupted
+
+    A PortReader thread drains the port while this thread decodes
+    frames, logs them to the writer and hands them to the renderer.
+    Observers are called with every frame on this thread.
+    Returns the number of frames captured.
+    """
+    reader = PortReader(ser)
+    decoder = FrameDecoder(verbose)
+    n_frames = 0
+
+    reader.start()
+    try:
+        while True:
+            chunk = reader.chunks.get()
+            if chunk is None:
+                if reader.error is not None:
+                    raise reader.error
+                break
+
+            timestamp_ns, data = chunk
+            decoder.feed(data)
+            for command, response in decoder.frames():
+                if writer is not None:
+                    writer.write(timestamp_ns, command, response)
+                if renderer is not None:
+                    renderer.submit(timestamp_ns, command, response)
+                for observer in observers:
+                    observer(timestamp_ns, command, response)
+                n_frames += 1
+    except KeyboardInterrupt:
+        pass
+    finally:
+        reader.stop()
+
+    return n_frames
@@ -0,0 +1,228 @@
+import array
+import bisect
+import mmap
+import os
+import struct
+from capture import RECORD, CaptureReader
+from crc_util import extract_addr
+
+# Recognized JoyBus commands
+CMD_PAK_READ = 0x02
+CMD_PAK_WRITE = 0x03
+
+# Commands whose frames carry a pak address
+ADDRESS_CMDS = [CMD_PAK_READ, CMD_PAK_WRITE]
+
+# File header: magic, format version, number of command sections, size
+# of the capture file when indexed, end of the last complete record and
+# number of records indexed.
+INDEX_MAGIC = b'COJIRIDX'
+INDEX_VERSION = 1
+INDEX_HEADER = struct.Struct('<8sHHQQQ')
+
+# One section per command byte: command, entry count, entries offset
+SECTION = struct.Struct('<BxxxxxxxQQ')
+
+# Entries in a section are sorted by pak address, then time:
+# address, timestamp in nanoseconds, record offset in the capture file
+ENTRY = struct.Struct('<HQQ')
+
+# record sequence numbers are packed below the address in the sort key
+SEQ_BITS = 40
+
+
+def frame_address(command):
+    """Pak address of a frame, 0 for commands without one"""
+    if command[0] in ADDRESS_CMDS and len(command) >= 3:
+        address, crc = extract_addr(command[1:3])
+        return address
+    return 0
+
+
+def index_filename_for(capture_filename):
+    return capture_filename + '.idx'
+
+
+def build_index(capture_filename, index_filename=None):
+    """Index every record of a capture by command, address and time"""
+    if index_filename is None:
+        index_filename = index_filename_for(capture_filename)
+
+    file_size = os.path.getsize(capture_filename)
+
+    timestamps = array.array('Q')
+    offsets = array.array('Q')
+    keys = {}
+    end = 0
+
+    with CaptureReader(capture_filename) as reader:
+        for offset, (timestamp_ns, command, response) in reader.records():
+            seq = len(offsets)
+            timestamps.append(timestamp_ns)
+            offsets.append(offset)
+
+            cmd = command[0] if command else 0
+            if cmd not in keys:
+                keys[cmd] = array.array('Q')
+            keys[cmd].append(frame_address(command) << SEQ_BITS | seq)
+
+            end = offset + RECORD.size + len(command) + len(response)
+
+    seq_mask = (1 << SEQ_BITS) - 1
+    entries_offset = INDEX_HEADER.size + SECTION.size * len(keys)
+
+    tmp_filename = index_filename + '.tmp'
+    with open(tmp_filename, 'wb') as f:
+        f.write(INDEX_HEADER.pack(INDEX_MAGIC, INDEX_VERSION, len(keys),
+                                  file_size, end, len(offsets)))
+
+        for cmd in sorted(keys):
+            f.write(SECTION.pack(cmd, len(keys[cmd]), entries_offset))
+            entries_offset += ENTRY.size * len(keys[cmd])
+
+        for cmd in sorted(keys):
+            for key in sorted(keys[cmd]):
+                seq = key & seq_mask
+                f.write(ENTRY.pack(key >> SEQ_BITS, timestamps[seq],
+                                   offsets[seq]))
+
+    os.replace(tmp_filename, index_filename)
+
+
+class EntryColumn:
+    """One field of a section's entries as a read-only sequence"""
+
+    def __init__(self, data, base, count, field):
+        self.data = data
+        self.base = base
+        self.count = count
+        # (format, offset) of the field within an entry
+        self.fmt, self.field_offset = {
+            'address': ('<H', 0),
+            'timestamp': ('<Q', 2),
+            'offset': ('<Q', 10),
+        }[field]
+
+    def __len__(self):
+        return self.count
+
+    def __getitem__(self, i):
+        return struct.unpack_from(
+            self.fmt, self.data,
+            self.base + i * ENTRY.size + self.field_offset)[0]
+
+
+class CaptureIndex:
+    """Query a capture by command, pak address range and time range
+
+    The index is stored next to the capture as `<capture>.idx` and is
+    rebuilt when missing or when the capture has changed since. Both
+    files are memory-mapped and searched with binary search, so queries
+    do not depend on the size of the capture.
+    """
+
+    def __init__(self, capture_filename, rebuild=False):
+        self.index_filename = index_filename_for(capture_filename)
+
+        if rebuild or self.stale(capture_filename):
+            build_index(capture_filename, self.index_filename)
+
+        self.capture = CaptureReader(capture_filename)
+
+        self.file = open(self.index_filename, 'rb')
+        self.data = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+
+        magic, version, n_sections, file_size, self.end, self.n_records = \
+            INDEX_HEADER.unpack_from(self.data, 0)
+
+        self.sections = {}
+        for i in range(n_sections):
+            cmd, count, base = SECTION.unpack_from(
+                self.data, INDEX_HEADER.size + i * SECTION.size)
+            self.sections[cmd] = (base, count)
+
+    def stale(self, capture_filename):
+        if not os.path.exists(self.index_filename):
+            return True
+
+        with open(self.index_filename, 'rb') as f:
+            header = f.read(INDEX_HEADER.size)
+        if len(header) < INDEX_HEADER.size:
+            return True
+
+        magic, version, n_sections, file_size, end, n_records = \
+            INDEX_HEADER.unpack(header)
+        return magic != INDEX_MAGIC or version != INDEX_VERSION or \
+            file_size != os.path.getsize(capture_filename)
+
+    def commands(self):
+        """Command bytes present in the capture with their frame counts"""
+        return {cmd: count for cmd, (base, count) in self.sections.items()}
+
+    def query_offsets(self, cmd, start_addr=None, end_addr=None,
+                      start_ns=None, end_ns=None):
+        """Capture offsets of matching frames of one command, unordered
+
+        Address and time ranges are inclusive.
+        """
+        if cmd not in self.sections:
+            return []
+
+        base, count = self.sections[cmd]
+        addresses = EntryColumn(self.data, base, count, 'address')
+        timestamps = EntryColumn(self.data, base, count, 'timestamp')
+        offsets = EntryColumn(self.data, base, count, 'offset')
+
+        lo = 0 if start_addr is None else bisect.bisect_left(addresses,
+                                                             start_addr)
+        hi = count if end_addr is None else bisect.bisect_right(addresses,
+                                                                end_addr)
+
+        results = []
+        while lo < hi:
+            # entries for one address are in time order
+            address = addresses[lo]
+            run_end = bisect.bisect_right(addresses, address, lo, hi)
+
+            first = lo
+            if start_ns is not None:
+                first = bisect.bisect_left(timestamps, start_ns, lo, run_end)
+            last = run_end
+            if end_ns is not None:
+                last = bisect.bisect_right(timestamps, end_ns, first, run_end)
+
+            results.extend(offsets[i] for i in range(first, last))
+            lo = run_end
+
+        return results
+
+    def query(self, cmds=None, start_addr=None, end_addr=None,
+              start_ns=None, end_ns=None):
+        """Matching (timestamp_ns, command, response) records in time order
+
+        cmds is a list of command bytes, None for all commands.
+        """
+        if cmds is None:
+            cmds = list(self.sections)
+        if start_addr is not None or end_addr is not None:
+            cmds = [cmd for cmd in cmds if cmd in ADDRESS_CMDS]
+
+        offsets = []
+        for cmd in cmds:
+            offsets.extend(self.query_offsets(cmd, start_addr, end_addr,
+                                              start_ns, end_ns))
+
+        # records are appended in time order
+        for offset in sorted(offsets):
+            yield self.capture.read_at(offset)
+
+    def close(self):
+        self.data.close()
+        self.file.close()
+        self.capture.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
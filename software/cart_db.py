@@ -0,0 +1,374 @@
+#!/usr/bin/env python3
+import argparse
+import bisect
+import hashlib
+import mmap
+import os
+import struct
+import zlib
+import xml.etree.ElementTree as ET
+from dump_verify import block_digest
+from gb_cart import GBHeader, GlobalChecksum
+
+GB_ROM_BANK_SZ = 0x4000
+
+# ROM files picked up when scanning a directory
+ROM_EXTENSIONS = ['.gb', '.gbc', '.sgb']
+
+# File header: magic, format version, number of entries, number of
+# header keys, offset of the string area
+DB_MAGIC = b'COJICART'
+DB_VERSION = 1
+DB_HEADER = struct.Struct('<8sHxxIIQ')
+
+# Entries are sorted by SHA-1: SHA-1, MD5, CRC32, ROM size, bank 0
+# digest, raw 16 byte title, header checksum, mask ROM version, global
+# checksum, flags, then offset and length of the name and the path of
+# a held copy in the string area
+ENTRY = struct.Struct('<20s16sII16s16sBBHBxIHIH')
+
+# Header keys are sorted by title, header checksum, global checksum and
+# mask ROM version, each pointing at an entry
+KEY = struct.Struct('<16sBHBI')
+KEY_FIELDS_SIZE = KEY.size - 4
+
+# Entry flags
+FLAG_DAT = 0x01     # listed in a DAT file
+FLAG_HEADER = 0x02  # header fields and bank 0 digest are known
+FLAG_HELD = 0x04    # a checked copy of the ROM was indexed
+
+
+def header_key(title, header_checksum, global_checksum, mask_rom_ver):
+    return KEY.pack(title, header_checksum, global_checksum, mask_rom_ver,
+                    0)[:KEY_FIELDS_SIZE]
+
+
+class CartEntry:
+    """One known ROM: hashes, name and, if known, its header fields"""
+
+    def __init__(self, name, size, crc32, md5, sha1):
+        self.name = name
+        self.size = size
+        self.crc32 = crc32
+        self.md5 = md5
+        self.sha1 = sha1
+        self.flags = 0
+
+        self.bank0_digest = bytes(16)
+        self.title = bytes(16)
+        self.header_checksum = 0
+        self.global_checksum = 0
+        self.mask_rom_ver = 0
+        self.path = ''
+
+    def set_header(self, gb_header, bank0):
+        self.title = gb_header.title_max
+        self.header_checksum = gb_header.header_checksum
+        self.global_checksum = gb_header.global_checksum
+        self.mask_rom_ver = gb_header.mask_rom_ver
+        self.bank0_digest = block_digest(bank0)
+        self.flags |= FLAG_HEADER
+
+    def key(self):
+        return header_key(self.title, self.header_checksum,
+                          self.global_checksum, self.mask_rom_ver)
+
+    def digests(self):
+        """Expected hashes, in the format of DumpHasher.digests()"""
+        return {
+            'crc32': f'{self.crc32:08x}',
+            'md5': self.md5.hex(),
+            'sha1': self.sha1.hex(),
+        }
+
+    def held_copy(self):
+        """Contents of the indexed copy of this ROM
+
+        The file is read once and checked against the SHA-1, so the data
+        returned is what was checked. None if the copy is gone or changed.
+        """
+        if not self.flags & FLAG_HELD or not os.path.isfile(self.path) or \
+           os.path.getsize(self.path) != self.size:
+            return None
+
+        with open(self.path, 'rb') as f:
+            rom = f.read()
+        if hashlib.sha1(rom).digest() != self.sha1:
+            return None
+        return rom
+
+    def __repr__(self):
+        return f'CartEntry({self.name!r}, {self.sha1.hex()})'
+
+
+def parse_dat(dat_filename):
+    """Yield a CartEntry per ROM with a SHA-1 in a Logiqx XML DAT file"""
+    for event, elem in ET.iterparse(dat_filename):
+        if elem.tag not in ['game', 'machine']:
+            continue
+
+        for rom in elem.iter('rom'):
+            if rom.get('sha1') is None:
+                continue
+            entry = CartEntry(elem.get('name', rom.get('name')),
+                              int(rom.get('size', 0)),
+                              int(rom.get('crc', '0'), 16),
+                              bytes.fromhex(rom.get('md5', '0' * 32)),
+                              bytes.fromhex(rom.get('sha1')))
+            entry.flags |= FLAG_DAT
+            yield entry
+
+        elem.clear()
+
+
+def find_rom_files(paths):
+    """ROM files given directly, or found under the given directories"""
+    for path in paths:
+        if not os.path.isdir(path):
+            yield path
+            continue
+
+        for root, dirs, files in os.walk(path):
+            dirs.sort()
+            for name in sorted(files):
+                if os.path.splitext(name)[1].lower() in ROM_EXTENSIONS:
+                    yield os.path.join(root, name)
+
+
+def build_database(db_filename, dat_filenames=(), rom_paths=(),
+                   verbose=False):
+    """Index DAT entries and ROM files we hold into a database file
+
+    ROM files supply the header fields and bank 0 digest used to
+    identify a cart. A file is indexed if it matches a DAT entry, or if
+    it is not in any DAT but its global checksum is correct.
+    Returns the number of entries.
+    """
+    entries = {}
+    for dat_filename in dat_filenames:
+        for entry in parse_dat(dat_filename):
+            entries.setdefault(entry.sha1, entry)
+
+    for rom_filename in find_rom_files(rom_paths):
+        with open(rom_filename, 'rb') as f:
+            rom = f.read()
+
+        if len(rom) < GB_ROM_BANK_SZ:
+            continue
+        gb_header = GBHeader(rom[0x100:0x150])
+        if not gb_header.verify_header():
+            if verbose:
+                print(f'{rom_filename}: bad header checksum, skipped')
+            continue
+
+        sha1 = hashlib.sha1(rom).digest()
+        entry = entries.get(sha1)
+        if entry is None:
+            checksum = GlobalChecksum()
+            checksum.update(0, rom)
+            if checksum.value() != gb_header.global_checksum:
+                if verbose:
+                    print(f'{rom_filename}: not in a DAT and global '
+                          'checksum mismatch, skipped')
+                continue
+
+            name = os.path.splitext(os.path.basename(rom_filename))[0]
+            entry = CartEntry(name, len(rom), zlib.crc32(rom),
+                              hashlib.md5(rom).digest(), sha1)
+            entries[sha1] = entry
+
+        entry.set_header(gb_header, rom[:GB_ROM_BANK_SZ])
+        entry.path = os.path.abspath(rom_filename)
+        entry.flags |= FLAG_HELD
+
+    sorted_entries = [entries[sha1] for sha1 in sorted(entries)]
+    keys = sorted((entry.key(), i) for i, entry in enumerate(sorted_entries)
+                  if entry.flags & FLAG_HEADER)
+
+    strings = bytearray()
+    strings_offset = DB_HEADER.size + ENTRY.size * len(sorted_entries) + \
+        KEY.size * len(keys)
+
+    tmp_filename = db_filename + '.tmp'
+    with open(tmp_filename, 'wb') as f:
+        f.write(DB_HEADER.pack(DB_MAGIC, DB_VERSION, len(sorted_entries),
+                               len(keys), strings_offset))
+
+        for entry in sorted_entries:
+            name = entry.name.encode()
+            path = entry.path.encode()
+            f.write(ENTRY.pack(entry.sha1, entry.md5, entry.crc32,
+                               entry.size, entry.bank0_digest, entry.title,
+                               entry.header_checksum, entry.mask_rom_ver,
+                               entry.global_checksum, entry.flags,
+                               len(strings), len(name),
+                               len(strings) + len(name), len(path)))
+            strings += name + path
+
+        for key, i in keys:
+            f.write(key + struct.pack('<I', i))
+
+        f.write(strings)
+
+    os.replace(tmp_filename, db_filename)
+    return len(sorted_entries)
+
+
+class FieldColumn:
+    """Leading bytes of fixed-size records as a read-only sequence"""
+
+    def __init__(self, data, base, count, record_size, field_size):
+        self.data = data
+        self.base = base
+        self.count = count
+        self.record_size = record_size
+        self.field_size = field_size
+
+    def __len__(self):
+        return self.count
+
+    def __getitem__(self, i):
+        offset = self.base + i * self.record_size
+        return self.data[offset:offset + self.field_size]
+
+
+class CartDatabase:
+    """Look up carts by ROM hash or by header fields and bank 0
+
+    The database file is memory-mapped and searched with binary search,
+    so a lookup only touches the records it returns.
+    """
+
+    def __init__(self, db_filename):
+        self.file = open(db_filename, 'rb')
+        self.data = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+
+        magic, version, self.n_entries, self.n_keys, self.strings_offset = \
+            DB_HEADER.unpack_from(self.data, 0)
+        if magic != DB_MAGIC or version != DB_VERSION:
+            self.close()
+            raise ValueError(f'{db_filename} is not a cart database')
+
+        self.keys_offset = DB_HEADER.size + ENTRY.size * self.n_entries
+        self.sha1s = FieldColumn(self.data, DB_HEADER.size, self.n_entries,
+                                 ENTRY.size, 20)
+        self.keys = FieldColumn(self.data, self.keys_offset, self.n_keys,
+                                KEY.size, KEY_FIELDS_SIZE)
+
+    def __len__(self):
+        return self.n_entries
+
+    def string(self, offset, length):
+        start = self.strings_offset + offset
+        return self.data[start:start + length].decode()
+
+    def entry(self, i):
+        (sha1, md5, crc32, size, bank0_digest, title, header_checksum,
+         mask_rom_ver, global_checksum, flags, name_offset, name_len,
+         path_offset, path_len) = ENTRY.unpack_from(
+             self.data, DB_HEADER.size + i * ENTRY.size)
+
+        entry = CartEntry(self.string(name_offset, name_len), size, crc32,
+                          md5, sha1)
+        entry.flags = flags
+        entry.bank0_digest = bank0_digest
+        entry.title = title
+        entry.header_checksum = header_checksum
+        entry.global_checksum = global_checksum
+        entry.mask_rom_ver = mask_rom_ver
+        entry.path = self.string(path_offset, path_len)
+        return entry
+
+    def lookup_sha1(self, sha1):
+        """Entry for a ROM SHA-1 (bytes or hex string), or None"""
+        if isinstance(sha1, str):
+            sha1 = bytes.fromhex(sha1)
+
+        i = bisect.bisect_left(self.sha1s, sha1)
+        if i < self.n_entries and self.sha1s[i] == sha1:
+            return self.entry(i)
+        return None
+
+    def lookup_header(self, gb_header):
+        """Entries whose header fields match a cart header"""
+        key = header_key(gb_header.title_max, gb_header.header_checksum,
+                         gb_header.global_checksum, gb_header.mask_rom_ver)
+
+        lo = bisect.bisect_left(self.keys, key)
+        hi = bisect.bisect_right(self.keys, key, lo)
+
+        entries = []
+        for i in range(lo, hi):
+            (index,) = struct.unpack_from(
+                '<I', self.data,
+                self.keys_offset + i * KEY.size + KEY_FIELDS_SIZE)
+            entries.append(self.entry(index))
+        return entries
+
+    def identify(self, gb_header, bank0):
+        """Entry matching the header and the contents of bank 0, or None"""
+        digest = block_digest(bank0)
+        for entry in self.lookup_header(gb_header):
+            if entry.bank0_digest == digest:
+                return entry
+        return None
+
+    def close(self):
+        self.data.close()
+        self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def print_entry(entry, held_rom=None):
+    """Print an entry, with its held copy if held_rom is its checked data"""
+    print(f'Name: {entry.name}')
+    print(f'  size:  {entry.size:#x} bytes')
+    for name, value in entry.digests().items():
+        print(f'  {name + ":":6} {value}')
+    if entry.flags & FLAG_DAT:
+        print('  listed in DAT')
+    if held_rom is not None:
+        print(f'  held copy: {entry.path}')
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Build or query a Game Boy cart identification database')
+    parser.add_argument('database', type=str, help='database file')
+    parser.add_argument('--dat', type=str, nargs='*', default=[],
+                        help='Logiqx XML DAT files to index')
+    parser.add_argument('--roms', type=str, nargs='*', default=[],
+                        help='ROM files or directories of dumps to index')
+    parser.add_argument('-v', '--verbose', action='store_true',
+                        default=False)
+    mode_group = parser.add_mutually_exclusive_group(required=True)
+    mode_group.add_argument('--build', action='store_true', default=False,
+                            help='(re)build the database')
+    mode_group.add_argument('--identify', type=str, default=None,
+                            help='ROM file to identify by header and bank 0')
+    args = parser.parse_args()
+
+    if args.build:
+        n_entries = build_database(args.database, args.dat, args.roms,
+                                   args.verbose)
+        print(f'{n_entries} entries written to {args.database}')
+        return
+
+    with open(args.identify, 'rb') as f:
+        bank0 = f.read(GB_ROM_BANK_SZ)
+
+    with CartDatabase(args.database) as db:
+        entry = db.identify(GBHeader(bank0[0x100:0x150]), bank0)
+        if entry is None:
+            print('Unknown cart')
+        else:
+            print_entry(entry, entry.held_copy())
+
+
+if __name__ == '__main__':
+    main()
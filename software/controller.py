@@ -1,79 +1,302 @@
+import os
 import struct
-from uart_util import send_cmd
+from uart_util import BULK_HEADER, BULK_MAGIC, BULK_RECORD_LEN, \
+    BULK_STATUS_CRC, BULK_STATUS_LENGTH, BULK_STATUS_RX, MAX_BULK_COUNT, \
+    CMD_INFO, CMD_INFO_RESET, CMD_PAK_READ, CMD_PAK_WRITE, CMD_STATE, \
+    FrameDecoder, pack_bulk_read, send_cmd, sendall
 from crc_util import (data_crc_lookup, pack_addr)
+from cpak_fs import CPAK_SIZE, METADATA_SIZE, PAGE_SIZE, CpakFilesystem, \
+    export_notes
+from dump_engine import ResumableDump
+from metrics import cmd_name
 from tqdm import tqdm
 
-# Recognized JoyBus commands
-CMD_INFO_RESET = 0xff
-CMD_INFO = 0x00
-CMD_STATE = 0x01
-CMD_PAK_READ = 0x02
-CMD_PAK_WRITE = 0x03
-
 
 class BadCRCException(Exception):
     pass
 
 
-class Controller:
+def pak_read_cmd(address):
+    packed_addr = pack_addr(address)
+    return struct.pack(
+        '>B2s',
+        CMD_PAK_READ,
+        packed_addr)
 
-    def __init__(self, ser, verbose=False):
-        self.ser = ser
-        self.verbose = verbose
 
-    def send_cmd(self, cmd):
-        return send_cmd(self.ser, cmd, self.verbose)
+def parse_pak_read(response):
+    """Check pak read response and return the 32 byte chunk"""
+    # Check response length
+    if len(response) != 33:
+        raise Exception(f'invalid response length {len(response)}')
 
-    def pak_read(self, address):
-        """read a 32 byte chunk from controller pak"""
-        packed_addr = pack_addr(address)
-        cmd = struct.pack(
-            '>B2s',
-            CMD_PAK_READ,
-            packed_addr)
-        response = self.send_cmd(cmd)
+    crc_received = response[-1]
+    chunk = response[:32]
+    crc_calculated = data_crc_lookup(chunk)
 
-        # Check response length
-        if len(response) != 33:
-            raise Exception(f'invalid response length {len(response)}')
+    if crc_received != crc_calculated:
+        raise BadCRCException(
+            f'CRC mismatched (received {crc_received:02x}, '
+            f'calculated {crc_calculated:02x}')
 
-        crc_received = response[-1]
-        chunk = response[:32]
-        crc_calculated = data_crc_lookup(chunk)
+    return chunk
 
-        if crc_received != crc_calculated:
-            raise BadCRCException(
-                f'CRC mismatched (received {crc_received:02x}, '
-                f'calculated {crc_calculated:02x}')
 
-        return chunk
+def check_pak_read_into(chunk, tail):
+    """Check a pak read that landed in chunk, tail is the CRC byte"""
+    if len(chunk) != 32 or len(tail) != 1:
+        raise Exception(
+            f'invalid response length {len(chunk) + len(tail)}')
 
-    def pak_write(self, address, data):
-        if len(data) != 32:
-            raise ValueError('data buffer must be 32 bytes')
+    crc_received = tail[0]
+    crc_calculated = data_crc_lookup(chunk)
 
-        packed_addr = pack_addr(address)
+    if crc_received != crc_calculated:
+        raise BadCRCException(
+            f'CRC mismatched (received {crc_received:02x}, '
+            f'calculated {crc_calculated:02x}')
 
-        cmd = struct.pack(
-            '>B2s32s',
-            CMD_PAK_WRITE,
-            packed_addr,
-            data)
 
-        response = self.send_cmd(cmd)
+def parse_bulk_record(record):
+    """Check a bulk read record and return the 32 byte chunk"""
+    status = record[0]
+    chunk = bytes(record[1:33])
 
-        crc_received = response[0]
-        crc_calculated = data_crc_lookup(data)
+    if status & (BULK_STATUS_LENGTH | BULK_STATUS_RX):
+        raise BadCRCException(
+            f'bridge failed to read chunk (status {status:02x})')
 
-        if crc_received != crc_calculated:
-            raise BadCRCException(
-                f'CRC mismatched (received {crc_received:02x}, '
-                f'calculated {crc_calculated:02x}')
+    # checked again here to catch corruption on the UART
+    crc_received = record[33]
+    crc_calculated = data_crc_lookup(chunk)
+
+    if status & BULK_STATUS_CRC or crc_received != crc_calculated:
+        raise BadCRCException(
+            f'CRC mismatched (received {crc_received:02x}, '
+            f'calculated {crc_calculated:02x}')
+
+    return chunk
+
+
+def pak_write_cmd(address, data):
+    if len(data) != 32:
+        raise ValueError('data buffer must be 32 bytes')
+
+    packed_addr = pack_addr(address)
+
+    return struct.pack(
+        '>B2s32s',
+        CMD_PAK_WRITE,
+        packed_addr,
+        data)
+
+
+def check_pak_write(data, response):
+    """Check the data CRC returned for a pak write"""
+    crc_received = response[0]
+    crc_calculated = data_crc_lookup(data)
+
+    if crc_received != crc_calculated:
+        raise BadCRCException(
+            f'CRC mismatched (received {crc_received:02x}, '
+            f'calculated {crc_calculated:02x}')
+
+
+def check_crc(metrics, cmd, check, *args):
+    """Run a CRC check, recording its time and failures in metrics"""
+    if metrics is None:
+        return check(*args)
+
+    with metrics.timer('crc', cmd):
+        try:
+            return check(*args)
+        except BadCRCException:
+            metrics.count('crc_error', cmd)
+            raise
+
+
+class PakSession:
+    """What is known about the inserted pak
+
+    Cleared whenever the joyport status reports the pak changed or
+    removed, or on an explicit reset, so accessory detection only has
+    to run once per inserted pak.
+    """
+
+    def __init__(self):
+        self.pad_type = None
+        self.pak_present = None
+        # bumped on every clear, so holders of pak state can notice
+        self.generation = 0
+        self.clear()
+
+    def clear(self):
+        self.generation += 1
+        # accessory ID that answered the probe, and IDs that did not
+        self.accessory_id = None
+        self.absent_ids = set()
+        # Transfer Pak cartridge presence
+        self.cart_present = None
+
+
+class Controller:
+
+    def __init__(self, ser, verbose=False, metrics=None, bulk=False):
+        self.ser = ser
+        self.verbose = verbose
+        self.metrics = metrics
+        # read runs of sequential chunks with the bridge's bulk read
+        self.bulk = bulk
+        self.decoder = FrameDecoder(verbose)
+        self.session = PakSession()
+
+    def send_cmd(self, cmd, out=None):
+        if self.metrics is None:
+            return send_cmd(self.ser, cmd, self.verbose, self.decoder,
+                            out=out)
+
+        with self.metrics.timer('transaction', cmd_name(cmd)):
+            return send_cmd(self.ser, cmd, self.verbose, self.decoder,
+                            self.metrics, out)
 
+    def pak_read(self, address):
+        """read a 32 byte chunk from controller pak"""
+        response = self.send_cmd(pak_read_cmd(address))
+        return check_crc(self.metrics, 'pak_read', parse_pak_read, response)
+
+    def pak_read_many(self, addresses, progress=None, return_exceptions=False):
+        """read a sequence of 32 byte chunks from controller pak
+
+        With return_exceptions, a failed read gives its BadCRCException in
+        place of the chunk instead of raising.
+        """
+        if self.bulk:
+            return self.pak_read_many_bulk(addresses, progress,
+                                           return_exceptions)
+
+        chunks = []
+        for address in addresses:
+            try:
+                chunks.append(self.pak_read(address))
+            except BadCRCException as e:
+                if not return_exceptions:
+                    raise
+                chunks.append(e)
+                continue
+            if progress is not None:
+                progress.update(32)
+        return chunks
+
+    def pak_read_into(self, address, view):
+        """read a 32 byte chunk from controller pak into view
+
+        The data is copied straight from the receive buffer into the
+        writable 32 byte view, e.g. a slice of a preallocated dump.
+        """
+        tail = self.send_cmd(pak_read_cmd(address), out=view)
+        check_crc(self.metrics, 'pak_read', check_pak_read_into, view, tail)
+
+    def pak_read_many_into(self, addresses, view, progress=None):
+        """read a sequence of 32 byte chunks into consecutive parts of view"""
+        view = memoryview(view)
+        if self.bulk:
+            # chunks come out of the bulk record stream, copy them in place
+            chunks = self.pak_read_many_bulk(addresses, progress)
+            for i, chunk in enumerate(chunks):
+                view[i * 32:(i + 1) * 32] = chunk
+            return
+
+        for i, address in enumerate(addresses):
+            self.pak_read_into(address, view[i * 32:(i + 1) * 32])
+            if progress is not None:
+                progress.update(32)
+
+    def pak_read_bulk(self, address, count, progress=None,
+                      return_exceptions=False):
+        """read count sequential 32 byte chunks with one bridge request
+
+        The bridge issues the pak reads itself and streams the chunks
+        back, so the whole run costs one host round trip. Needs a bridge
+        with the bulk read opcode. With return_exceptions, a failed chunk
+        gives its BadCRCException in place of the chunk instead of raising.
+        """
+        if self.metrics is None:
+            return self.recv_bulk(address, count, progress, return_exceptions)
+
+        with self.metrics.timer('transaction', 'bulk_read'):
+            return self.recv_bulk(address, count, progress, return_exceptions)
+
+    def recv_bulk(self, address, count, progress, return_exceptions):
+        sendall(self.ser, pack_bulk_read(address, count))
+
+        self.decoder.sync(self.ser, BULK_MAGIC)
+        magic, echo_address, echo_count = BULK_HEADER.unpack(
+            self.decoder.take(self.ser, BULK_HEADER.size))
+        if echo_address != address or echo_count != count:
+            raise Exception(f'bulk read echoed {echo_count} chunks at '
+                            f'{echo_address:04x}')
+
+        # every record is received even after a failure, to stay in sync
+        chunks = []
+        error = None
+        record = bytearray(BULK_RECORD_LEN)
+        for i in range(count):
+            self.decoder.take_into(self.ser, record)
+            try:
+                chunks.append(check_crc(self.metrics, 'pak_read',
+                                        parse_bulk_record, record))
+            except BadCRCException as e:
+                chunks.append(e)
+                error = error or e
+                continue
+            if progress is not None:
+                progress.update(32)
+
+        if error is not None and not return_exceptions:
+            raise error
+        return chunks
+
+    def pak_read_many_bulk(self, addresses, progress=None,
+                           return_exceptions=False):
+        """read chunks with one bulk request per run of sequential addresses"""
+        addresses = list(addresses)
+        chunks = []
+        start = 0
+        for i in range(1, len(addresses) + 1):
+            if i == len(addresses) or \
+               addresses[i] != addresses[i - 1] + 32 or \
+               i - start == MAX_BULK_COUNT:
+                chunks += self.pak_read_bulk(addresses[start], i - start,
+                                             progress, return_exceptions)
+                start = i
+        return chunks
+
+    def pak_write(self, address, data):
+        response = self.send_cmd(pak_write_cmd(address, data))
+        check_crc(self.metrics, 'pak_write', check_pak_write, data, response)
         return response
 
+    def pak_write_many(self, blocks, progress=None, return_exceptions=False):
+        """write a sequence of (address, 32 byte chunk) to controller pak"""
+        responses = []
+        for address, data in blocks:
+            try:
+                responses.append(self.pak_write(address, data))
+            except BadCRCException as e:
+                if not return_exceptions:
+                    raise
+                responses.append(e)
+                continue
+            if progress is not None:
+                progress.update(32)
+        return responses
+
     def check_accessory_id(self, accessory_id):
-        """Check if this type of accessory is connected"""
+        """Check if this type of accessory is connected
+
+        The result is cached until the pak is changed, so only a status
+        query is needed for repeated checks.
+        """
         pad_type, joyport_status = self.pad_query()
 
         if joyport_status & 1 == 0:
@@ -81,6 +304,16 @@ class Controller:
                 print('no accessory pak detected')
             return False
 
+        if joyport_status & 2 != 0:
+            # the changed flag stays set until acknowledged with a reset
+            self.pad_query(reset=True)
+
+        session = self.session
+        if session.accessory_id is not None:
+            return session.accessory_id == accessory_id
+        if accessory_id in session.absent_ids:
+            return False
+
         self.pak_write(0x8000, b'\xfe' * 32)
         reset_response = self.pak_read(0x8000)
 
@@ -95,10 +328,30 @@ class Controller:
             print(f'accessory ID check for {acc_id_byte.hex()}: {response.hex()}')
 
         if response[31] == accessory_id:
+            session.accessory_id = accessory_id
             return True
 
+        session.absent_ids.add(accessory_id)
         return False
 
+    def cpak_present(self):
+        """Check that the pak is not a Rumble Pak or Transfer Pak
+
+        Controller Paks do not answer the accessory ID probe, so any
+        other pak in the joyport is taken to be one.
+        """
+        pad_type, joyport_status = self.pad_query()
+        if joyport_status & 1 == 0:
+            return False
+
+        # Rumble Pak and Transfer Pak IDs
+        return not self.check_accessory_id(0x80) and \
+            not self.check_accessory_id(0x84)
+
+    def reset_session(self):
+        """Forget cached accessory detection"""
+        self.session.clear()
+
     def pad_query(self, reset=False):
         if reset:
             cmd_id = CMD_INFO_RESET
@@ -110,6 +363,14 @@ class Controller:
         response_bytez = self.send_cmd(cmd)
 
         pad_type, joyport_status = struct.unpack('<HB', response_bytez)
+
+        session = self.session
+        if reset or joyport_status & 3 != 1:
+            # pak changed or removed
+            session.clear()
+        session.pad_type = pad_type
+        session.pak_present = joyport_status & 1 != 0
+
         return (pad_type, joyport_status)
 
     def poll_state(self):
@@ -118,33 +379,150 @@ class Controller:
         response = self.send_cmd(cmd)
         return response
 
-    def dump_cpak(self, cpak_filename):
+    def dump_cpak(self, cpak_filename, resume=True, progress=None,
+                  sparse=False, fill=0x00, notes_dir=None, archive=None):
+        """Dump the controller pak to an image file
+
+        With sparse, the ID, inode and note table pages are read first
+        and only the pages the inode table marks as allocated are read
+        after them; free pages are filled with fill. With notes_dir,
+        each note is also exported to its own file there. With an
+        archive, cpak_filename is the dump name; the image is assembled
+        in the archive's staging area and stored once complete.
+        """
         pad_type, joyport_status = self.pad_query(reset=True)
 
         if joyport_status & 1 == 0:
             print('no pak detected')
-            return
+            return False
 
         if self.verbose and joyport_status & 2 != 0:
             print('(pak changed)')
 
-        print(f'dump controller pak to {cpak_filename}...')
-
-        test_file = open(cpak_filename, 'wb')
+        if not self.cpak_present():
+            print('no controller pak detected')
+            return False
 
-        for i in tqdm(range(0, 0x8000, 32)):
-            retry = False
+        print(f'dump controller pak to {cpak_filename}...')
 
-            # read a 32 byte chunk from controller pak
-            try:
-                chunk = self.pak_read(i)
-            except BadCRCException:
-                retry = True
+        image_filename = cpak_filename
+        if archive is not None:
+            image_filename = archive.staging_filename(cpak_filename)
+
+        # bulk reads only pay a round trip per batch, so use fewer
+        dump = ResumableDump(image_filename, CPAK_SIZE, resume=resume,
+                             batch_size=256 if self.bulk else 32)
+        if dump.n_done() > 0:
+            print(f'resuming, {dump.n_chunks - dump.n_done()} chunks left')
+
+        def read_many(addresses):
+            return self.pak_read_many(addresses, return_exceptions=True)
+
+        try:
+            fs = None
+            if sparse or notes_dir is not None:
+                # metadata pages are quick, no progress bar for them
+                with tqdm(disable=True) as quiet:
+                    dump.run(read_many, quiet,
+                             addresses=range(0, METADATA_SIZE, 32))
+                fs = CpakFilesystem(dump.image[:METADATA_SIZE])
+                if not fs.valid():
+                    print('no valid inode table, reading every page')
+                elif fs.broken_notes:
+                    print(f'{len(fs.broken_notes)} notes have broken '
+                          'page chains')
+
+            if sparse and fs.valid():
+                free_pages = fs.free_pages()
+                print(f'{len(fs.notes)} notes, '
+                      f'{len(free_pages)} free pages skipped')
+                for page in free_pages:
+                    dump.fill(page * PAGE_SIZE, PAGE_SIZE, fill)
+
+            dump.run(read_many, progress)
+
+            if notes_dir is not None:
+                for filename in export_notes(fs, dump.image, notes_dir):
+                    print(f'exported {filename}')
+
+            if archive is not None:
+                archive.put(cpak_filename, 'cpak', dump.image,
+                            {'sparse': sparse and fs.valid()})
+        finally:
+            if self.metrics is not None:
+                self.metrics.count('retry', 'pak_read',
+                                   sum(dump.retries.attempts.values()))
+            dump.close()
+
+        if archive is not None:
+            os.remove(image_filename)
+        return True
+
+    def restore_cpak(self, cpak_filename, reference_filename=None):
+        """Write an image to the controller pak, skipping unchanged blocks
+
+        The pak contents are taken from the reference image if given (for
+        example the dump the image was edited from), otherwise they are read
+        from the pak. The CRC returned by each write verifies it, so there
+        is no read-back pass. The reference is updated after the restore.
+        Returns the number of blocks written, 0 if the pak already held
+        the image, or None if the restore could not start.
+        """
+        with open(cpak_filename, 'rb') as f:
+            image = f.read()
+
+        if len(image) != 0x8000:
+            print('controller pak image must be 32 KB')
+            return None
+
+        self.pad_query(reset=True)
+
+        if not self.cpak_present():
+            print('no controller pak detected')
+            return None
+
+        if reference_filename is not None and \
+           os.path.exists(reference_filename):
+            with open(reference_filename, 'rb') as f:
+                current = f.read()
+            if len(current) != 0x8000:
+                print('reference image must be 32 KB')
+                return None
+        else:
+            print('reading controller pak...')
+            with tqdm(total=0x8000) as progress:
+                current = b''.join(self.pak_read_many(
+                    range(0, 0x8000, 32), progress))
+
+        blocks = [(address, image[address:address + 32])
+                  for address in range(0, 0x8000, 32)
+                  if image[address:address + 32] !=
+                  current[address:address + 32]]
+
+        n_written = len(blocks)
+        print(f'restore {cpak_filename} to controller pak, '
+              f'{n_written} of 1024 blocks changed...')
+
+        with tqdm(total=len(blocks) * 32) as progress:
+            for attempt in range(3):
+                results = self.pak_write_many(blocks, progress,
+                                              return_exceptions=True)
+                blocks = [block for block, result in zip(blocks, results)
+                          if isinstance(result, BadCRCException)]
+                if not blocks:
+                    break
+                if self.metrics is not None:
+                    self.metrics.count('retry', 'pak_write', len(blocks))
+                for address, data in blocks:
+                    progress.write(f'bad CRC, retrying address {address:04x}')
+
+        if blocks:
+            raise BadCRCException(
+                f'{len(blocks)} blocks failed to write, first at '
+                f'{blocks[0][0]:04x}')
 
-            if retry:
-                print(f'bad CRC, retrying address {i:04x}')
-                i -= 32
-            else:
-                test_file.write(chunk)
+        if reference_filename is not None:
+            with open(reference_filename, 'wb') as f:
+                f.write(image)
 
-        test_file.close()
+        return n_written
@@ -0,0 +1,164 @@
+import os
+import struct
+
+# Controller Pak layout, in 256 byte pages
+PAGE_SIZE = 0x100
+N_PAGES = 128
+CPAK_SIZE = N_PAGES * PAGE_SIZE
+
+ID_PAGE = 0
+INODE_PAGE = 1
+INODE_BACKUP_PAGE = 2
+NOTE_PAGE = 3
+FIRST_DATA_PAGE = 5
+
+# ID, inode and note table pages come before any note data
+METADATA_SIZE = FIRST_DATA_PAGE * PAGE_SIZE
+
+N_NOTES = 16
+NOTE_ENTRY = struct.Struct('>4s2sHBxH4s16s')
+
+# inode table values other than the next page of a note
+INODE_END = 0x0001
+INODE_FREE = 0x0003
+
+# N64 font codes of the characters used in note names
+NOTE_CHARS = {0x0f: ' '}
+NOTE_CHARS.update({0x10 + i: c for i, c in enumerate('0123456789')})
+NOTE_CHARS.update({0x1a + i: c
+                   for i, c in enumerate('ABCDEFGHIJKLMNOPQRSTUVWXYZ')})
+NOTE_CHARS.update({0x34 + i: c for i, c in enumerate('!"#\'*+,-./:=?@')})
+
+
+def decode_note_text(data):
+    """Note name or extension as a string, unknown codes as '?'"""
+    return ''.join(NOTE_CHARS.get(b, '?') for b in data.rstrip(b'\x00'))
+
+
+def inode_checksum(table):
+    """Checksum stored in byte 1 of an inode table page
+
+    Only the low (page) byte of the data page entries is summed, the high
+    byte holds the bank on paks with more than one.
+    """
+    return sum(table[FIRST_DATA_PAGE * 2 + 1:N_PAGES * 2:2]) & 0xff
+
+
+class Note:
+    """One note table entry and the pages its inode chain covers"""
+
+    def __init__(self, index, entry):
+        self.index = index
+        self.entry = bytes(entry)
+        (self.game_code, self.publisher_code, self.start_page, self.status,
+         self.data_sum, self.extension, self.name) = NOTE_ENTRY.unpack(entry)
+        self.pages = []
+
+    def in_use(self):
+        return FIRST_DATA_PAGE <= self.start_page < N_PAGES
+
+    def title(self):
+        title = decode_note_text(self.name)
+        extension = decode_note_text(self.extension)
+        if extension:
+            title += f'.{extension}'
+        return title
+
+    def filename(self):
+        """File name for a per-note export"""
+        code = (self.game_code + self.publisher_code).decode('ascii',
+                                                             'replace')
+        name = f'{self.index:02}_{code}_{self.title()}'
+        return ''.join(c if c.isalnum() or c in '-.' else '_'
+                       for c in name) + '.note'
+
+    def __repr__(self):
+        return f'Note({self.index}, {self.title()!r}, ' \
+            f'{len(self.pages)} pages)'
+
+
+class CpakFilesystem:
+    """Allocation index parsed from the metadata pages of a Controller Pak
+
+    The primary inode table is used if its checksum matches, otherwise
+    the backup copy. Every page the inode table does not mark free
+    counts as allocated, so pages of a damaged note chain are still
+    dumped.
+    """
+
+    def __init__(self, metadata):
+        if len(metadata) < METADATA_SIZE:
+            raise ValueError(f'metadata must be {METADATA_SIZE:#x} bytes')
+
+        self.inodes = None
+        for page in [INODE_PAGE, INODE_BACKUP_PAGE]:
+            table = metadata[page * PAGE_SIZE:(page + 1) * PAGE_SIZE]
+            if table[1] == inode_checksum(table):
+                self.inodes = struct.unpack(f'>{N_PAGES}H', table)
+                self.inode_page = page
+                break
+
+        self.notes = []
+        self.broken_notes = []
+        if self.inodes is None:
+            return
+
+        note_table = metadata[NOTE_PAGE * PAGE_SIZE:METADATA_SIZE]
+        for i in range(N_NOTES):
+            note = Note(i, note_table[i * NOTE_ENTRY.size:
+                                      (i + 1) * NOTE_ENTRY.size])
+            if not note.in_use():
+                continue
+            if self.follow_chain(note):
+                self.notes.append(note)
+            else:
+                self.broken_notes.append(note)
+
+    def valid(self):
+        """False if neither inode table checks out, e.g. unformatted"""
+        return self.inodes is not None
+
+    def follow_chain(self, note):
+        """Collect the pages of a note, False if the chain is broken"""
+        seen = set()
+        page = note.start_page
+        while True:
+            if page in seen or not FIRST_DATA_PAGE <= page < N_PAGES:
+                return False
+            seen.add(page)
+            note.pages.append(page)
+
+            next_page = self.inodes[page]
+            if next_page == INODE_END:
+                return True
+            page = next_page
+
+    def allocated_pages(self):
+        """Data pages holding note data, or all of them if not valid"""
+        if not self.valid():
+            return list(range(FIRST_DATA_PAGE, N_PAGES))
+        return [page for page in range(FIRST_DATA_PAGE, N_PAGES)
+                if self.inodes[page] != INODE_FREE]
+
+    def free_pages(self):
+        allocated = set(self.allocated_pages())
+        return [page for page in range(FIRST_DATA_PAGE, N_PAGES)
+                if page not in allocated]
+
+
+def export_notes(fs, image, notes_dir):
+    """Write each note as its note table entry followed by its pages
+
+    Returns the list of files written.
+    """
+    os.makedirs(notes_dir, exist_ok=True)
+
+    filenames = []
+    for note in fs.notes:
+        filename = os.path.join(notes_dir, note.filename())
+        with open(filename, 'wb') as f:
+            f.write(note.entry)
+            for page in note.pages:
+                f.write(image[page * PAGE_SIZE:(page + 1) * PAGE_SIZE])
+        filenames.append(filename)
+    return filenames
@@ -1,3 +1,9 @@
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+
 def u32(val):
     return val & 0xffffffff
 
@@ -12,7 +18,7 @@ def pack_addr(address):
     if address & 0x1f != 0:
         raise ValueError('low 5 bits of address must be clear')
 
-    crc = address_crc(address >> 5)
+    crc = ADDRESS_CRC_TABLE[address >> 5]
 
     return (address | crc).to_bytes(2, 'big')
 
@@ -77,14 +83,52 @@ def data_crc(buf):
     return crc & 0xff
 
 
+# 5-bit address CRC for each of the 2048 32-byte aligned pak addresses
+ADDRESS_CRC_TABLE = [address_crc(i) for i in range(0x800)]
+
 DATA_CRC_TABLE = [data_crc(bytes([i])) for i in range(256)]
 
 
 def data_crc_lookup(buf):
+    # the shifted out high byte never feeds back into the low byte,
+    # so the running CRC can stay 8 bits wide
     crc = 0
+    table = DATA_CRC_TABLE
     for cur_byte in buf:
-        index = cur_byte ^ (crc & 0xff)
-        crc = u32(crc << 8)
-        crc ^= DATA_CRC_TABLE[index]
+        crc = table[cur_byte ^ crc]
 
-    return crc & 0xff
+    return crc
+
+
+def data_crc_batch(buf, chunk_size=32):
+    """Calculate the data CRC of each chunk_size chunk of buf
+
+    Uses NumPy to process every chunk at once when it is installed.
+    """
+    if len(buf) % chunk_size != 0:
+        raise ValueError(f'buffer length must be a multiple of {chunk_size}')
+
+    if np is None:
+        view = memoryview(buf)
+        return [data_crc_lookup(view[i:i + chunk_size])
+                for i in range(0, len(buf), chunk_size)]
+
+    chunks = np.frombuffer(buf, dtype=np.uint8).reshape(-1, chunk_size)
+    table = np.array(DATA_CRC_TABLE, dtype=np.uint8)
+
+    # one table lookup per byte column, across all chunks
+    crcs = np.zeros(len(chunks), dtype=np.uint8)
+    for column in chunks.T:
+        crcs = table[column ^ crcs]
+
+    return crcs.tolist()
+
+
+def check_data_crcs(buf, crcs, chunk_size=32):
+    """Return indexes of chunks that don't match the expected CRCs"""
+    calculated = data_crc_batch(buf, chunk_size)
+    if len(calculated) != len(crcs):
+        raise ValueError(f'expected {len(calculated)} CRCs, got {len(crcs)}')
+
+    return [i for i, (expected, actual) in enumerate(zip(crcs, calculated))
+            if expected != actual]
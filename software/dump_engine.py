@@ -0,0 +1,234 @@
+import collections
+import mmap
+import os
+import time
+from tqdm import tqdm
+
+
+class ChunkBitmap:
+    """Bitmap of completed chunks, kept in a sidecar file"""
+
+    def __init__(self, filename, n_chunks):
+        self.filename = filename
+        self.n_chunks = n_chunks
+        n_bytes = (n_chunks + 7) // 8
+
+        self.bits = bytearray(n_bytes)
+        if os.path.exists(filename):
+            with open(filename, 'rb') as f:
+                saved = f.read()
+            # ignore progress saved for a different image size
+            if len(saved) == n_bytes:
+                self.bits[:] = saved
+
+    def is_set(self, i):
+        return self.bits[i >> 3] & (1 << (i & 7)) != 0
+
+    def set(self, i):
+        self.bits[i >> 3] |= 1 << (i & 7)
+
+    def count(self):
+        return sum(bin(b).count('1') for b in self.bits)
+
+    def missing(self):
+        return [i for i in range(self.n_chunks) if not self.is_set(i)]
+
+    def save(self):
+        tmp_filename = self.filename + '.tmp'
+        with open(tmp_filename, 'wb') as f:
+            f.write(self.bits)
+        os.replace(tmp_filename, self.filename)
+
+    def remove(self):
+        if os.path.exists(self.filename):
+            os.remove(self.filename)
+
+
+class RetryQueue:
+    """Bounded queue of failed addresses with exponential backoff"""
+
+    def __init__(self, max_size=64, max_attempts=5, base_delay=0.01,
+                 max_delay=0.5):
+        self.max_size = max_size
+        self.max_attempts = max_attempts
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+
+        self.attempts = collections.Counter()
+        # (ready time, address) in order of insertion
+        self.queue = collections.deque()
+
+    def __len__(self):
+        return len(self.queue)
+
+    def full(self):
+        return len(self.queue) >= self.max_size
+
+    def push(self, address):
+        """Queue a failed address
+
+        Returns False, without queueing it, once the address is out of
+        attempts or max_size addresses are already waiting.
+        """
+        if self.full():
+            return False
+
+        self.attempts[address] += 1
+        n = self.attempts[address]
+        if n > self.max_attempts:
+            return False
+
+        delay = min(self.base_delay * 2 ** (n - 1), self.max_delay)
+        self.queue.append((time.monotonic() + delay, address))
+        return True
+
+    def pop_ready(self):
+        """Remove and return addresses whose backoff has expired"""
+        now = time.monotonic()
+        ready = []
+        remaining = collections.deque()
+        for ready_time, address in self.queue:
+            if ready_time <= now:
+                ready.append(address)
+            else:
+                remaining.append((ready_time, address))
+        self.queue = remaining
+        return ready
+
+    def wait(self):
+        """Sleep until the earliest queued address is ready"""
+        if self.queue:
+            delay = min(t for t, a in self.queue) - time.monotonic()
+            if delay > 0:
+                time.sleep(delay)
+
+
+class ResumableDump:
+    """Dump into a preallocated, memory-mapped image
+
+    Completed chunks are tracked in `<filename>.progress`, so an
+    interrupted dump resumes by reading only the missing chunks. Chunks
+    that fail go into a RetryQueue instead of stalling the sweep; the
+    dump stops if a chunk runs out of attempts or the queue overflows.
+    """
+
+    def __init__(self, filename, size, chunk_size=32, resume=True,
+                 batch_size=32, retry_queue=None):
+        if size % chunk_size != 0:
+            raise ValueError('size must be a multiple of the chunk size')
+
+        self.filename = filename
+        self.size = size
+        self.chunk_size = chunk_size
+        self.n_chunks = size // chunk_size
+        self.batch_size = batch_size
+        self.retries = retry_queue if retry_queue is not None else RetryQueue()
+
+        # An existing image without progress is a finished or foreign
+        # file, and progress without a matching image is stale
+        progress_filename = filename + '.progress'
+        resuming = resume and os.path.exists(progress_filename) and \
+            os.path.isfile(filename) and os.path.getsize(filename) == size
+        if not resuming and os.path.exists(progress_filename):
+            os.remove(progress_filename)
+        self.bitmap = ChunkBitmap(progress_filename, self.n_chunks)
+
+        self.file = open(filename, 'r+b' if resuming else 'w+b')
+        self.file.truncate(size)
+        self.image = mmap.mmap(self.file.fileno(), size)
+
+    def n_done(self):
+        return self.bitmap.count()
+
+    def checkpoint(self):
+        # image data must be on disk before it is marked complete
+        self.image.flush()
+        self.bitmap.save()
+
+    def store(self, address, chunk):
+        self.image[address:address + self.chunk_size] = chunk
+        self.bitmap.set(address // self.chunk_size)
+
+    def fill(self, address, length, value=0x00):
+        """Mark chunks complete without reading them, filled with value
+
+        Chunks already read, e.g. by an interrupted dump, are kept.
+        """
+        fill_chunk = bytes([value]) * self.chunk_size
+        for chunk_address in range(address, address + length,
+                                   self.chunk_size):
+            if not self.bitmap.is_set(chunk_address // self.chunk_size):
+                self.store(chunk_address, fill_chunk)
+
+    def read_batch(self, read_many, addresses, progress):
+        """Read addresses, queueing the ones that fail for retry
+
+        If a failed address cannot be queued, the chunks that were read
+        are still stored before its error is raised.
+        """
+        results = read_many(addresses)
+
+        error = None
+        for address, result in zip(addresses, results):
+            if isinstance(result, Exception):
+                if not self.retries.push(address):
+                    error = error or result
+                    continue
+                progress.write(f'bad CRC, retrying address {address:04x}')
+            else:
+                self.store(address, result)
+                progress.update(self.chunk_size)
+
+        if error is not None:
+            raise error
+
+    def run(self, read_many, progress=None, addresses=None):
+        """Read all missing chunks
+
+        read_many(addresses) returns a chunk or an exception per address.
+        With addresses, only the missing chunks among them are read.
+        Progress is counted in bytes; a progress bar passed in is left
+        open for the caller.
+        """
+        missing = [i * self.chunk_size for i in self.bitmap.missing()]
+        done = self.size - len(missing) * self.chunk_size
+        if addresses is not None:
+            addresses = set(addresses)
+            missing = [a for a in missing if a in addresses]
+
+        own_progress = progress is None
+        if own_progress:
+            progress = tqdm(total=self.size, initial=done)
+        else:
+            progress.reset(total=self.size)
+            progress.update(done)
+
+        try:
+            for i in range(0, len(missing), self.batch_size):
+                self.read_batch(read_many, missing[i:i + self.batch_size],
+                                progress)
+
+                # retry failed chunks between batches, and block
+                # on them only when the queue is full
+                if self.retries.full():
+                    self.retries.wait()
+                ready = self.retries.pop_ready()
+                if ready:
+                    self.read_batch(read_many, ready, progress)
+
+                self.checkpoint()
+
+            while len(self.retries) > 0:
+                self.retries.wait()
+                self.read_batch(read_many, self.retries.pop_ready(), progress)
+        finally:
+            self.checkpoint()
+            if own_progress:
+                progress.close()
+
+        if self.bitmap.count() == self.n_chunks:
+            self.bitmap.remove()
+
+    def close(self):
+        self.image.close()
+        self.file.close()
@@ -0,0 +1,51 @@
+import hashlib
+import zlib
+
+
+class DumpHasher:
+    """Incremental CRC32, MD5 and SHA-1 of a dump
+
+    Data can be added out of order with an offset; it is hashed once
+    everything before it has arrived.
+    """
+
+    def __init__(self):
+        self.crc32 = 0
+        self.md5 = hashlib.md5()
+        self.sha1 = hashlib.sha1()
+
+        self.offset = 0
+        self.pending = {}
+
+    def update(self, data, offset=None):
+        if offset is None:
+            offset = self.offset
+
+        if offset != self.offset:
+            self.pending[offset] = data
+            return
+
+        self.hash(data)
+        while self.offset in self.pending:
+            self.hash(self.pending.pop(self.offset))
+
+    def hash(self, data):
+        self.crc32 = zlib.crc32(data, self.crc32)
+        self.md5.update(data)
+        self.sha1.update(data)
+        self.offset += len(data)
+
+    def digests(self):
+        if self.pending:
+            raise Exception(f'missing data at offset {self.offset:#x}')
+
+        return {
+            'crc32': f'{self.crc32:08x}',
+            'md5': self.md5.hexdigest(),
+            'sha1': self.sha1.hexdigest(),
+        }
+
+
+def block_digest(data):
+    """Short digest used to compare reads of the same block"""
+    return hashlib.blake2b(data, digest_size=16).digest()
@@ -0,0 +1,577 @@
+import random
+import struct
+import threading
+import time
+from urllib.parse import parse_qs, urlparse
+from crc_util import data_crc_lookup, extract_addr, pack_addr
+from gb_cart import GBHeader
+from uart_util import (BULK_HEADER, BULK_MAGIC, BULK_READ_OPCODE,
+                       BULK_REQUEST, BULK_STATUS_CRC, BULK_STATUS_LENGTH,
+                       CMD_INFO, CMD_INFO_RESET, CMD_PAK_READ, CMD_PAK_WRITE,
+                       CMD_STATE)
+
+NINTENDO_LOGO = bytes.fromhex(
+    'ceed6666cc0d000b03730083000c000d0008111f8889000e'
+    'dccc6ee6ddddd999bbbb67636e0eecccdddc999fbbb9333e')
+
+# Cartridge type byte used when generating ROMs for each MBC
+CART_TYPES = {
+    'NO_MBC': 0x08,  # ROM+RAM
+    'MBC1': 0x03,    # MBC1+RAM+BATTERY
+    'MBC2': 0x06,    # MBC2+BATTERY
+    'MBC3': 0x13,    # MBC3+RAM+BATTERY
+    'MBC5': 0x1b,    # MBC5+RAM+BATTERY
+}
+
+# RAM size byte for each number of 8 KB banks
+RAM_SIZE_CODES = {0: 0, 1: 2, 4: 3, 8: 5, 16: 4}
+
+
+class TimingModel:
+    """Timing of a UART host bridge transaction
+
+    baudrate: UART baud rate between host and bridge
+    joybus_bit_time: JoyBus bit period in seconds
+    usb_latency: one-way USB-serial latency in seconds
+    realtime: sleep for modelled delays instead of only tracking them
+    """
+
+    def __init__(self, baudrate=1500000, joybus_bit_time=4e-6,
+                 usb_latency=0.001, realtime=False):
+        self.baudrate = baudrate
+        self.joybus_bit_time = joybus_bit_time
+        self.usb_latency = usb_latency
+        self.realtime = realtime
+
+    def uart_time(self, n_bytes):
+        # start bit, 8 data bits, stop bit
+        return n_bytes * 10 / self.baudrate
+
+    def joybus_time(self, tx_bytes, rx_bytes):
+        # each direction ends with a stop bit
+        n_bits = tx_bytes * 8 + 1
+        if rx_bytes > 0:
+            n_bits += rx_bytes * 8 + 1
+        return n_bits * self.joybus_bit_time
+
+
+class ControllerPak:
+    """32 KB Controller Pak memory"""
+
+    accessory_id = None
+
+    def __init__(self, data=None):
+        if data is None:
+            data = bytes(0x8000)
+        elif len(data) != 0x8000:
+            raise ValueError('Controller Pak image must be 32 KB')
+        self.mem = bytearray(data)
+
+    def read(self, address):
+        if address < 0x8000:
+            return bytes(self.mem[address:address + 32])
+        return bytes(32)
+
+    def write(self, address, data):
+        if address < 0x8000:
+            self.mem[address:address + 32] = data
+
+
+class RumblePak:
+
+    accessory_id = 0x80
+
+    def __init__(self):
+        self.probe = 0
+        self.rumble = False
+
+    def read(self, address):
+        if 0x8000 <= address < 0x9000 and self.probe == self.accessory_id:
+            return bytes([self.accessory_id]) * 32
+        return bytes(32)
+
+    def write(self, address, data):
+        if 0x8000 <= address < 0x9000:
+            self.probe = data[31]
+        elif address >= 0xc000:
+            self.rumble = data[31] & 1 == 1
+
+
+class TransferPak:
+
+    accessory_id = 0x84
+
+    def __init__(self, cart=None):
+        self.cart = cart
+        self.probe = 0
+        self.bank = 0
+        self.access = False
+
+    def enabled(self):
+        return self.probe == self.accessory_id
+
+    def read(self, address):
+        if 0x8000 <= address < 0x9000:
+            return bytes([self.probe if self.enabled() else 0]) * 32
+        elif not self.enabled():
+            return bytes(32)
+        elif 0xa000 <= address < 0xb000:
+            return bytes([self.bank]) * 32
+        elif 0xb000 <= address < 0xc000:
+            status = 0x80 if self.cart is not None else 0x40
+            return bytes([status]) * 32
+        elif address >= 0xc000:
+            if self.cart is None or not self.access:
+                return bytes(32)
+            cart_addr = self.bank * 0x4000 + address - 0xc000
+            return bytes(self.cart.read(cart_addr + i) for i in range(32))
+        return bytes(32)
+
+    def write(self, address, data):
+        if 0x8000 <= address < 0x9000:
+            self.probe = data[31]
+        elif not self.enabled():
+            return
+        elif 0xa000 <= address < 0xb000:
+            self.bank = data[31] & 3
+        elif 0xb000 <= address < 0xc000:
+            self.access = data[31] & 1 == 1
+            if self.cart is not None and not self.access:
+                # cartridge loses power
+                self.cart.reset()
+        elif address >= 0xc000:
+            if self.cart is None or not self.access:
+                return
+            cart_addr = self.bank * 0x4000 + address - 0xc000
+            for i, value in enumerate(data):
+                self.cart.write(cart_addr + i, value)
+
+
+class GBCart:
+    """Game Boy cartridge with MBC1, MBC2, MBC3 or MBC5 banking"""
+
+    def __init__(self, rom, ram=None):
+        self.rom = bytes(rom)
+        header = GBHeader(self.rom[0x100:0x150])
+        self.mbc_type = header.get_mbc_type()
+
+        if self.mbc_type not in CART_TYPES:
+            raise NotImplementedError(f'MBC type {self.mbc_type} not emulated')
+
+        ram_size = header.get_ram_size()
+        if ram is None:
+            ram = bytes(ram_size)
+        elif len(ram) != ram_size:
+            raise ValueError(f'RAM image must be {ram_size:#x} bytes')
+        self.ram = bytearray(ram)
+
+        self.n_rom_banks = max(len(self.rom) // 0x4000, 2)
+        self.reset()
+
+    def reset(self):
+        self.ram_enabled = False
+        self.rom_bank = 1
+        self.bank_high = 0
+        self.ram_bank = 0
+        self.mode = 0
+
+    def rom_bank_0(self):
+        if self.mbc_type == 'MBC1' and self.mode == 1:
+            return (self.bank_high << 5) % self.n_rom_banks
+        return 0
+
+    def rom_bank_n(self):
+        if self.mbc_type == 'NO_MBC':
+            bank = 1
+        elif self.mbc_type == 'MBC1':
+            bank = (self.bank_high << 5) | (self.rom_bank & 0x1f or 1)
+        elif self.mbc_type == 'MBC2':
+            bank = self.rom_bank & 0xf or 1
+        elif self.mbc_type == 'MBC3':
+            bank = self.rom_bank & 0x7f or 1
+        else:
+            bank = self.rom_bank & 0x1ff
+        return bank % self.n_rom_banks
+
+    def ram_offset(self, address):
+        if self.mbc_type == 'MBC1':
+            bank = self.bank_high if self.mode == 1 else 0
+        elif self.mbc_type == 'MBC3':
+            bank = self.ram_bank & 3
+        elif self.mbc_type == 'MBC5':
+            bank = self.ram_bank & 0xf
+        else:
+            bank = 0
+        return (bank * 0x2000 + address - 0xa000) % len(self.ram)
+
+    def ram_accessible(self):
+        if len(self.ram) == 0:
+            return False
+        return self.mbc_type == 'NO_MBC' or self.ram_enabled
+
+    def read(self, address):
+        if address < 0x4000:
+            return self.rom[self.rom_bank_0() * 0x4000 + address]
+        elif address < 0x8000:
+            return self.rom[self.rom_bank_n() * 0x4000 + address - 0x4000]
+        elif 0xa000 <= address < 0xc000 and self.ram_accessible():
+            if self.mbc_type == 'MBC2':
+                # only the low nibble is stored
+                return 0xf0 | self.ram[self.ram_offset(address)]
+            return self.ram[self.ram_offset(address)]
+        return 0xff
+
+    def write(self, address, value):
+        if self.mbc_type == 'NO_MBC':
+            if 0xa000 <= address < 0xc000 and self.ram_accessible():
+                self.ram[self.ram_offset(address)] = value
+            return
+
+        if self.mbc_type == 'MBC2' and address < 0x4000:
+            # address bit 8 selects the register
+            if address & 0x100:
+                self.rom_bank = value & 0xf
+            else:
+                self.ram_enabled = value & 0xf == 0xa
+        elif self.mbc_type == 'MBC2' and 0xa000 <= address < 0xc000:
+            if self.ram_accessible():
+                self.ram[self.ram_offset(address)] = value & 0xf
+        elif address < 0x2000:
+            self.ram_enabled = value & 0xf == 0xa
+        elif address < 0x4000:
+            if self.mbc_type == 'MBC5':
+                if address < 0x3000:
+                    self.rom_bank = (self.rom_bank & 0x100) | value
+                else:
+                    self.rom_bank = (self.rom_bank & 0xff) | ((value & 1) << 8)
+            else:
+                self.rom_bank = value
+        elif address < 0x6000:
+            if self.mbc_type == 'MBC1':
+                self.bank_high = value & 3
+            else:
+                self.ram_bank = value
+        elif address < 0x8000:
+            if self.mbc_type == 'MBC1':
+                self.mode = value & 1
+        elif 0xa000 <= address < 0xc000 and self.ram_accessible():
+            self.ram[self.ram_offset(address)] = value
+
+
+def make_test_rom(mbc_type='MBC5', n_rom_banks=4, n_ram_banks=1,
+                  title=b'COJIRO EMU', seed=0):
+    """Build a ROM image with a valid header and per-bank test data"""
+    if n_rom_banks < 2 or n_rom_banks & (n_rom_banks - 1) != 0:
+        raise ValueError('number of ROM banks must be a power of two')
+
+    rng = random.Random(seed)
+    rom = bytearray(rng.randbytes(n_rom_banks * 0x4000))
+
+    # tag each bank with its number
+    for bank in range(n_rom_banks):
+        struct.pack_into('>H', rom, bank * 0x4000 + 0x3ffe, bank)
+
+    rom[0x100:0x104] = b'\x00\xc3\x50\x01'
+    rom[0x104:0x134] = NINTENDO_LOGO
+    rom[0x134:0x144] = title[:16].ljust(16, b'\x00')
+    rom[0x144:0x146] = b'00'
+    rom[0x146] = 0
+    rom[0x147] = CART_TYPES[mbc_type]
+    rom[0x148] = (n_rom_banks // 2).bit_length() - 1
+    # MBC2 RAM is not reported in the header
+    rom[0x149] = 0 if mbc_type == 'MBC2' else RAM_SIZE_CODES[n_ram_banks]
+    rom[0x14a] = 1
+    rom[0x14b] = 0x33
+    rom[0x14c] = 0
+
+    hdr_chk = 0
+    for b in rom[0x134:0x14d]:
+        hdr_chk = (hdr_chk + ~b) & 0xff
+    rom[0x14d] = hdr_chk
+
+    global_chk = (sum(rom) - rom[0x14e] - rom[0x14f]) & 0xffff
+    struct.pack_into('>H', rom, 0x14e, global_chk)
+
+    return bytes(rom)
+
+
+class EmulatedController:
+    """N64 controller with an optional accessory pak"""
+
+    def __init__(self, pak=None, pad_type=0x0005):
+        self.pad_type = pad_type
+        self.pak = pak
+        self.pak_changed = pak is not None
+        self.state = bytes(4)
+
+    def insert_pak(self, pak):
+        self.pak = pak
+        self.pak_changed = True
+
+    def joyport_status(self):
+        status = 0
+        if self.pak is not None:
+            status |= 0x01
+        if self.pak_changed:
+            status |= 0x02
+        return status
+
+    def handle(self, cmd):
+        """Return the response to a JoyBus command, or b'' for none"""
+        cmd_id = cmd[0]
+
+        if cmd_id in [CMD_INFO, CMD_INFO_RESET]:
+            response = struct.pack('<HB', self.pad_type,
+                                   self.joyport_status())
+            if cmd_id == CMD_INFO_RESET:
+                self.pak_changed = False
+            return response
+        elif cmd_id == CMD_STATE:
+            return self.state
+        elif cmd_id == CMD_PAK_READ and len(cmd) == 3:
+            address, crc = extract_addr(cmd[1:3])
+            if self.pak is None:
+                # no pak, controller reports inverted CRC
+                return bytes(32) + bytes([data_crc_lookup(bytes(32)) ^ 0xff])
+            data = self.pak.read(address)
+            return data + bytes([data_crc_lookup(data)])
+        elif cmd_id == CMD_PAK_WRITE and len(cmd) == 35:
+            address, crc = extract_addr(cmd[1:3])
+            data = cmd[3:]
+            if self.pak is None:
+                return bytes([data_crc_lookup(data) ^ 0xff])
+            self.pak.write(address, data)
+            return bytes([data_crc_lookup(data)])
+
+        return b''
+
+
+class EmulatedSerial:
+    """serial.Serial stand-in speaking the top_uart_host.v protocol
+
+    Commands written to it are answered by `device` and the AA 55 frames
+    become readable once the timing model says the bridge would have
+    sent them. Unless the timing model is realtime, time is virtual and
+    advances only as frames are read, so `elapsed()` reports how long
+    the same traffic would take on hardware.
+    """
+
+    def __init__(self, device, timing=None, timeout=None, name='emulator'):
+        self.device = device
+        self.timing = timing if timing is not None else TimingModel()
+        self.timeout = timeout
+        self.name = name
+        self.is_open = True
+
+        self.lock = threading.Condition()
+        self.tx_buf = bytearray()
+        self.rx_buf = bytearray()
+
+        # (time available to the host, frame bytes)
+        self.frames = []
+
+        self.start_time = time.perf_counter()
+        self.virtual_time = 0.0
+        self.bridge_free = 0.0
+
+    @classmethod
+    def from_url(cls, url, timeout=None):
+        """Create from an emu:// URL
+
+        emu://cpak?image=FILE, emu://rpak, emu://none or
+        emu://tpak?rom=FILE&ram=FILE&mbc=MBC5, with optional timing
+        parameters baudrate, bit_time, usb_latency and realtime.
+        """
+        parsed = urlparse(url)
+        params = {k: v[-1] for k, v in parse_qs(parsed.query).items()}
+        kind = parsed.netloc or parsed.path.lstrip('/')
+
+        if kind == 'cpak':
+            image = None
+            if 'image' in params:
+                with open(params['image'], 'rb') as f:
+                    image = f.read()
+            pak = ControllerPak(image)
+        elif kind == 'rpak':
+            pak = RumblePak()
+        elif kind == 'tpak':
+            if 'rom' in params:
+                with open(params['rom'], 'rb') as f:
+                    rom = f.read()
+            else:
+                rom = make_test_rom(params.get('mbc', 'MBC5'),
+                                    int(params.get('rom_banks', 4)),
+                                    int(params.get('ram_banks', 1)))
+            ram = None
+            if 'ram' in params:
+                with open(params['ram'], 'rb') as f:
+                    ram = f.read()
+            pak = TransferPak(GBCart(rom, ram))
+        elif kind == 'none':
+            pak = None
+        else:
+            raise ValueError(f'unknown emulated device {kind}')
+
+        timing = TimingModel(
+            baudrate=int(params.get('baudrate', 1500000)),
+            joybus_bit_time=float(params.get('bit_time', 4e-6)),
+            usb_latency=float(params.get('usb_latency', 0.001)),
+            realtime=params.get('realtime', '0') not in ['0', 'false'])
+
+        return cls(EmulatedController(pak), timing, timeout, url)
+
+    def now(self):
+        if self.timing.realtime:
+            return time.perf_counter() - self.start_time
+        return self.virtual_time
+
+    def elapsed(self):
+        """Modelled time since the port was opened"""
+        return self.now()
+
+    def write(self, data):
+        with self.lock:
+            self.tx_buf += data
+
+            # handle every complete length-prefixed command
+            while self.tx_buf:
+                if self.tx_buf[0] == BULK_READ_OPCODE:
+                    if len(self.tx_buf) < BULK_REQUEST.size:
+                        break
+                    opcode, address, count = BULK_REQUEST.unpack(
+                        self.tx_buf[:BULK_REQUEST.size])
+                    del self.tx_buf[:BULK_REQUEST.size]
+                    self.bulk_read(address, count)
+                    continue
+
+                n = self.tx_buf[0]
+                if len(self.tx_buf) <= n:
+                    break
+                cmd = bytes(self.tx_buf[1:1 + n])
+                del self.tx_buf[:1 + n]
+                self.transact(cmd)
+
+            self.lock.notify_all()
+
+        return len(data)
+
+    def transact(self, cmd):
+        timing = self.timing
+        response = self.device.handle(cmd) if cmd else b''
+        frame = b'\xaa\x55' + bytes([len(cmd), len(response)]) + \
+            cmd + response
+
+        arrival = self.now() + timing.usb_latency + timing.uart_time(1 + len(cmd))
+        start = max(arrival, self.bridge_free)
+        done = start + timing.joybus_time(len(cmd), len(response)) + \
+            timing.uart_time(len(frame))
+        self.bridge_free = done
+
+        self.frames.append((done + timing.usb_latency, frame))
+
+    def bulk_read(self, address, count):
+        """Answer a bulk pak read, one record per chunk as it completes"""
+        timing = self.timing
+        header = BULK_HEADER.pack(BULK_MAGIC, address, count)
+
+        arrival = self.now() + timing.usb_latency + \
+            timing.uart_time(BULK_REQUEST.size)
+        done = max(arrival, self.bridge_free) + timing.uart_time(len(header))
+        self.frames.append((done + timing.usb_latency, header))
+
+        for i in range(count):
+            chunk_address = (address + i * 32) & 0xffe0
+            cmd = bytes([CMD_PAK_READ]) + pack_addr(chunk_address)
+            response = self.device.handle(cmd)
+
+            status = 0
+            if len(response) != 33:
+                status |= BULK_STATUS_LENGTH
+                response = response[:33].ljust(33, b'\x00')
+            elif response[32] != data_crc_lookup(response[:32]):
+                status |= BULK_STATUS_CRC
+
+            record = bytes([status]) + response
+            done += timing.joybus_time(len(cmd), 33) + \
+                timing.uart_time(len(record))
+            self.frames.append((done + timing.usb_latency, record))
+
+        self.bridge_free = done
+
+    def deliver(self):
+        """Move frames the host would have received by now"""
+        now = self.now()
+        while self.frames and self.frames[0][0] <= now:
+            self.rx_buf += self.frames.pop(0)[1]
+
+    def wait_next_frame(self, deadline):
+        """Wait for the next frame, return False on timeout"""
+        if not self.frames:
+            remaining = None
+            if deadline is not None:
+                remaining = deadline - time.perf_counter()
+                if remaining <= 0:
+                    return False
+            return self.lock.wait(remaining) or bool(self.frames)
+
+        available = self.frames[0][0]
+        if self.timing.realtime:
+            delay = available - self.now()
+            if deadline is not None and \
+               time.perf_counter() + delay > deadline:
+                self.lock.wait(max(deadline - time.perf_counter(), 0))
+                return False
+            if delay > 0:
+                self.lock.wait(delay)
+        else:
+            self.virtual_time = max(self.virtual_time, available)
+        return True
+
+    def read(self, size=1):
+        deadline = None
+        if self.timeout is not None:
+            deadline = time.perf_counter() + self.timeout
+
+        with self.lock:
+            while True:
+                self.deliver()
+                if len(self.rx_buf) >= size:
+                    break
+                if not self.wait_next_frame(deadline):
+                    break
+
+            data = bytes(self.rx_buf[:size])
+            del self.rx_buf[:size]
+            return data
+
+    def readinto(self, b):
+        data = self.read(len(b))
+        b[:len(data)] = data
+        return len(data)
+
+    @property
+    def in_waiting(self):
+        with self.lock:
+            self.deliver()
+            return len(self.rx_buf)
+
+    def reset_input_buffer(self):
+        with self.lock:
+            self.deliver()
+            self.rx_buf.clear()
+
+    def reset_output_buffer(self):
+        with self.lock:
+            self.tx_buf.clear()
+
+    def flush(self):
+        pass
+
+    def close(self):
+        self.is_open = False
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
@@ -87,7 +87,10 @@ class GBHeader:
         if self._ram_size > 5:
             raise ValueError('RAM size code unknown')
 
-        if self._ram_size < 2:
+        if self.get_mbc_type() == 'MBC2':
+            # 512x4 bits built into the MBC, header reports no RAM
+            return 0x200
+        elif self._ram_size < 2:
             return 0
         elif self._ram_size == 2:
             return 0x2000
@@ -117,3 +120,25 @@ class GBHeader:
             return 'MBC7'
 
         return None
+
+
+class GlobalChecksum:
+    """Running Game Boy global checksum over ROM data
+
+    The global checksum is the 16-bit sum of every ROM byte except the
+    two checksum bytes at 0x14e-0x14f, so banks can be added in any order.
+    """
+
+    def __init__(self):
+        self.total = 0
+
+    def update(self, offset, data):
+        self.total += sum(data)
+
+        # exclude the checksum bytes themselves
+        for address in [0x14e, 0x14f]:
+            if offset <= address < offset + len(data):
+                self.total -= data[address - offset]
+
+    def value(self):
+        return self.total & 0xffff
@@ -0,0 +1,202 @@
+class MBC:
+    """Game Boy memory bank controller accessed through a Transfer Pak
+
+    Register values written are shadowed so writes that would not change
+    the register are skipped. Each register write is a full pak write,
+    often with a Transfer Pak bank switch before it.
+    """
+
+    name = None
+    max_rom_banks = 2
+    max_ram_banks = 1
+
+    def __init__(self, tpak):
+        self.tpak = tpak
+        self.regs = {}
+
+    def reset(self):
+        """Forget register state, e.g. after the cart is power cycled"""
+        self.regs = {}
+
+    def write_reg(self, address, value):
+        """Write register unless it already holds value"""
+        if self.regs.get(address) == value:
+            return False
+
+        self.tpak.cart_write_fill(address, value)
+        self.regs[address] = value
+        return True
+
+    def check_rom_bank(self, rom_bank):
+        if rom_bank < 0:
+            raise ValueError('ROM bank must be positive')
+        elif rom_bank >= self.max_rom_banks:
+            raise ValueError(f'{self.name} supports at most '
+                             f'{self.max_rom_banks} ROM banks')
+
+    def check_ram_bank(self, ram_bank):
+        if ram_bank < 0 or ram_bank >= self.max_ram_banks:
+            raise ValueError(f'{self.name} supports at most '
+                             f'{self.max_ram_banks} RAM banks')
+
+    def enable_ram(self, enable):
+        self.write_reg(0x0000, 0x0a if enable else 0x00)
+
+    def select_rom_bank(self, rom_bank):
+        """Map a ROM bank and return the cart address it is visible at"""
+        raise NotImplementedError()
+
+    def select_ram_bank(self, ram_bank):
+        """Map a RAM bank at a000-bfff"""
+        raise NotImplementedError()
+
+    def bank_group(self, rom_bank):
+        """Banks in the same group share every register but the bank number"""
+        return 0
+
+    def plan_rom_reads(self, rom_banks):
+        """Order bank reads so shared MBC registers are written once
+
+        Banks are grouped by the registers they share besides the bank
+        number (MBC1's BANK2), and within a group banks that can only be
+        mapped at 0000-3fff come first. For the MBCs here this is the
+        sequential order. Transfer Pak bank switches are the same in any
+        order: the bank number register at 2000-3fff is in Transfer Pak
+        bank 0 and the 4000-7fff window in bank 1, so each switchable
+        bank costs two switches.
+        """
+        def key(rom_bank):
+            in_bank_0 = self.rom_bank_address(rom_bank) == 0x0000
+            return (self.bank_group(rom_bank), not in_bank_0, rom_bank)
+
+        return sorted(rom_banks, key=key)
+
+    def rom_bank_address(self, rom_bank):
+        return 0x0000 if rom_bank == 0 else 0x4000
+
+
+class NoMBC(MBC):
+
+    name = 'NO_MBC'
+
+    def enable_ram(self, enable):
+        # RAM is always enabled without an MBC
+        pass
+
+    def select_rom_bank(self, rom_bank):
+        self.check_rom_bank(rom_bank)
+        return self.rom_bank_address(rom_bank)
+
+    def select_ram_bank(self, ram_bank):
+        self.check_ram_bank(ram_bank)
+
+
+class MBC1(MBC):
+
+    name = 'MBC1'
+    max_rom_banks = 0x80
+    max_ram_banks = 4
+
+    def bank_group(self, rom_bank):
+        # upper two bits come from the shared BANK2 register
+        return rom_bank >> 5
+
+    def rom_bank_address(self, rom_bank):
+        # banks 00/20/40/60 can only be mapped at 0000-3fff
+        return 0x0000 if rom_bank & 0x1f == 0 else 0x4000
+
+    def select_rom_bank(self, rom_bank):
+        self.check_rom_bank(rom_bank)
+
+        # BANK2 register, upper two bits of bank number
+        self.write_reg(0x4000, rom_bank >> 5)
+
+        if rom_bank & 0x1f == 0:
+            # Advanced banking mode maps BANK2 << 5 at 0000-3fff
+            self.write_reg(0x6000, 0x01 if rom_bank != 0 else 0x00)
+            return 0x0000
+
+        # BANK1 register, low 5 bits
+        self.write_reg(0x2000, rom_bank & 0x1f)
+        return 0x4000
+
+    def select_ram_bank(self, ram_bank):
+        self.check_ram_bank(ram_bank)
+
+        # Select RAM banking mode, then 2 bit RAM bank number
+        self.write_reg(0x6000, 0x01)
+        self.write_reg(0x4000, ram_bank & 3)
+
+
+class MBC2(MBC):
+
+    name = 'MBC2'
+    max_rom_banks = 0x10
+
+    # MBC2 registers are selected by address bit 8
+    ROM_BANK_REG = 0x2100
+
+    def select_rom_bank(self, rom_bank):
+        self.check_rom_bank(rom_bank)
+        if rom_bank == 0:
+            return 0x0000
+
+        self.write_reg(self.ROM_BANK_REG, rom_bank & 0xf)
+        return 0x4000
+
+    def select_ram_bank(self, ram_bank):
+        # 512x4 bit RAM built into the MBC
+        self.check_ram_bank(ram_bank)
+
+
+class MBC3(MBC):
+
+    name = 'MBC3'
+    max_rom_banks = 0x80
+    max_ram_banks = 4
+
+    def select_rom_bank(self, rom_bank):
+        self.check_rom_bank(rom_bank)
+        if rom_bank == 0:
+            return 0x0000
+
+        # 7 bit ROM bank number
+        self.write_reg(0x2000, rom_bank & 0x7f)
+        return 0x4000
+
+    def select_ram_bank(self, ram_bank):
+        self.check_ram_bank(ram_bank)
+        # Set 2 bit RAM bank number
+        self.write_reg(0x4000, ram_bank & 3)
+
+
+class MBC5(MBC):
+
+    name = 'MBC5'
+    max_rom_banks = 0x200
+    max_ram_banks = 0x10
+
+    def select_rom_bank(self, rom_bank):
+        self.check_rom_bank(rom_bank)
+        if rom_bank == 0:
+            return 0x0000
+
+        # Low 8 bits and high bit of ROM bank number
+        self.write_reg(0x2000, rom_bank & 0xff)
+        self.write_reg(0x3000, (rom_bank >> 8) & 1)
+        return 0x4000
+
+    def select_ram_bank(self, ram_bank):
+        self.check_ram_bank(ram_bank)
+        self.write_reg(0x4000, ram_bank & 0xf)
+
+
+MBC_CLASSES = {cls.name: cls for cls in [NoMBC, MBC1, MBC2, MBC3, MBC5]}
+
+
+def make_mbc(tpak, gb_header):
+    """Create the MBC for a cartridge header, None if unsupported"""
+    mbc_cls = MBC_CLASSES.get(gb_header.get_mbc_type())
+    if mbc_cls is None:
+        return None
+    return mbc_cls(tpak)
@@ -0,0 +1,176 @@
+import bisect
+import contextlib
+import json
+import threading
+import time
+
+# Names of JoyBus command bytes used as metric labels
+CMD_NAMES = {
+    0xff: 'info_reset',
+    0x00: 'info',
+    0x01: 'state',
+    0x02: 'pak_read',
+    0x03: 'pak_write',
+}
+
+# Upper bounds of the latency histogram buckets, in seconds
+LATENCY_BUCKETS = [50e-6, 100e-6, 200e-6, 500e-6, 1e-3, 2e-3, 5e-3, 10e-3,
+                   20e-3, 50e-3, 100e-3]
+
+METRIC_PREFIX = 'cojiro'
+
+
+def cmd_name(command):
+    """Label for a command, from its first byte"""
+    if not command:
+        return 'empty'
+    return CMD_NAMES.get(command[0], f'{command[0]:02x}')
+
+
+class PhaseStats:
+    """Count, total, max and bucket counts of one phase's durations"""
+
+    def __init__(self):
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+        # one count per bucket plus one for larger values
+        self.buckets = [0] * (len(LATENCY_BUCKETS) + 1)
+
+    def add(self, seconds):
+        self.count += 1
+        self.total += seconds
+        self.max = max(self.max, seconds)
+        self.buckets[bisect.bisect_left(LATENCY_BUCKETS, seconds)] += 1
+
+    def to_dict(self):
+        return {
+            'count': self.count,
+            'total': self.total,
+            'mean': self.total / self.count if self.count else 0.0,
+            'max': self.max,
+        }
+
+
+class Metrics:
+    """Per-command phase timings and event counts for the host stack
+
+    Transactions are split into phases: `write` (sending the command),
+    `read` (waiting for and reading the frame, which includes the
+    bridge's Joy Bus exchange) and `parse` (frame decoding).
+    `transaction` is the whole exchange, so the Python overhead is what
+    it has left over. The data CRC check after it is timed as `crc`.
+    Events count resyncs, CRC failures and retries. One instance may be
+    shared between threads.
+    """
+
+    # phases that make up a transaction
+    PHASES = ['write', 'read', 'parse']
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self.lock:
+            # (command name, phase) -> PhaseStats
+            self.phases = {}
+            # (event, command name) -> count
+            self.events = {}
+            self.start_time = time.time()
+
+    def observe(self, phase, cmd, seconds):
+        with self.lock:
+            key = (cmd, phase)
+            if key not in self.phases:
+                self.phases[key] = PhaseStats()
+            self.phases[key].add(seconds)
+
+    def count(self, event, cmd=None, n=1):
+        if n == 0:
+            return
+        with self.lock:
+            key = (event, cmd)
+            self.events[key] = self.events.get(key, 0) + n
+
+    @contextlib.contextmanager
+    def timer(self, phase, cmd):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(phase, cmd, time.perf_counter() - start)
+
+    def snapshot(self):
+        """Current metrics as a JSON-serializable dict"""
+        with self.lock:
+            commands = {}
+            for (cmd, phase), stats in self.phases.items():
+                commands.setdefault(cmd, {})[phase] = stats.to_dict()
+
+            for cmd, phases in commands.items():
+                if 'transaction' in phases:
+                    accounted = sum(phases[p]['total'] for p in self.PHASES
+                                    if p in phases)
+                    phases['overhead'] = {
+                        'total': max(phases['transaction']['total'] -
+                                     accounted, 0.0)
+                    }
+
+            events = {}
+            for (event, cmd), n in self.events.items():
+                events.setdefault(event, {})[cmd or 'all'] = n
+
+            return {
+                'start_time': self.start_time,
+                'elapsed': time.time() - self.start_time,
+                'commands': commands,
+                'events': events,
+            }
+
+    def to_json(self):
+        return json.dumps(self.snapshot(), indent=2)
+
+    def to_prometheus(self):
+        """Metrics in the Prometheus text exposition format"""
+        name = f'{METRIC_PREFIX}_phase_seconds'
+        lines = [
+            f'# HELP {name} Time spent in each phase of a transaction',
+            f'# TYPE {name} histogram',
+        ]
+
+        with self.lock:
+            for (cmd, phase), stats in sorted(self.phases.items()):
+                labels = f'cmd="{cmd}",phase="{phase}"'
+                cumulative = 0
+                for bound, n in zip(LATENCY_BUCKETS, stats.buckets):
+                    cumulative += n
+                    lines.append(f'{name}_bucket{{{labels},le="{bound:g}"}} '
+                                 f'{cumulative}')
+                lines.append(f'{name}_bucket{{{labels},le="+Inf"}} '
+                             f'{stats.count}')
+                lines.append(f'{name}_sum{{{labels}}} {stats.total:.9f}')
+                lines.append(f'{name}_count{{{labels}}} {stats.count}')
+
+            name = f'{METRIC_PREFIX}_events_total'
+            lines.append(f'# HELP {name} Resyncs, CRC failures and retries')
+            lines.append(f'# TYPE {name} counter')
+            for (event, cmd), n in sorted(self.events.items(),
+                                          key=lambda item: (item[0][0],
+                                                            item[0][1] or '')):
+                labels = f'event="{event}"'
+                if cmd is not None:
+                    labels += f',cmd="{cmd}"'
+                lines.append(f'{name}{{{labels}}} {n}')
+
+        return '\n'.join(lines) + '\n'
+
+    def write(self, filename):
+        """Export to a file, Prometheus text for .prom, otherwise JSON"""
+        if filename.endswith('.prom'):
+            data = self.to_prometheus()
+        else:
+            data = self.to_json()
+
+        with open(filename, 'w') as f:
+            f.write(data)
@@ -0,0 +1,491 @@
+#!/usr/bin/env python3
+import argparse
+import os
+import sys
+import threading
+import time
+from accessories.transferpak import TransferPak
+from archive import Archive
+from async_controller import PipelinedController
+from controller import Controller
+from cpak_fs import METADATA_SIZE, CpakFilesystem
+from tqdm import tqdm
+from uart_util import open_port
+
+JOB_KINDS = ['cpak', 'rom', 'ram']
+
+
+class AccessoryMismatch(Exception):
+    """The bridge lacks the pak or cart a job needs"""
+    pass
+
+
+class Job:
+    """One dump, optionally bound to a single port"""
+
+    def __init__(self, kind, filename, port=None):
+        if kind not in JOB_KINDS:
+            raise ValueError(f'unknown job kind {kind}')
+
+        self.kind = kind
+        self.filename = filename
+        self.port = port
+        self.attempts = 0
+        self.done = False
+        self.error = None
+        # ports whose bridge lacks the accessory for this job
+        self.declined_by = set()
+
+    def __str__(self):
+        return f'{self.kind}:{self.filename}'
+
+
+def port_label(port):
+    """Short port name for file templates and log lines"""
+    if port.startswith('emu://'):
+        return port[len('emu://'):].split('?')[0]
+    return os.path.basename(port)
+
+
+def parse_jobs(specs, ports):
+    """Parse `[PORT=]KIND:FILE` job specs
+
+    `{port}` in FILE expands to the port name. An unbound job whose file
+    uses it runs once on every port, other unbound jobs run on whichever
+    port is free first.
+    """
+    jobs = []
+    for spec in specs:
+        # ports and emu:// URLs can contain ':' and '=' themselves
+        port = None
+        for p in ports:
+            if spec.startswith(p + '='):
+                port = p
+                spec = spec[len(p) + 1:]
+                break
+
+        kind, filename = spec.split(':', 1)
+        if kind not in JOB_KINDS and '=' in kind:
+            raise ValueError(f'job bound to unknown port in {spec}')
+
+        if '{port}' in filename and port is None:
+            for p in ports:
+                jobs.append(Job(kind, filename.replace(
+                    '{port}', port_label(p)), p))
+        else:
+            if port is not None:
+                filename = filename.replace('{port}', port_label(port))
+            jobs.append(Job(kind, filename, port))
+
+    return jobs
+
+
+class JobQueue:
+    """Jobs shared between bridge workers"""
+
+    def __init__(self, jobs, max_attempts=3):
+        self.jobs = list(jobs)
+        self.max_attempts = max_attempts
+        self.lock = threading.Lock()
+        self.changed = threading.Condition(self.lock)
+        self.finished = []
+        # jobs taken by workers, which may yet come back to the queue
+        self.in_flight = 0
+
+    def take_locked(self, port):
+        for job in self.jobs:
+            if job.port == port:
+                return job
+        for job in self.jobs:
+            if job.port is None and port not in job.declined_by:
+                return job
+        return None
+
+    def take(self, port):
+        """Next job for port, preferring jobs bound to it
+
+        Waits while other workers' jobs may still be requeued, and
+        returns None once there is nothing left for port.
+        """
+        with self.lock:
+            while True:
+                job = self.take_locked(port)
+                if job is not None:
+                    self.jobs.remove(job)
+                    self.in_flight += 1
+                    return job
+                if self.in_flight == 0:
+                    return None
+                self.changed.wait(0.1)
+
+    def finish_locked(self, job, requeue):
+        self.in_flight -= 1
+        if requeue:
+            self.jobs.append(job)
+        else:
+            self.finished.append(job)
+        self.changed.notify_all()
+        return requeue
+
+    def complete(self, job):
+        job.done = True
+        with self.lock:
+            self.finish_locked(job, False)
+
+    def fail(self, job, error):
+        """Requeue a failed job unless it is out of attempts"""
+        job.attempts += 1
+        job.error = error
+        with self.lock:
+            return self.finish_locked(job, job.attempts < self.max_attempts)
+
+    def decline(self, job, port, error):
+        """Requeue a job for other bridges, without using an attempt
+
+        A job bound to the port fails, as no other bridge can take it.
+        """
+        job.error = error
+        with self.lock:
+            job.declined_by.add(port)
+            return self.finish_locked(job, job.port is None)
+
+    def orphaned(self, ports):
+        """Drop jobs no running worker can take
+
+        These are jobs bound to ports without a running worker, and jobs
+        declined by every running worker.
+        """
+        with self.lock:
+            orphans = [j for j in self.jobs
+                       if j.port is not None and j.port not in ports or
+                       j.port is None and j.declined_by.issuperset(ports)]
+            for job in orphans:
+                self.jobs.remove(job)
+                job.error = job.error or 'no healthy worker for port'
+                self.finished.append(job)
+        return orphans
+
+
+class DeviceHealth:
+    """Job outcomes and throughput of one bridge"""
+
+    def __init__(self, port):
+        self.port = port
+        self.jobs_done = 0
+        self.failures = 0
+        self.consecutive_failures = 0
+        self.n_bytes = 0
+        self.busy_time = 0.0
+        self.healthy = True
+        self.last_error = None
+
+    def record(self, ok, n_bytes, elapsed, error=None):
+        self.busy_time += elapsed
+        if ok:
+            self.jobs_done += 1
+            self.consecutive_failures = 0
+            self.n_bytes += n_bytes
+        else:
+            self.failures += 1
+            self.consecutive_failures += 1
+            self.last_error = error
+
+    def throughput(self):
+        if self.busy_time == 0:
+            return 0.0
+        return self.n_bytes / self.busy_time
+
+
+class AggregateProgress:
+    """Per-worker view of one shared progress bar
+
+    Quacks like the tqdm bars the dump methods create, so each worker's
+    dump adds its size to the shared total and its progress to the
+    shared count. The worker calls finish() once a job is done, or
+    discard() to take a failed attempt back out of the shared bar.
+    """
+
+    def __init__(self, bar, lock, label):
+        self.bar = bar
+        self.lock = lock
+        self.label = label
+        # size and progress of the current job
+        self.total = 0
+        self.n = 0
+
+    def reset(self, total=None):
+        with self.lock:
+            self.bar.total += total - self.total
+            self.total = total
+            self.bar.refresh()
+
+    def update(self, n=1):
+        self.n += n
+        with self.lock:
+            self.bar.update(n)
+
+    def finish(self):
+        self.total = 0
+        self.n = 0
+
+    def discard(self):
+        with self.lock:
+            self.bar.total -= self.total
+            self.bar.n -= self.n
+            self.bar.refresh()
+        self.finish()
+
+    def write(self, s):
+        with self.lock:
+            self.bar.write(f'[{self.label}] {s}')
+
+    def close(self):
+        # the shared bar outlives each dump
+        pass
+
+
+class BridgeWorker(threading.Thread):
+    """Run jobs from the queue on one bridge"""
+
+    def __init__(self, port, queue, bar, bar_lock, baudrate=1500000,
+                 window=1, max_consecutive_failures=2, resume=True,
+                 sparse=False, bulk=False, archive=None):
+        super().__init__(name=port_label(port), daemon=True)
+        self.port = port
+        self.queue = queue
+        self.baudrate = baudrate
+        self.window = window
+        self.max_consecutive_failures = max_consecutive_failures
+        self.resume = resume
+        self.sparse = sparse
+        self.bulk = bulk
+        self.archive = archive
+
+        self.health = DeviceHealth(port)
+        self.progress = AggregateProgress(bar, bar_lock, self.name)
+        self.pad = None
+
+    def log(self, message):
+        self.progress.write(message)
+
+    def open(self):
+        ser = open_port(self.port, self.baudrate)
+        ser.reset_input_buffer()
+        ser.reset_output_buffer()
+
+        if self.bulk:
+            self.pad = Controller(ser, bulk=True)
+        elif self.window > 1:
+            self.pad = PipelinedController(ser, self.window)
+        else:
+            self.pad = Controller(ser)
+        self.pad.pad_query(reset=True)
+        return ser
+
+    def run_job(self, job):
+        """Run a job, return the number of bytes dumped"""
+        if job.kind == 'cpak':
+            if not self.pad.cpak_present():
+                raise AccessoryMismatch('no Controller Pak present')
+
+            # any other pak is taken for a Controller Pak, so look for
+            # its inode table before reading 32 KB of it
+            metadata = b''.join(self.pad.pak_read_many(
+                range(0, METADATA_SIZE, 32)))
+            if not CpakFilesystem(metadata).valid():
+                raise AccessoryMismatch('no valid Controller Pak inode table')
+
+            if not self.pad.dump_cpak(job.filename, resume=self.resume,
+                                      progress=self.progress,
+                                      sparse=self.sparse,
+                                      archive=self.archive):
+                raise AccessoryMismatch('no Controller Pak present')
+            return 0x8000
+
+        tpak = TransferPak(self.pad)
+        if not tpak.check_pak():
+            raise AccessoryMismatch('no Transfer Pak present')
+        if not tpak.cart_present():
+            raise AccessoryMismatch('no cart present')
+
+        tpak.cart_enable(True)
+        header_ok = tpak.load_rom_header()
+        tpak.cart_enable(False)
+        if not header_ok:
+            raise Exception('failed to get valid ROM header')
+
+        # before {title} is expanded, another cart may have RAM
+        ram_size = tpak.gb_header.get_ram_size()
+        if job.kind == 'ram' and ram_size == 0:
+            raise AccessoryMismatch('cart has no RAM')
+
+        title = tpak.gb_header.title_guess().decode('ascii', 'replace')
+        title = ''.join(c if c.isalnum() else '_' for c in title.strip())
+        # the job keeps its template in case another bridge retries it
+        filename = job.filename.replace('{title}', title or 'untitled')
+
+        if job.kind == 'rom':
+            report = tpak.dump_rom(filename, progress=self.progress,
+                                   archive=self.archive)
+            if report is None:
+                raise Exception('ROM not dumped')
+            if report['global_checksum'] != tpak.gb_header.global_checksum:
+                raise Exception('global checksum mismatch')
+            return tpak.gb_header.get_rom_size()
+
+        tpak.dump_ram(filename, progress=self.progress,
+                      archive=self.archive)
+        return ram_size
+
+    def run(self):
+        try:
+            ser = self.open()
+        except Exception as e:
+            self.health.healthy = False
+            self.health.last_error = str(e)
+            self.log(f'failed to open port: {e}')
+            return
+
+        with ser:
+            while True:
+                job = self.queue.take(self.port)
+                if job is None:
+                    break
+
+                start = time.perf_counter()
+                try:
+                    n_bytes = self.run_job(job)
+                except AccessoryMismatch as e:
+                    # not the bridge's fault, another one may have it
+                    self.progress.discard()
+                    requeued = self.queue.decline(job, self.port, str(e))
+                    self.log(f'{job} skipped: {e}'
+                             f'{", requeued" if requeued else ""}')
+                    continue
+                except Exception as e:
+                    self.progress.discard()
+                    self.health.record(False, 0, time.perf_counter() - start,
+                                       str(e))
+                    requeued = self.queue.fail(job, str(e))
+                    self.log(f'{job} failed: {e}'
+                             f'{", requeued" if requeued else ""}')
+
+                    if self.health.consecutive_failures >= \
+                       self.max_consecutive_failures:
+                        self.health.healthy = False
+                        self.log('too many failures, taking bridge offline')
+                        break
+
+                    # reset the pad in case it is stuck mid transfer
+                    try:
+                        self.pad.pad_query(reset=True)
+                    except Exception:
+                        pass
+                    continue
+
+                self.progress.finish()
+                self.health.record(True, n_bytes,
+                                   time.perf_counter() - start)
+                self.queue.complete(job)
+                self.log(f'{job} done')
+
+            if isinstance(self.pad, PipelinedController):
+                self.pad.close()
+
+
+def run_jobs(ports, jobs, baudrate=1500000, window=1, resume=True,
+             max_attempts=3, max_consecutive_failures=2, sparse=False,
+             bulk=False, archive=None):
+    """Dump jobs across bridges, one worker thread per port
+
+    With an archive, job file names are dump names in the archive.
+    """
+    queue = JobQueue(jobs, max_attempts)
+    bar_lock = threading.Lock()
+    bar = tqdm(total=0, unit='B', unit_scale=True, unit_divisor=1024)
+
+    workers = [BridgeWorker(port, queue, bar, bar_lock, baudrate, window,
+                            max_consecutive_failures, resume, sparse, bulk,
+                            archive)
+               for port in ports]
+    start = time.perf_counter()
+    for worker in workers:
+        worker.start()
+
+    # jobs bound to a bridge that went offline can never run
+    while any(w.is_alive() for w in workers):
+        for worker in workers:
+            worker.join(0.1)
+        running = [w.port for w in workers if w.is_alive()]
+        queue.orphaned(running)
+    queue.orphaned([])
+
+    bar.close()
+    return queue.finished, [w.health for w in workers], \
+        time.perf_counter() - start
+
+
+def print_summary(finished, health, elapsed):
+    print('Devices:')
+    for h in health:
+        status = 'ok' if h.healthy else 'OFFLINE'
+        line = f'  {port_label(h.port):16} {status:8} ' \
+            f'jobs={h.jobs_done:<3} failures={h.failures:<3} ' \
+            f'{h.throughput() / 1024:8.1f} KiB/s'
+        if h.last_error is not None:
+            line += f'  last error: {h.last_error}'
+        print(line)
+
+    total_bytes = sum(h.n_bytes for h in health)
+    print(f'Total: {total_bytes} bytes in {elapsed:.1f} s '
+          f'({total_bytes / elapsed / 1024:.1f} KiB/s)')
+
+    failed = [j for j in finished if not j.done]
+    for job in failed:
+        print(f'FAILED {job}: {job.error}')
+    return failed
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Run dumps on several bridges in parallel')
+    parser.add_argument('-p', '--port', type=str, action='append',
+                        required=True,
+                        help='serial port or emu:// URL, may be repeated')
+    parser.add_argument('-b', '--baudrate', type=int, default=1500000)
+    parser.add_argument('-w', '--window', type=int, default=1,
+                        help='number of pak reads to keep in flight')
+    parser.add_argument('--bulk', action='store_true', default=False,
+                        help='use the bridge bulk read')
+    parser.add_argument('--restart', action='store_true', default=False,
+                        help='ignore progress saved by an interrupted dump')
+    parser.add_argument('--sparse', action='store_true', default=False,
+                        help='only read allocated Controller Pak pages')
+    parser.add_argument('--max-attempts', type=int, default=3,
+                        help='attempts per job before giving up')
+    parser.add_argument('--max-failures', type=int, default=2,
+                        help='consecutive failures before a bridge '
+                        'is taken offline')
+    parser.add_argument('--archive', type=str, default=None,
+                        help='archive directory to store dumps in')
+    parser.add_argument('jobs', type=str, nargs='+',
+                        help='[PORT=]KIND:FILE with KIND one of '
+                        f'{", ".join(JOB_KINDS)}; FILE may use {{port}} '
+                        'and {title}')
+    args = parser.parse_args()
+
+    jobs = parse_jobs(args.jobs, args.port)
+    archive = Archive(args.archive) if args.archive is not None else None
+    finished, health, elapsed = run_jobs(
+        args.port, jobs, args.baudrate, args.window, not args.restart,
+        args.max_attempts, args.max_failures, args.sparse, args.bulk,
+        archive)
+    if archive is not None:
+        archive.close()
+
+    if print_summary(finished, health, elapsed):
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
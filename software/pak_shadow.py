@@ -0,0 +1,173 @@
+import array
+import collections
+from crc_util import ADDRESS_CRC_TABLE, data_crc_lookup, extract_addr
+
+# Recognized JoyBus commands
+CMD_INFO_RESET = 0xff
+CMD_INFO = 0x00
+CMD_PAK_READ = 0x02
+CMD_PAK_WRITE = 0x03
+
+CPAK_SIZE = 0x8000
+BLOCK_SIZE = 32
+
+
+class Snapshot:
+    """Pak contents at one point in the stream
+
+    Blocks are immutable and shared with the shadow and other
+    snapshots, so taking one only copies the block references.
+    """
+
+    def __init__(self, name, timestamp_ns, blocks, versions):
+        self.name = name
+        self.timestamp_ns = timestamp_ns
+        self.blocks = blocks
+        self.versions = versions
+
+    def image(self, fill=0x00):
+        """Reconstructed image, unknown blocks filled with fill"""
+        unknown = bytes([fill]) * BLOCK_SIZE
+        return b''.join(unknown if block is None else block
+                        for block in self.blocks)
+
+    def n_known(self):
+        return sum(block is not None for block in self.blocks)
+
+
+def diff_snapshots(old, new):
+    """List (address, old block, new block) for blocks that changed
+
+    Blocks with the same version were not touched in between and are
+    skipped without comparing data. Unknown blocks are None.
+    """
+    changes = []
+    for i, (old_version, new_version) in enumerate(zip(old.versions,
+                                                       new.versions)):
+        if old_version == new_version:
+            continue
+
+        old_block = old.blocks[i]
+        new_block = new.blocks[i]
+        if old_block != new_block:
+            changes.append((i * BLOCK_SIZE, old_block, new_block))
+    return changes
+
+
+class PakShadow:
+    """Controller Pak contents reconstructed from sniffed traffic
+
+    Writes the pak acknowledged with a good data CRC and reads with a
+    good CRC update the 32 byte blocks they cover. Every change bumps
+    the block version and marks the block dirty until the next
+    snapshot. Only the last max_snapshots snapshots are kept.
+    """
+
+    def __init__(self, size=CPAK_SIZE, max_snapshots=8):
+        self.size = size
+        self.n_blocks = size // BLOCK_SIZE
+
+        self.blocks = [None] * self.n_blocks
+        self.versions = array.array('Q', bytes(8 * self.n_blocks))
+        self.dirty = set()
+        self.version = 0
+
+        self.snapshots = collections.deque(maxlen=max_snapshots)
+
+        # frame counters
+        self.n_writes = 0
+        self.n_reads = 0
+        self.n_ignored = 0
+        self.n_read_mismatches = 0
+        self.n_pak_changes = 0
+
+    def reset(self):
+        """Forget the contents, e.g. when the pak is swapped"""
+        for i in range(self.n_blocks):
+            if self.blocks[i] is not None:
+                self.set_block(i, None)
+
+    def set_block(self, i, block):
+        self.version += 1
+        self.blocks[i] = block
+        self.versions[i] = self.version
+        self.dirty.add(i)
+
+    def block_index(self, command):
+        """Block addressed by a pak command, None if not pak memory"""
+        if len(command) < 3:
+            return None
+
+        address, crc = extract_addr(command[1:3])
+        # the pak ignores commands with a bad address CRC
+        if crc != ADDRESS_CRC_TABLE[address >> 5] or address >= self.size:
+            return None
+        return address // BLOCK_SIZE
+
+    def apply(self, timestamp_ns, command, response):
+        """Update the shadow from one frame, return True if it changed"""
+        if not command:
+            return False
+        cmd = command[0]
+
+        if cmd in [CMD_INFO, CMD_INFO_RESET]:
+            # status bit 1: pak changed since the last reset
+            if len(response) == 3 and response[2] & 0x02:
+                self.n_pak_changes += 1
+                self.reset()
+                return True
+            return False
+
+        if cmd not in [CMD_PAK_READ, CMD_PAK_WRITE]:
+            return False
+
+        i = self.block_index(command)
+        if i is None:
+            self.n_ignored += 1
+            return False
+
+        if cmd == CMD_PAK_WRITE:
+            data = command[3:]
+            if len(data) != BLOCK_SIZE or len(response) != 1 or \
+               response[0] != data_crc_lookup(data):
+                self.n_ignored += 1
+                return False
+            self.n_writes += 1
+        else:
+            data = response[:BLOCK_SIZE]
+            if len(response) != BLOCK_SIZE + 1 or \
+               response[-1] != data_crc_lookup(data):
+                self.n_ignored += 1
+                return False
+            self.n_reads += 1
+
+            if self.blocks[i] is not None and self.blocks[i] != data:
+                # changed behind our back, or a missed write
+                self.n_read_mismatches += 1
+
+        data = bytes(data)
+        if self.blocks[i] == data:
+            return False
+
+        self.set_block(i, data)
+        return True
+
+    def snapshot(self, name=None, timestamp_ns=None):
+        """Record the current contents and clear the dirty set"""
+        snapshot = Snapshot(name, timestamp_ns, tuple(self.blocks),
+                            array.array('Q', self.versions))
+        self.snapshots.append(snapshot)
+        self.dirty = set()
+        return snapshot
+
+    def diff(self, old, new=None):
+        """Changes from snapshot old to snapshot new, or to now"""
+        if new is None:
+            new = Snapshot(None, None, self.blocks, self.versions)
+        return diff_snapshots(old, new)
+
+    def image(self, fill=0x00):
+        return Snapshot(None, None, self.blocks, self.versions).image(fill)
+
+    def n_known(self):
+        return sum(block is not None for block in self.blocks)
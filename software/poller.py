@@ -0,0 +1,155 @@
+import collections
+import struct
+import time
+
+# Button bits of the first two state bytes, most significant first
+BUTTON_NAMES = [
+    'A', 'B', 'Z', 'Start', 'Up', 'Down', 'Left', 'Right',
+    'Reset', None, 'L', 'R', 'C-Up', 'C-Down', 'C-Left', 'C-Right',
+]
+
+# buttons as a 16 bit mask, signed stick x and y
+PadState = collections.namedtuple('PadState', ['buttons', 'x', 'y'])
+
+
+def decode_state(response):
+    """Decode the 4 byte controller state response"""
+    if len(response) != 4:
+        raise Exception(f'invalid state length {len(response)}')
+    return PadState(*struct.unpack('>Hbb', response))
+
+
+def pressed(buttons):
+    """Names of the buttons set in a button mask"""
+    return [name for i, name in enumerate(BUTTON_NAMES)
+            if name is not None and buttons & (0x8000 >> i)]
+
+
+def format_state(state):
+    buttons = ' '.join(pressed(state.buttons)) or '-'
+    return f'x={state.x:4} y={state.y:4} {buttons}'
+
+
+class Histogram:
+    """Fixed-width bucket histogram of durations in seconds"""
+
+    def __init__(self, bucket_width=10e-6, n_buckets=1000):
+        self.bucket_width = bucket_width
+        self.buckets = [0] * n_buckets
+        # samples past the last bucket
+        self.overflow = 0
+
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def add(self, value):
+        self.count += 1
+        self.total += value
+        self.max = max(self.max, value)
+
+        i = int(max(value, 0) / self.bucket_width)
+        if i < len(self.buckets):
+            self.buckets[i] += 1
+        else:
+            self.overflow += 1
+
+    def mean(self):
+        return self.total / self.count if self.count else 0.0
+
+    def percentile(self, p):
+        """Upper edge of the bucket holding the p quantile"""
+        target = p * self.count
+        seen = 0
+        for i, n in enumerate(self.buckets):
+            seen += n
+            if seen >= target and seen > 0:
+                return (i + 1) * self.bucket_width
+        return self.max
+
+    def summary(self):
+        return f'mean={self.mean() * 1e6:.1f} us ' \
+            f'p50={self.percentile(0.5) * 1e6:.0f} us ' \
+            f'p99={self.percentile(0.99) * 1e6:.0f} us ' \
+            f'max={self.max * 1e6:.1f} us'
+
+
+class Poller:
+    """Poll controller state at a fixed rate
+
+    Polls are scheduled on absolute perf_counter deadlines, so sleep
+    jitter does not accumulate into rate drift. Subscribers are called
+    with (timestamp, old state, new state) only when the state changes.
+    Lateness against the schedule and poll round-trip times are kept
+    in histograms.
+    """
+
+    def __init__(self, pad, rate=1000, spin_time=0.002):
+        self.pad = pad
+        self.period = 1.0 / rate
+        # sleep until this long before a deadline, then busy-wait
+        self.spin_time = spin_time
+
+        self.subscribers = []
+        self.state = None
+
+        self.jitter = Histogram()
+        self.rtt = Histogram()
+        self.n_polls = 0
+        self.n_missed = 0
+        self.n_events = 0
+
+    def subscribe(self, callback):
+        self.subscribers.append(callback)
+
+    def wait_until(self, deadline):
+        remaining = deadline - time.perf_counter()
+        if remaining > self.spin_time:
+            time.sleep(remaining - self.spin_time)
+        while time.perf_counter() < deadline:
+            pass
+
+    def poll(self):
+        start = time.perf_counter()
+        state = decode_state(self.pad.poll_state())
+        end = time.perf_counter()
+        self.rtt.add(end - start)
+        self.n_polls += 1
+
+        if state != self.state:
+            old = self.state
+            self.state = state
+            self.n_events += 1
+            for callback in self.subscribers:
+                callback(start, old, state)
+
+        return start
+
+    def run(self, duration=None, count=None):
+        """Poll until duration seconds or count polls have passed"""
+        start = time.perf_counter()
+        deadline = start
+        n = 0
+
+        while (duration is None or deadline - start < duration) and \
+              (count is None or n < count):
+            self.wait_until(deadline)
+            poll_start = self.poll()
+            self.jitter.add(poll_start - deadline)
+            n += 1
+
+            deadline += self.period
+            now = time.perf_counter()
+            if now > deadline + self.period:
+                # too far behind, skip the missed slots
+                missed = int((now - deadline) / self.period)
+                self.n_missed += missed
+                deadline += missed * self.period
+
+    def print_stats(self, elapsed):
+        rate = self.n_polls / elapsed if elapsed > 0 else 0.0
+        print(f'{self.n_polls} polls in {elapsed:.2f} s '
+              f'({rate:.1f} Hz, '
+              f'{self.n_missed} slots missed, {self.n_events} changes)')
+        print(f'jitter: {self.jitter.summary()}')
+        print(f'rtt:    {self.rtt.summary()}')
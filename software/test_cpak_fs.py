@@ -0,0 +1,79 @@
+import struct
+from cpak_fs import (CPAK_SIZE, FIRST_DATA_PAGE, INODE_BACKUP_PAGE, INODE_END,
+                     INODE_FREE, INODE_PAGE, METADATA_SIZE, N_PAGES,
+                     NOTE_ENTRY, NOTE_PAGE, PAGE_SIZE, CpakFilesystem,
+                     inode_checksum)
+
+
+def format_inodes(chain=()):
+    """Inode table as libdragon formats it, with chain allocated as a note"""
+    inodes = [0] * FIRST_DATA_PAGE + \
+        [INODE_FREE] * (N_PAGES - FIRST_DATA_PAGE)
+    for page, next_page in zip(chain, list(chain[1:]) + [INODE_END]):
+        inodes[page] = next_page
+
+    table = bytearray(struct.pack(f'>{N_PAGES}H', *inodes))
+    table[1] = inode_checksum(table)
+    return table
+
+
+def make_image(table, backup=None, notes=()):
+    image = bytearray(CPAK_SIZE)
+    image[INODE_PAGE * PAGE_SIZE:(INODE_PAGE + 1) * PAGE_SIZE] = table
+    image[INODE_BACKUP_PAGE * PAGE_SIZE:(INODE_BACKUP_PAGE + 1) * PAGE_SIZE] = \
+        table if backup is None else backup
+    for i, entry in enumerate(notes):
+        offset = NOTE_PAGE * PAGE_SIZE + i * NOTE_ENTRY.size
+        image[offset:offset + NOTE_ENTRY.size] = entry
+    return image
+
+
+def test_inode_checksum_formatted():
+    # 123 free pages, each entry 0x0003
+    table = format_inodes()
+    assert table[1] == 0x71
+
+    fs = CpakFilesystem(make_image(table)[:METADATA_SIZE])
+    assert fs.valid()
+    assert fs.inode_page == INODE_PAGE
+    assert fs.notes == []
+    assert fs.free_pages() == list(range(FIRST_DATA_PAGE, N_PAGES))
+
+
+def test_inode_checksum_ignores_bank_byte():
+    table = format_inodes()
+    checksum = table[1]
+
+    # the high byte of an entry is the bank on multi-bank paks
+    table[FIRST_DATA_PAGE * 2 + 20] = 0x01
+    assert inode_checksum(table) == checksum
+
+    table[FIRST_DATA_PAGE * 2 + 21] ^= 0x01
+    assert inode_checksum(table) != checksum
+
+
+def test_note_chain():
+    table = format_inodes([5, 6, 9])
+    entry = NOTE_ENTRY.pack(b'NTEJ', b'01', 5, 0x02, 0, b'\x00' * 4,
+                            bytes([0x1d, 0x1e, 0x2c, 0x2d]).ljust(16, b'\x00'))
+
+    fs = CpakFilesystem(make_image(table, notes=[entry])[:METADATA_SIZE])
+    assert fs.valid()
+    assert [n.pages for n in fs.notes] == [[5, 6, 9]]
+    assert fs.notes[0].title() == 'DEST'
+    assert fs.broken_notes == []
+    assert fs.allocated_pages() == [5, 6, 9]
+
+
+def test_backup_inode_table():
+    table = format_inodes([7])
+    damaged = bytearray(table)
+    damaged[1] ^= 0xff
+
+    fs = CpakFilesystem(make_image(damaged, backup=table)[:METADATA_SIZE])
+    assert fs.inode_page == INODE_BACKUP_PAGE
+    assert fs.allocated_pages() == [7]
+
+    fs = CpakFilesystem(make_image(damaged, backup=damaged)[:METADATA_SIZE])
+    assert not fs.valid()
+    assert fs.allocated_pages() == list(range(FIRST_DATA_PAGE, N_PAGES))
@@ -0,0 +1,85 @@
+import random
+import pytest
+import crc_util
+from crc_util import (ADDRESS_CRC_TABLE, address_crc, check_data_crcs,
+                      data_crc, data_crc_batch, data_crc_lookup,
+                      extract_addr, pack_addr)
+
+
+def random_chunks(n_chunks, chunk_size=32, seed=0):
+    rng = random.Random(seed)
+    return bytes(rng.getrandbits(8) for i in range(n_chunks * chunk_size))
+
+
+@pytest.fixture(params=['numpy', 'pure'])
+def numpy_mode(request, monkeypatch):
+    """Run a test with NumPy, if installed, and with it patched out"""
+    if request.param == 'numpy':
+        pytest.importorskip('numpy')
+    else:
+        monkeypatch.setattr(crc_util, 'np', None)
+    return request.param
+
+
+def test_address_crc_table():
+    assert len(ADDRESS_CRC_TABLE) == 0x800
+    for page in range(0x800):
+        assert ADDRESS_CRC_TABLE[page] == address_crc(page)
+
+
+def test_pack_addr():
+    # addresses used for accessory IDs and the Rumble Pak motor
+    assert pack_addr(0x8000) == bytes.fromhex('8001')
+    assert pack_addr(0xc000) == bytes.fromhex('c01b')
+
+    for address in range(0, 0x10000, 32):
+        packed = pack_addr(address)
+        assert extract_addr(packed) == (address, address_crc(address >> 5))
+
+    with pytest.raises(ValueError):
+        pack_addr(0x8001)
+
+
+def test_data_crc_known():
+    assert data_crc(bytes(32)) == 0x00
+    # Rumble Pak motor on
+    assert data_crc(b'\x01' * 32) == 0xeb
+
+
+def test_data_crc_lookup():
+    assert data_crc_lookup(b'') == data_crc(b'')
+    for i in range(256):
+        assert data_crc_lookup(bytes([i])) == data_crc(bytes([i]))
+
+    buf = random_chunks(64)
+    for i in range(0, len(buf), 32):
+        chunk = buf[i:i + 32]
+        assert data_crc_lookup(chunk) == data_crc(chunk)
+    assert data_crc_lookup(buf[:45]) == data_crc(buf[:45])
+
+
+def test_data_crc_batch(numpy_mode):
+    buf = random_chunks(100)
+    expected = [data_crc(buf[i:i + 32]) for i in range(0, len(buf), 32)]
+    assert data_crc_batch(buf) == expected
+    assert data_crc_batch(bytearray(buf)) == expected
+
+    assert data_crc_batch(buf[:64], chunk_size=16) == \
+        [data_crc(buf[i:i + 16]) for i in range(0, 64, 16)]
+    assert data_crc_batch(b'') == []
+
+    with pytest.raises(ValueError):
+        data_crc_batch(buf[:33])
+
+
+def test_check_data_crcs(numpy_mode):
+    buf = random_chunks(16)
+    crcs = [data_crc(buf[i:i + 32]) for i in range(0, len(buf), 32)]
+    assert check_data_crcs(buf, crcs) == []
+
+    crcs[3] ^= 0x01
+    crcs[15] ^= 0x80
+    assert check_data_crcs(buf, crcs) == [3, 15]
+
+    with pytest.raises(ValueError):
+        check_data_crcs(buf, crcs[:-1])
@@ -0,0 +1,74 @@
+import pytest
+from controller import BadCRCException
+from dump_engine import ResumableDump, RetryQueue
+
+
+def make_reader(fail):
+    """read_many for a 1 KB image, failing the addresses in fail once"""
+    image = bytes(range(256)) * 4
+    reads = []
+
+    def read_many(addresses):
+        results = []
+        for address in addresses:
+            reads.append(address)
+            if address in fail:
+                fail.discard(address)
+                results.append(BadCRCException(f'bad chunk {address:04x}'))
+            else:
+                results.append(image[address:address + 32])
+        return results
+
+    return image, reads, read_many
+
+
+def test_retry_queue_bound():
+    queue = RetryQueue(max_size=2, max_attempts=2, base_delay=0)
+    assert queue.push(0x00)
+    assert queue.push(0x20)
+    assert queue.full()
+    assert not queue.push(0x40)
+    assert len(queue) == 2
+
+    assert queue.pop_ready() == [0x00, 0x20]
+    assert queue.push(0x00)
+    # third failure of 0x00
+    queue.pop_ready()
+    assert not queue.push(0x00)
+
+
+def test_resumable_dump_retries(tmp_path):
+    filename = str(tmp_path / 'image.bin')
+    image, reads, read_many = make_reader({0x40, 0x100})
+
+    dump = ResumableDump(filename, len(image), batch_size=8,
+                         retry_queue=RetryQueue(base_delay=0))
+    dump.run(read_many)
+    dump.close()
+
+    assert (tmp_path / 'image.bin').read_bytes() == image
+    assert not (tmp_path / 'image.bin.progress').exists()
+    assert reads.count(0x40) == 2 and reads.count(0x100) == 2
+
+
+def test_resumable_dump_overflow(tmp_path):
+    filename = str(tmp_path / 'image.bin')
+    image, reads, read_many = make_reader({0x00, 0x20, 0x40})
+
+    # more chunks fail in one batch than may wait for a retry
+    dump = ResumableDump(filename, len(image), batch_size=8,
+                         retry_queue=RetryQueue(max_size=2, base_delay=0))
+    with pytest.raises(BadCRCException):
+        dump.run(read_many)
+    dump.close()
+
+    # progress was saved, resuming reads only what is missing
+    reads.clear()
+    dump = ResumableDump(filename, len(image), batch_size=8)
+    assert 0 < dump.n_done() < dump.n_chunks
+    dump.run(read_many)
+    dump.close()
+
+    assert (tmp_path / 'image.bin').read_bytes() == image
+    # chunks read in the batch that gave up are kept
+    assert 0x00 in reads and 0x60 not in reads
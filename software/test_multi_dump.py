@@ -0,0 +1,64 @@
+import hashlib
+import threading
+import pytest
+from emulator import make_test_rom
+from multi_dump import BridgeWorker, Job, JobQueue, parse_jobs, run_jobs
+from tqdm import tqdm
+
+
+def run(tmp_path, ports, specs):
+    jobs = parse_jobs([s.format(tmp=tmp_path) for s in specs], ports)
+    finished, health, elapsed = run_jobs(ports, jobs)
+    return {str(job): job for job in finished}, \
+        {h.port: h for h in health}
+
+
+def test_mixed_accessories(tmp_path):
+    # cpak image with only 0xff, which has no valid inode table
+    garbage = tmp_path / 'garbage.bin'
+    garbage.write_bytes(b'\xff' * 0x8000)
+
+    cpak = 'emu://cpak'
+    ports = ['emu://rpak', 'emu://tpak?rom_banks=4', cpak,
+             f'emu://cpak?image={garbage}', 'emu://none']
+    jobs, health = run(tmp_path, ports, [
+        'cpak:{tmp}/c1.bin', 'cpak:{tmp}/c2.bin', 'cpak:{tmp}/c3.bin',
+        'rom:{tmp}/rom.gb'])
+
+    assert all(job.done for job in jobs.values())
+    assert health[cpak].jobs_done == 3
+    assert health['emu://tpak?rom_banks=4'].jobs_done == 1
+    for port in ports[0], ports[3], ports[4]:
+        assert health[port].jobs_done == 0
+        assert health[port].failures == 0
+
+    for name in ['c1.bin', 'c2.bin', 'c3.bin']:
+        assert (tmp_path / name).read_bytes() == bytes(0x8000)
+    assert hashlib.sha1((tmp_path / 'rom.gb').read_bytes()).digest() == \
+        hashlib.sha1(make_test_rom(n_rom_banks=4)).digest()
+
+
+def test_no_bridge_has_accessory(tmp_path):
+    ports = ['emu://rpak', 'emu://tpak']
+    jobs, health = run(tmp_path, ports, ['cpak:{tmp}/c.bin'])
+
+    job = jobs[f'cpak:{tmp_path}/c.bin']
+    assert not job.done
+    assert job.error == 'no Controller Pak present'
+    assert not (tmp_path / 'c.bin').exists()
+
+
+def test_retry_keeps_title_template(tmp_path):
+    # a cart whose global checksum does not match its contents
+    rom = bytearray(make_test_rom(title=b'BADCART'))
+    rom[0x3000] ^= 0xff
+    (tmp_path / 'bad.gb').write_bytes(rom)
+
+    job = Job('rom', f'{tmp_path}/{{title}}.gb')
+    bar = tqdm(total=0, disable=True)
+    worker = BridgeWorker(f'emu://tpak?rom={tmp_path}/bad.gb',
+                          JobQueue([job]), bar, threading.Lock())
+    with worker.open():
+        with pytest.raises(Exception, match='checksum'):
+            worker.run_job(job)
+    assert job.filename == f'{tmp_path}/{{title}}.gb'
@@ -0,0 +1,116 @@
+import asyncio
+import collections
+import time
+from concurrent.futures import ThreadPoolExecutor
+from metrics import cmd_name
+from uart_util import FrameDecoder, pack_cmd, sendall
+
+# Commands in flight by default. The bridge buffers queued commands in a
+# 256 byte UART FIFO, so keep window * 36 bytes below that.
+DEFAULT_WINDOW = 4
+MAX_WINDOW = 7
+
+
+class AsyncTransport:
+    """Pipelined UART host transport
+
+    Keeps up to `window` commands queued to the bridge and matches the
+    echoed frames to their commands in FIFO order.
+    """
+
+    def __init__(self, ser, window=DEFAULT_WINDOW, verbose=False,
+                 metrics=None):
+        if window < 1 or window > MAX_WINDOW:
+            raise ValueError(f'window must be between 1 and {MAX_WINDOW}')
+
+        self.ser = ser
+        self.window = window
+        self.verbose = verbose
+        # with commands overlapped, only whole transactions are timed
+        self.metrics = metrics
+        self.decoder = FrameDecoder(verbose)
+
+        # (command, future) for each command sent but not yet answered
+        self.pending = collections.deque()
+
+        # blocking serial reads happen on a dedicated thread
+        self.executor = ThreadPoolExecutor(max_workers=1)
+
+        self.loop = None
+        self.slots = None
+        self.reader = None
+
+    def bind_loop(self, loop):
+        if self.loop is not loop:
+            if self.pending:
+                raise Exception('commands still in flight on another loop')
+            self.loop = loop
+            self.slots = asyncio.Semaphore(self.window)
+            self.reader = None
+
+    async def send_cmd(self, command):
+        """Queue length-prefixed TX buffer and wait for its response"""
+        tx_buf = pack_cmd(command)
+
+        loop = asyncio.get_running_loop()
+        self.bind_loop(loop)
+
+        await self.slots.acquire()
+        start = time.perf_counter()
+
+        future = loop.create_future()
+        entry = (command, future)
+        self.pending.append(entry)
+        try:
+            sendall(self.ser, tx_buf)
+        except Exception:
+            self.pending.remove(entry)
+            self.slots.release()
+            raise
+
+        if self.reader is None or self.reader.done():
+            self.reader = loop.create_task(self.read_responses())
+
+        if self.metrics is None:
+            return await future
+
+        try:
+            return await future
+        finally:
+            self.metrics.observe('transaction', cmd_name(command),
+                                 time.perf_counter() - start)
+
+    async def read_responses(self):
+        """Receive frames until no commands are in flight"""
+        while self.pending:
+            resyncs = self.decoder.resyncs
+            try:
+                echo_bytez, response_bytez = await self.loop.run_in_executor(
+                    self.executor, self.decoder.recv, self.ser)
+            except Exception as e:
+                while self.pending:
+                    command, future = self.pending.popleft()
+                    self.slots.release()
+                    if not future.done():
+                        future.set_exception(e)
+                return
+
+            command, future = self.pending.popleft()
+            self.slots.release()
+
+            if self.metrics is not None:
+                self.metrics.count('resync', n=self.decoder.resyncs - resyncs)
+
+            if future.done():
+                # cancelled by the caller
+                continue
+
+            if echo_bytez != command:
+                future.set_exception(Exception(
+                    f'response out of order (sent {command.hex()}, '
+                    f'echo {echo_bytez.hex()})'))
+            else:
+                future.set_result(response_bytez)
+
+    def close(self):
+        self.executor.shutdown(wait=False)
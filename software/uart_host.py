@@ -1,18 +1,32 @@
 #!/usr/bin/env python3
 import argparse
-import serial
 import time
 from accessories.rumblepak import RumblePak
 from accessories.transferpak import TransferPak
+from archive import Archive
+from async_controller import PipelinedController
+from cart_db import FLAG_HELD, CartDatabase, print_entry
 from controller import Controller
 from hexdump import hexdump
+from metrics import Metrics
+from poller import Poller, format_state
+from uart_util import open_port
 
 
-def poll_loop(pad):
-    while True:
-        response = pad.poll_state()
-        print(f'state: {response.hex(" ")}')
-        time.sleep(0.001)
+def poll_loop(pad, rate=1000, duration=None):
+    poller = Poller(pad, rate)
+
+    def print_change(timestamp, old, new):
+        print(f'state: {format_state(new)}')
+
+    poller.subscribe(print_change)
+
+    start = time.perf_counter()
+    try:
+        poller.run(duration)
+    except KeyboardInterrupt:
+        pass
+    poller.print_stats(time.perf_counter() - start)
 
 
 def rumble_test(pad):
@@ -26,7 +40,35 @@ def rumble_test(pad):
         rpak.set_rumble(False)
 
 
-def tpak_test(pad, rom_filename=None, ram_filename=None, verbose=False):
+def identify_cart(tpak, db_filename):
+    """Look the cart up by its header and bank 0
+
+    Returns the entry and the checked contents of its held copy, either
+    of which may be None.
+    """
+    with CartDatabase(db_filename) as db:
+        if not db.lookup_header(tpak.gb_header):
+            print('Cart not in database')
+            return None, None
+
+        tpak.cart_enable(True)
+        bank0 = tpak.read_rom_bank(0)
+        tpak.cart_enable(False)
+
+        entry = db.identify(tpak.gb_header, bank0)
+
+    if entry is None:
+        print('Cart header is in database, bank 0 does not match')
+        return None, None
+
+    held_rom = entry.held_copy()
+    print_entry(entry, held_rom)
+    return entry, held_rom
+
+
+def tpak_test(pad, rom_filename=None, ram_filename=None, verbose=False,
+              verify=True, restore_filename=None, reference_filename=None,
+              db_filename=None, force_dump=False, archive=None):
     tpak = TransferPak(pad, verbose)
 
     # Check for Transfer Pak
@@ -65,24 +107,116 @@ def tpak_test(pad, rom_filename=None, ram_filename=None, verbose=False):
     if verbose:
         print(gb_header.__dict__)
 
+    entry = None
+    held_rom = None
+    if db_filename is not None:
+        entry, held_rom = identify_cart(tpak, db_filename)
+
+    if force_dump:
+        held_rom = None
+    elif rom_filename is not None and entry is not None and \
+            held_rom is None and entry.flags & FLAG_HELD:
+        print(f'Held dump {entry.path} is missing or no longer matches '
+              'the database, reading the cart')
+
     if rom_filename is not None:
-        tpak.dump_rom(rom_filename)
+        if held_rom is not None:
+            print(f'Copying held dump {entry.path} to {rom_filename}, '
+                  'use --force-dump to read the cart')
+            if archive is not None:
+                archive.put(rom_filename, 'rom', held_rom,
+                            dict(entry.digests(), title=tpak.title()))
+            else:
+                with open(rom_filename, 'wb') as f:
+                    f.write(held_rom)
+        else:
+            tpak.dump_rom(rom_filename, verify=verify,
+                          expected=entry.digests() if entry else None,
+                          archive=archive)
 
     if ram_filename is not None:
-        tpak.dump_ram(ram_filename)
+        tpak.dump_ram(ram_filename, archive=archive)
+
+    if restore_filename is not None:
+        tpak.restore_ram(restore_filename, reference_filename)
+
+
+def run_mode(pad, args, archive=None):
+    # Send info/reset
+    pad_type, joyport_status = pad.pad_query(reset=True)
+
+    print(f'Pad type: {pad_type:04x}, joyport status: {joyport_status:02x}')
+
+    if args.dump_cpak is not None:
+        pad.dump_cpak(args.dump_cpak, resume=not args.restart,
+                      sparse=args.sparse, notes_dir=args.notes_dir,
+                      archive=archive)
+    elif args.restore_cpak is not None:
+        pad.restore_cpak(args.restore_cpak, args.cpak_reference)
+    elif args.test_rpak:
+        rumble_test(pad)
+    elif args.test_tpak:
+        tpak_test(pad, verbose=args.verbose, db_filename=args.cart_db)
+    elif args.dump_tpak_rom:
+        tpak_test(pad, rom_filename=args.dump_tpak_rom,
+                  verbose=args.verbose, verify=not args.no_verify,
+                  db_filename=args.cart_db, force_dump=args.force_dump,
+                  archive=archive)
+    elif args.dump_tpak_ram:
+        tpak_test(pad, ram_filename=args.dump_tpak_ram,
+                  verbose=args.verbose, archive=archive)
+    elif args.restore_tpak_ram:
+        tpak_test(pad, restore_filename=args.restore_tpak_ram,
+                  reference_filename=args.ram_reference,
+                  verbose=args.verbose)
+    else:
+        poll_loop(pad, args.poll_rate, args.poll_time)
 
 
 def main():
     parser = argparse.ArgumentParser()
-    parser.add_argument('port', type=str)
+    parser.add_argument('port', type=str,
+                        help='serial port, or emu:// URL for the emulator')
     parser.add_argument('-b', '--baudrate', type=int,
                         default=1500000)
     parser.add_argument('-v', '--verbose', action='store_true',
                         default=False)
+    parser.add_argument('-w', '--window', type=int, default=1,
+                        help='number of pak reads to keep in flight')
+    parser.add_argument('--bulk', action='store_true', default=False,
+                        help='use the bridge bulk read for pak dumps')
+    parser.add_argument('--metrics', type=str, default=None,
+                        help='write command timings to a file, '
+                        'Prometheus text if it ends in .prom, else JSON')
+    parser.add_argument('--poll-rate', type=float, default=1000,
+                        help='controller polls per second')
+    parser.add_argument('--poll-time', type=float, default=None,
+                        help='stop polling after this many seconds')
+    parser.add_argument('--restart', action='store_true', default=False,
+                        help='ignore progress saved by an interrupted dump')
+    parser.add_argument('--sparse', action='store_true', default=False,
+                        help='only read allocated cpak pages')
+    parser.add_argument('--notes-dir', type=str, default=None,
+                        help='also export each cpak note to this directory')
+    parser.add_argument('--cpak-reference', type=str, default=None,
+                        help='image of current cpak contents for restore')
+    parser.add_argument('--ram-reference', type=str, default=None,
+                        help='image of current cart RAM contents for restore')
+    parser.add_argument('--no-verify', action='store_true', default=False,
+                        help='skip ROM dump checksum verification')
+    parser.add_argument('--cart-db', type=str, default=None,
+                        help='cart database to identify Game Boy carts with')
+    parser.add_argument('--force-dump', action='store_true', default=False,
+                        help='dump the ROM even if the database holds a copy')
+    parser.add_argument('--archive', type=str, default=None,
+                        help='archive directory to store dumps in; dump '
+                        'file names become dump names in the archive')
     # mutually exclusive options below
     mode_group = parser.add_mutually_exclusive_group()
     mode_group.add_argument('--dump-cpak', type=str, default=None,
                             help='file to dump cpak memory to')
+    mode_group.add_argument('--restore-cpak', type=str, default=None,
+                            help='file to write to cpak memory')
     mode_group.add_argument('--test-rpak', action='store_true',
                             default=False, help='Test Rumble Pak')
     mode_group.add_argument('--test-tpak', action='store_true',
@@ -91,34 +225,36 @@ def main():
                             default=None, help='file to dump ROM to')
     mode_group.add_argument('--dump-tpak-ram', type=str,
                             default=None, help='file to dump RAM to')
+    mode_group.add_argument('--restore-tpak-ram', type=str,
+                            default=None, help='file to write to cart RAM')
     args = parser.parse_args()
 
-    with serial.Serial(args.port, args.baudrate) as ser:
+    with open_port(args.port, args.baudrate) as ser:
         print(f'Using port: {ser.name}')
         ser.reset_input_buffer()
         ser.reset_output_buffer()
 
-        pad = Controller(ser, args.verbose)
-
-        # Send info/reset
-        pad_type, joyport_status = pad.pad_query(reset=True)
-
-        print(f'Pad type: {pad_type:04x}, joyport status: {joyport_status:02x}')
-
-        if args.dump_cpak is not None:
-            pad.dump_cpak(args.dump_cpak)
-        elif args.test_rpak:
-            rumble_test(pad)
-        elif args.test_tpak:
-            tpak_test(pad, verbose=args.verbose)
-        elif args.dump_tpak_rom:
-            tpak_test(pad, rom_filename=args.dump_tpak_rom,
-                      verbose=args.verbose)
-        elif args.dump_tpak_ram:
-            tpak_test(pad, ram_filename=args.dump_tpak_ram,
-                      verbose=args.verbose)
+        metrics = Metrics() if args.metrics is not None else None
+
+        if args.bulk:
+            # the bridge pipelines bulk reads itself
+            pad = Controller(ser, args.verbose, metrics, bulk=True)
+        elif args.window > 1:
+            pad = PipelinedController(ser, args.window, args.verbose,
+                                      metrics)
         else:
-            poll_loop(pad)
+            pad = Controller(ser, args.verbose, metrics)
+
+        archive = Archive(args.archive) if args.archive is not None \
+            else None
+
+        try:
+            run_mode(pad, args, archive)
+        finally:
+            if metrics is not None:
+                metrics.write(args.metrics)
+            if archive is not None:
+                archive.close()
 
 
 if __name__ == '__main__':
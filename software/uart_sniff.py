@@ -1,8 +1,10 @@
 #!/usr/bin/env python3
 import argparse
 import serial
-from uart_util import sync_recv
+from capture import CaptureReader, CaptureWriter, FrameRenderer, capture
+from capture_index import CaptureIndex, build_index
 from crc_util import extract_addr
+from pak_shadow import PakShadow
 
 # Recognized JoyBus commands
 CMD_INFO_RESET = 0xff
@@ -11,42 +13,209 @@ CMD_STATE = 0x01
 CMD_PAK_READ = 0x02
 CMD_PAK_WRITE = 0x03
 
+CMD_NAMES = {
+    'info_reset': CMD_INFO_RESET,
+    'info': CMD_INFO,
+    'state': CMD_STATE,
+    'read': CMD_PAK_READ,
+    'write': CMD_PAK_WRITE,
+}
+
+
+def print_frame(bytez, response_bytez, verbose=False):
+    cmd = bytez[0]
+    if verbose and cmd != CMD_STATE:
+        print(f'cmd {cmd:02x}')
+        print(bytez.hex())
+
+    if cmd in [CMD_INFO, CMD_INFO_RESET, CMD_STATE]:
+        # state cmd is spammy
+        pass
+    elif cmd == CMD_PAK_READ:
+        address, crc = extract_addr(bytez[1:3])
+        print(f'read cmd: {address:04x} (addr CRC-5 {crc:02x})')
+        print(f'  response: {response_bytez.hex()}')
+    elif cmd == CMD_PAK_WRITE:
+        address, crc = extract_addr(bytez[1:3])
+        data = bytez[3:]
+        print(f'write cmd: {address:04x} (addr CRC-5 {crc:02x})')
+        print(f'  {data.hex()}')
+        print(f'  response: {response_bytez.hex()}')
+    else:
+        print(f'unknown cmd {cmd:02x}')
+
+
+def parse_cmd(value):
+    if value in CMD_NAMES:
+        return CMD_NAMES[value]
+    return int(value, 16)
+
+
+def parse_addr_range(value):
+    """Parse a hex address or start-end range, both inclusive"""
+    start, sep, end = value.partition('-')
+    start = int(start, 16)
+    end = int(end, 16) if sep else start
+    return start, end
+
+
+class ShadowTracker:
+    """Feed frames to a PakShadow, snapshotting after each burst of pak I/O
+
+    Games read and write the pak in bursts (loading, saving), so a
+    snapshot is taken when pak traffic resumes after a quiet gap, and
+    the blocks changed since the previous snapshot are reported.
+    """
+
+    def __init__(self, shadow, gap=0.5):
+        self.shadow = shadow
+        self.gap_ns = int(gap * 1e9)
+        self.last_pak_ns = None
+        self.previous = shadow.snapshot('start')
+
+    def report(self, timestamp_ns):
+        snapshot = self.shadow.snapshot(timestamp_ns=timestamp_ns)
+        changes = self.shadow.diff(self.previous, snapshot)
+        self.previous = snapshot
+
+        if changes:
+            addresses = ' '.join(f'{address:04x}' for address, old, new
+                                 in changes[:8])
+            more = ' ...' if len(changes) > 8 else ''
+            print(f'shadow: {len(changes)} blocks changed ({addresses}{more}), '
+                  f'{self.shadow.n_known()} blocks known')
+
+    def __call__(self, timestamp_ns, bytez, response_bytez):
+        if bytez and bytez[0] in [CMD_PAK_READ, CMD_PAK_WRITE]:
+            if self.last_pak_ns is not None and self.shadow.dirty and \
+               timestamp_ns - self.last_pak_ns > self.gap_ns:
+                self.report(self.last_pak_ns)
+            self.last_pak_ns = timestamp_ns
+
+        self.shadow.apply(timestamp_ns, bytez, response_bytez)
+
+    def finish(self, filename):
+        if self.shadow.dirty:
+            self.report(self.last_pak_ns)
+
+        with open(filename, 'wb') as f:
+            f.write(self.shadow.image())
+        print(f'shadow: {self.shadow.n_known()} of {self.shadow.n_blocks} '
+              f'blocks known, image written to {filename}')
+        if self.shadow.n_read_mismatches > 0:
+            print(f'shadow: {self.shadow.n_read_mismatches} reads did not '
+                  'match earlier traffic')
+
 
 def main():
     parser = argparse.ArgumentParser()
-    parser.add_argument('port', type=str)
+    parser.add_argument('port', type=str, nargs='?', default=None)
     parser.add_argument('-b', '--baudrate', type=int, default=1500000)
     parser.add_argument('-v', '--verbose', action='store_true', default=False)
+    parser.add_argument('-w', '--capture', type=str, default=None,
+                        help='write frames to a binary capture file')
+    parser.add_argument('-q', '--quiet', action='store_true', default=False,
+                        help='do not print frames')
+    parser.add_argument('-r', '--replay', type=str, default=None,
+                        help='print frames from a capture file')
+    parser.add_argument('--no-index', action='store_true', default=False,
+                        help='do not index the capture file when done')
+    parser.add_argument('--shadow', type=str, default=None,
+                        help='reconstruct pak contents from the traffic '
+                        'and write the image to a file')
+    parser.add_argument('--shadow-gap', type=float, default=0.5,
+                        help='seconds without pak traffic that end a burst')
+    query_group = parser.add_argument_group(
+        'capture queries', 'filter replayed frames using the capture index')
+    query_group.add_argument('--cmd', type=parse_cmd, action='append',
+                             default=None, help='command name or byte, '
+                             'may be repeated')
+    query_group.add_argument('--addr', type=parse_addr_range, default=None,
+                             help='pak address or range, e.g. 8000-8fff')
+    query_group.add_argument('--start', type=float, default=None,
+                             help='seconds from start of capture')
+    query_group.add_argument('--end', type=float, default=None,
+                             help='seconds from start of capture')
     args = parser.parse_args()
 
+    def render(timestamp_ns, bytez, response_bytez):
+        print_frame(bytez, response_bytez, args.verbose)
+
+    tracker = None
+    if args.shadow is not None:
+        tracker = ShadowTracker(PakShadow(), args.shadow_gap)
+
+    querying = args.cmd is not None or args.addr is not None or \
+        args.start is not None or args.end is not None
+    if querying and args.replay is None:
+        parser.error('capture queries need a capture to replay (-r)')
+
+    if args.replay is not None:
+        if not querying:
+            with CaptureReader(args.replay) as reader:
+                for frame in reader:
+                    if tracker is not None:
+                        tracker(*frame)
+                    if not args.quiet:
+                        render(*frame)
+            if tracker is not None:
+                tracker.finish(args.shadow)
+            return
+
+        with CaptureIndex(args.replay) as index:
+            start_ns = end_ns = None
+            if args.start is not None:
+                start_ns = index.capture.start_ns + int(args.start * 1e9)
+            if args.end is not None:
+                end_ns = index.capture.start_ns + int(args.end * 1e9)
+            start_addr, end_addr = args.addr or (None, None)
+
+            # the shadow only sees the selected frames
+            for frame in index.query(args.cmd, start_addr, end_addr,
+                                     start_ns, end_ns):
+                if tracker is not None:
+                    tracker(*frame)
+                if not args.quiet:
+                    seconds = (frame[0] - index.capture.start_ns) / 1e9
+                    print(f'[{seconds:.6f}]', end=' ')
+                    render(*frame)
+        if tracker is not None:
+            tracker.finish(args.shadow)
+        return
+
+    if args.port is None:
+        parser.error('port is required unless replaying a capture')
+
     with serial.Serial(args.port, args.baudrate) as ser:
         print(ser.name)
         ser.reset_input_buffer()
         ser.reset_output_buffer()
 
-        while True:
-            bytez, response_bytez = sync_recv(ser, args.verbose)
-
-            cmd = bytez[0]
-            if args.verbose and cmd != CMD_STATE:
-                print(f'cmd {cmd:02x}')
-                print(bytez.hex())
-
-            if cmd in [CMD_INFO, CMD_INFO_RESET, CMD_STATE]:
-                # state cmd is spammy
-                pass
-            elif cmd == CMD_PAK_READ:
-                address, crc = extract_addr(bytez[1:3])
-                print(f'read cmd: {address:04x} (addr CRC-5 {crc:02x})')
-                print(f'  response: {response_bytez.hex()}')
-            elif cmd == CMD_PAK_WRITE:
-                address, crc = extract_addr(bytez[1:3])
-                data = bytez[3:]
-                print(f'write cmd: {address:04x} (addr CRC-5 {crc:02x})')
-                print(f'  {data.hex()}')
-                print(f'  response: {response_bytez.hex()}')
-            else:
-                print(f'unknown cmd {cmd:02x}')
+        writer = None
+        if args.capture is not None:
+            writer = CaptureWriter(args.capture)
+
+        renderer = None
+        if not args.quiet:
+            renderer = FrameRenderer(render)
+            renderer.start()
+
+        try:
+            n_frames = capture(ser, writer, renderer, args.verbose,
+                               [tracker] if tracker is not None else [])
+        finally:
+            if renderer is not None:
+                renderer.stop()
+            if writer is not None:
+                writer.close()
+
+        print(f'{n_frames} frames captured')
+        if writer is not None and not args.no_index:
+            build_index(args.capture)
+        if renderer is not None and renderer.skipped > 0:
+            print(f'{renderer.skipped} frames not shown, display fell behind')
+        if tracker is not None:
+            tracker.finish(args.shadow)
 
 
 if __name__ == '__main__':
@@ -1,60 +1,334 @@
+import serial
+import struct
+import time
+from metrics import cmd_name
+
+# Maximum command length accepted by the UART host bridge
+MAX_TX_BYTES = 35
+
+# Recognized JoyBus commands
+CMD_INFO_RESET = 0xff
+CMD_INFO = 0x00
+CMD_STATE = 0x01
+CMD_PAK_READ = 0x02
+CMD_PAK_WRITE = 0x03
+
+# Bulk pak read: sent in place of a length byte, followed by the start
+# address and chunk count. The bridge replies with AA 5A, the address and
+# count, then a status byte, 32 data bytes and the pak's data CRC per chunk.
+BULK_READ_OPCODE = 0x80
+BULK_REQUEST = struct.Struct('>BHH')
+BULK_MAGIC = b'\xaa\x5a'
+BULK_HEADER = struct.Struct('>2sHH')
+BULK_RECORD_LEN = 34
+MAX_BULK_COUNT = 0xffff
+
+# Bulk record status bits
+BULK_STATUS_CRC = 0x01      # data CRC check failed on the bridge
+BULK_STATUS_LENGTH = 0x02   # response was not 33 bytes
+BULK_STATUS_RX = 0x04       # JoyBus receive error
+
+
+def open_port(port, baudrate):
+    """Open a serial port, or an emulated bridge for emu:// URLs"""
+    if port.startswith('emu://'):
+        # the emulator imports this module for the protocol constants
+        from emulator import EmulatedSerial
+        return EmulatedSerial.from_url(port)
+
+    return serial.Serial(port, baudrate)
+
+
 def sendall(ser, data):
     n = 0
     while n < len(data):
         n += ser.write(data[n:])
 
 
-def sync_recv(ser, verbose=False):
-    """Sync on AA 55, then get command and response length bytes"""
+class FrameDecoder:
+    """Incremental decoder for the AA 55 framed UART output
+
+    Bytes are read from the serial port in bulk into a reusable buffer
+    and complete (command, response) frames are parsed out of it. Any
+    bytes read past the end of a frame are kept for the next one.
+    """
+
+    # frame header is AA 55 <command length> <response length>
+    HEADER_LEN = 4
+
+    # lengths are sent as 6 bit values by the bridge
+    MAX_FIELD_LEN = 0x3f
+
+    def __init__(self, verbose=False, greedy=True, size=4096):
+        self.verbose = verbose
+        # read everything waiting on the port, not just the current frame
+        self.greedy = greedy
+
+        # received bytes are buf[pos:end]
+        self.buf = bytearray(size)
+        self.pos = 0
+        self.end = 0
+
+        # bytes needed before another frame can be parsed
+        self.need = self.HEADER_LEN
+
+        # number of times the decoder had to search for the sync magic
+        self.resyncs = 0
+
+    def pending(self):
+        return self.end - self.pos
+
+    def reserve(self, n):
+        """Make room for n more bytes at the end of the buffer"""
+        if self.end + n <= len(self.buf):
+            return
+
+        # move unparsed bytes to the front
+        pending = self.pending()
+        self.buf[:pending] = self.buf[self.pos:self.end]
+        self.pos = 0
+        self.end = pending
+
+        if pending + n > len(self.buf):
+            self.buf.extend(bytes(pending + n - len(self.buf)))
+
+    def feed(self, data):
+        """Append received bytes"""
+        self.reserve(len(data))
+        self.buf[self.end:self.end + len(data)] = data
+        self.end += len(data)
+
+    def fill(self, ser):
+        """Read at least enough bytes to make progress on the next frame"""
+        want = self.need - self.pending()
+        if self.greedy:
+            want = max(want, getattr(ser, 'in_waiting', 0))
+        want = max(want, 1)
+
+        if not hasattr(ser, 'readinto'):
+            data = ser.read(want)
+            self.feed(data)
+            return len(data)
+
+        # read straight into the buffer
+        self.reserve(want)
+        with memoryview(self.buf) as view:
+            n = ser.readinto(view[self.end:self.end + want])
+        self.end += n
+        return n
+
+    def resync(self):
+        """Skip to the next AA 55 after the current position"""
+        self.resyncs += 1
+        if self.verbose:
+            print('out of sync')
+            print(bytes(self.buf[self.pos:min(self.pos + self.HEADER_LEN,
+                                              self.end)]))
+
+        index = self.buf.find(b'\xaa\x55', self.pos + 1, self.end)
+        if index < 0:
+            # keep a trailing AA that may start the next magic
+            self.pos = max(self.pos + 1, self.end - 1)
+        else:
+            self.pos = index
+
+    def next_span(self):
+        """Find the next complete frame in the buffer and consume it
+
+        Returns (command start, response start, end) offsets into the
+        buffer, or None if no complete frame is buffered.
+        """
+        buf = self.buf
+
+        while True:
+            pos = self.pos
+            if self.end - pos < self.HEADER_LEN:
+                self.need = self.HEADER_LEN
+                return None
+
+            if buf[pos] != 0xaa or buf[pos + 1] != 0x55:
+                self.resync()
+                continue
+
+            cmd_len = buf[pos + 2]
+            resp_len = buf[pos + 3]
+            if cmd_len == 0 or cmd_len > self.MAX_FIELD_LEN or \
+               resp_len > self.MAX_FIELD_LEN:
+                # false sync on AA 55 inside frame data
+                self.resync()
+                continue
+
+            cmd_start = pos + self.HEADER_LEN
+            resp_start = cmd_start + cmd_len
+            end = resp_start + resp_len
+
+            if self.end < end:
+                self.need = end - pos
+                return None
+
+            self.pos = end
+            self.need = self.HEADER_LEN
+            return cmd_start, resp_start, end
+
+    def next_frame(self):
+        """Parse one frame from the buffer, or None if incomplete"""
+        span = self.next_span()
+        if span is None:
+            return None
+
+        cmd_start, resp_start, end = span
+        return (bytes(self.buf[cmd_start:resp_start]),
+                bytes(self.buf[resp_start:end]))
+
+    def next_frame_into(self, out):
+        """Parse one frame, copying the start of its response into out
+
+        Returns (command, rest of the response), or None if incomplete.
+        """
+        span = self.next_span()
+        if span is None:
+            return None
+
+        cmd_start, resp_start, end = span
+        n = len(out)
+        if end - resp_start < n:
+            raise Exception(f'response too short ({end - resp_start} bytes)')
+
+        with memoryview(self.buf) as view:
+            out[:] = view[resp_start:resp_start + n]
+        return (bytes(self.buf[cmd_start:resp_start]),
+                bytes(self.buf[resp_start + n:end]))
+
+    def sync(self, ser, magic):
+        """Skip received bytes up to the next occurrence of magic"""
+        while True:
+            index = self.buf.find(magic, self.pos, self.end)
+            if index >= 0:
+                if index != self.pos:
+                    self.resyncs += 1
+                self.pos = index
+                return
+
+            # keep a partial magic at the end
+            self.pos = max(self.pos, self.end - len(magic) + 1)
+            self.need = len(magic)
+            self.fill(ser)
+
+    def take_into(self, ser, out):
+        """Copy the next len(out) raw bytes of the stream into out"""
+        n = len(out)
+        while self.pending() < n:
+            self.need = n
+            self.fill(ser)
+
+        with memoryview(self.buf) as view:
+            out[:] = view[self.pos:self.pos + n]
+        self.pos += n
+        self.need = self.HEADER_LEN
+
+    def take(self, ser, n):
+        """Next n raw bytes of the stream, outside of any frame"""
+        data = bytearray(n)
+        self.take_into(ser, data)
+        return bytes(data)
+
+    def frames(self):
+        """Yield all complete frames currently buffered"""
+        while True:
+            frame = self.next_frame()
+            if frame is None:
+                return
+            yield frame
+
+    def recv(self, ser):
+        """Block until a complete frame is received"""
+        while True:
+            frame = self.next_frame()
+            if frame is not None:
+                return frame
+            self.fill(ser)
+
+    def recv_into(self, ser, out):
+        """Block until a frame is received, see next_frame_into"""
+        while True:
+            frame = self.next_frame_into(out)
+            if frame is not None:
+                return frame
+            self.fill(ser)
+
+
+def sync_recv(ser, verbose=False, decoder=None, metrics=None, out=None):
+    """Sync on AA 55, then get command and response bytes
+
+    Pass a persistent FrameDecoder to keep bytes that arrive after the frame.
+    With metrics, time spent reading and parsing is recorded per command.
+    With out, the start of the response is copied into it and only the
+    rest is returned, see FrameDecoder.next_frame_into.
+    """
+    if decoder is None:
+        decoder = FrameDecoder(verbose, greedy=False)
+
+    if metrics is None:
+        if out is None:
+            return decoder.recv(ser)
+        return decoder.recv_into(ser, out)
+
+    resyncs = decoder.resyncs
+    read_time = 0.0
+    parse_time = 0.0
     while True:
-        # get number of bytes to receive
-        sync_magic1 = ser.read(1)
-        if len(sync_magic1) != 1:
-            continue
-        if sync_magic1 != b'\xaa':
-            if verbose:
-                print('out of sync')
-                print(sync_magic1)
-            continue
-
-        sync_magic2 = ser.read(1)
-        if len(sync_magic2) != 1 or sync_magic2 != b'\x55':
-            if verbose:
-                print('out of sync 2')
-                print(sync_magic2)
-            continue
-
-        byte_count = ser.read(1)
-        if len(byte_count) != 1:
-            print('error: no command length received')
-        byte_count = ord(byte_count)
-
-        response_byte_count = ser.read(1)
-        if len(response_byte_count) != 1:
-            print('error: no response length received')
-            continue
-        response_byte_count = ord(response_byte_count)
-
-        bytez = ser.read(byte_count)
-        if len(bytez) == 0:
-            continue
-
-        if response_byte_count > 0:
-            response_bytez = ser.read(response_byte_count)
+        start = time.perf_counter()
+        if out is None:
+            frame = decoder.next_frame()
         else:
-            response_bytez = b''
+            frame = decoder.next_frame_into(out)
+        parsed = time.perf_counter()
+        parse_time += parsed - start
+        if frame is not None:
+            break
 
-        return (bytez, response_bytez)
+        decoder.fill(ser)
+        read_time += time.perf_counter() - parsed
 
+    cmd = cmd_name(frame[0])
+    metrics.observe('read', cmd, read_time)
+    metrics.observe('parse', cmd, parse_time)
+    metrics.count('resync', n=decoder.resyncs - resyncs)
+    return frame
 
-def send_cmd(ser, command, verbose=False):
-    """Send length-prefixed TX buffer"""
-    if len(command) > 35:
+
+def pack_cmd(command):
+    """Build length-prefixed TX buffer"""
+    if len(command) > MAX_TX_BYTES:
         # limit based on current maximum in Verilog
-        raise Exception('max TX length is 35')
+        raise Exception(f'max TX length is {MAX_TX_BYTES}')
+
+    return len(command).to_bytes(1, 'big') + command
+
+
+def pack_bulk_read(address, count):
+    """Build the bulk pak read request"""
+    if address & 0x1f != 0:
+        raise ValueError('low 5 bits of address must be clear')
+    if not 0 < count <= MAX_BULK_COUNT:
+        raise ValueError(f'count must be between 1 and {MAX_BULK_COUNT}')
+
+    return BULK_REQUEST.pack(BULK_READ_OPCODE, address, count)
+
+
+def send_cmd(ser, command, verbose=False, decoder=None, metrics=None,
+             out=None):
+    """Send length-prefixed TX buffer
 
-    len_byte = len(command).to_bytes(1, 'big')
-    sendall(ser, len_byte + command)
+    With out, the start of the response lands in out and the remaining
+    response bytes are returned.
+    """
+    if metrics is None:
+        sendall(ser, pack_cmd(command))
+    else:
+        with metrics.timer('write', cmd_name(command)):
+            sendall(ser, pack_cmd(command))
 
-    echo_bytez, response_bytez = sync_recv(ser, verbose)
+    echo_bytez, response_bytez = sync_recv(ser, verbose, decoder, metrics,
+                                           out)
     return response_bytez
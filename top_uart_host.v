@@ -10,12 +10,12 @@ module top (
     output TX, // RS232
 	input  BTN_N, BTN1, BTN2, BTN3,
     inout  P1B1, // bidirectional IO w/ console
-	output LED1, LED2, LED3, LED4, LED5,
+	output LED1, LED2, LED3, LED4, LED5
     `ifdef SEVENSEG_DISPLAY
-	output P1A1, P1A2, P1A3, P1A4, P1A7, P1A8, P1A9, P1A10,
+	, output P1A1, P1A2, P1A3, P1A4, P1A7, P1A8, P1A9, P1A10
     `endif
     `ifdef DEBUG_WIRE
-    output P1B10, // debug output
+    , output P1B10 // debug output
     `endif
 );
 
@@ -25,7 +25,7 @@ module top (
    `endif
 
    // State constants
-   localparam [2:0]
+   localparam [3:0]
      STATE_RESET = 0,
      STATE_UART_LEN = 1,
      STATE_UART_CMD = 2,
@@ -33,14 +33,49 @@ module top (
      STATE_RX = 4,
      STATE_FORWARD_LEN = 5,
      STATE_FORWARD_TX = 6,
-     STATE_FORWARD_RX = 7;
-   reg [2:0] state = STATE_RESET;
+     STATE_FORWARD_RX = 7,
+     STATE_BULK_ARGS = 8,
+     STATE_BULK_HEADER = 9,
+     STATE_BULK_CMD = 10,
+     STATE_BULK_CRC1 = 11,
+     STATE_BULK_CRC2 = 12,
+     STATE_BULK_FORWARD = 13;
+   reg [3:0] state = STATE_RESET;
    reg       error_flag = 0;
 
    // expecting at most 35 bytes (1 cmd byte + 34 optional data bytes)
    localparam MAX_RX_BYTES = 33;
    localparam MAX_TX_BYTES = 35;
 
+   localparam [7:0] CMD_PAK_READ = 8'h 02;
+
+   // Bulk pak read
+   // Sent in place of a length byte, followed by a 16 bit start address
+   // and 16 bit chunk count (big endian). The bridge issues the pak reads
+   // itself and replies with AA 5A <address> <count>, then one record per
+   // chunk: <status> <32 data bytes> <data CRC from the pak>.
+   localparam [7:0] BULK_READ_OPCODE = 8'h 80;
+   localparam BULK_ARG_BYTES = 4;
+   localparam BULK_HEADER_BYTES = 6;
+   localparam BULK_RECORD_BYTES = 34;
+
+   // Bulk record status bits
+   localparam
+     BULK_STATUS_CRC = 0,    // data CRC mismatch
+     BULK_STATUS_LENGTH = 1, // response was not 33 bytes
+     BULK_STATUS_RX = 2;     // JoyBus receive error
+
+   reg         bulk_active = 0;
+   reg [15:0]  bulk_addr;
+   reg [15:0]  bulk_count;
+   reg [7:0]   bulk_status;
+
+   // Data CRC of bulk read chunks
+   reg [7:0]   datacrc_in = 8'h 00;
+   wire [7:0]  datacrc_out;
+   reg         datacrc_enable = 0;
+   reg         datacrc_reset = 0;
+
    // Joybus RX module stuff
    reg [5:0]   rx_n_bytes = 0;
    reg [7:0]   rx_bytes [0:MAX_RX_BYTES-1];
@@ -90,7 +125,7 @@ module top (
    assign { P1A10, P1A9, P1A8, P1A7, P1A4, P1A3, P1A2, P1A1 } = seven_segment;
 
    wire [7:0] display_wire;
-   assign display_wire = {5'd 0, state[2:0]};
+   assign display_wire = {4'd 0, state[3:0]};
 
    // 7 segment display control Pmod 1A
    seven_seg_ctrl seven_segment_ctrl (
@@ -123,6 +158,38 @@ module top (
                        `endif
                        );
 
+   datacrc datacrc (
+                    .data_in(datacrc_in),
+                    .crc_en(datacrc_enable),
+                    .crc_out(datacrc_out),
+                    .rst(datacrc_reset),
+                    .clk(CLK)
+                    );
+
+   // 5 bit CRC of a pak address (bits 15:5), polynomial 0x15
+   function [4:0] address_crc (input [10:0] page);
+      integer i;
+      reg [4:0] crc;
+      reg       msb;
+      begin
+         crc = 0;
+         for (i = 10; i >= 0; i = i - 1) begin
+            msb = crc[4];
+            crc = {crc[3:0], page[i]};
+            if (msb)
+              crc = crc ^ 5'h 15;
+         end
+         // flush with 5 zero bits
+         for (i = 0; i < 5; i = i + 1) begin
+            msb = crc[4];
+            crc = {crc[3:0], 1'b 0};
+            if (msb)
+              crc = crc ^ 5'h 15;
+         end
+         address_crc = crc;
+      end
+   endfunction // address_crc
+
    // UART stuff
    reg        uart_reset = 0;
    reg        uart_transmit = 0;
@@ -158,6 +225,55 @@ module top (
 		 .recv_error(uart_recv_error)           // Indicates error in receiving packet.
 	     );
 
+   // UART receive FIFO
+   // Lets the host queue commands while a JoyBus transaction is in progress,
+   // otherwise bytes received outside of STATE_UART_LEN/STATE_UART_CMD are lost.
+   localparam UART_FIFO_BITS = 8;
+   reg [7:0]  uart_fifo [0:(1<<UART_FIFO_BITS)-1];
+   reg [UART_FIFO_BITS-1:0] uart_fifo_head = 0;
+   reg [UART_FIFO_BITS-1:0] uart_fifo_tail = 0;
+   reg        uart_fifo_overflow = 0;
+
+   // One cycle pulse when uart_fifo_byte holds the next received byte
+   reg        uart_fifo_valid = 0;
+   reg [7:0]  uart_fifo_byte;
+
+   wire       uart_fifo_empty;
+   wire       uart_fifo_full;
+   wire       uart_fifo_pop;
+   assign uart_fifo_empty = uart_fifo_head == uart_fifo_tail;
+   assign uart_fifo_full = (uart_fifo_head + 1'b 1) == uart_fifo_tail;
+   assign uart_fifo_pop = (state == STATE_UART_LEN ||
+                           (state == STATE_UART_CMD && buf_i < tx_n_bytes) ||
+                           (state == STATE_BULK_ARGS &&
+                            buf_i < BULK_ARG_BYTES)) &&
+                          !uart_fifo_valid && !uart_fifo_empty;
+
+   always @(posedge CLK) begin
+      uart_fifo_valid <= 0;
+
+      if (state == STATE_RESET || !BTN_N) begin
+         uart_fifo_head <= 0;
+         uart_fifo_tail <= 0;
+         uart_fifo_overflow <= 0;
+      end else begin
+         if (uart_received) begin
+            if (!uart_fifo_full) begin
+               uart_fifo[uart_fifo_head] <= uart_rx_byte;
+               uart_fifo_head <= uart_fifo_head + 1;
+            end else begin
+               uart_fifo_overflow <= 1;
+            end
+         end
+
+         if (uart_fifo_pop) begin
+            uart_fifo_byte <= uart_fifo[uart_fifo_tail];
+            uart_fifo_tail <= uart_fifo_tail + 1;
+            uart_fifo_valid <= 1;
+         end
+      end
+   end
+
    always @(posedge CLK) begin
       // Reset
       if (state == STATE_RESET || !BTN_N) begin
@@ -165,6 +281,8 @@ module top (
          tx_enabled <= 0;
          error_flag <= 0;
          buf_i <= 0;
+         bulk_active <= 0;
+         datacrc_enable <= 0;
 
          uart_transmit <= 0;
          uart_fwd_sync_state <= UART_SYNC_MAGIC1;
@@ -178,18 +296,128 @@ module top (
          uart_reset <= 0;
 
          // Wait for initial cmd length byte on UART
-         if (uart_received) begin
-            // TODO check MAX_TX_BYTES
-            tx_n_bytes <= uart_rx_byte[5:0];
+         if (uart_fifo_valid) begin
             buf_i <= 0;
-            state <= STATE_UART_CMD;
+            if (uart_fifo_byte == BULK_READ_OPCODE) begin
+               state <= STATE_BULK_ARGS;
+            end else begin
+               // TODO check MAX_TX_BYTES
+               tx_n_bytes <= uart_fifo_byte[5:0];
+               state <= STATE_UART_CMD;
+            end
+         end
+      end
+
+      else if (state == STATE_BULK_ARGS) begin
+         // start address and chunk count, big endian
+         if (buf_i < BULK_ARG_BYTES) begin
+            if (uart_fifo_valid) begin
+               case (buf_i)
+                 0: bulk_addr[15:8] <= uart_fifo_byte;
+                 // chunks are 32 byte aligned
+                 1: bulk_addr[7:0] <= {uart_fifo_byte[7:5], 5'b 00000};
+                 2: bulk_count[15:8] <= uart_fifo_byte;
+                 default: bulk_count[7:0] <= uart_fifo_byte;
+               endcase
+               buf_i <= buf_i + 1;
+            end
+         end else begin
+            buf_i <= 0;
+            state <= STATE_BULK_HEADER;
+         end
+      end
+
+      else if (state == STATE_BULK_HEADER) begin
+         // send AA 5A <address> <count>
+         if (uart_transmit) begin
+            uart_transmit <= 0;
+         end else if (buf_i < BULK_HEADER_BYTES) begin
+            if (!uart_is_transmitting) begin
+               case (buf_i)
+                 0: uart_tx_byte <= 8'h AA;
+                 1: uart_tx_byte <= 8'h 5A;
+                 2: uart_tx_byte <= bulk_addr[15:8];
+                 3: uart_tx_byte <= bulk_addr[7:0];
+                 4: uart_tx_byte <= bulk_count[15:8];
+                 default: uart_tx_byte <= bulk_count[7:0];
+               endcase
+               buf_i <= buf_i + 1;
+               uart_transmit <= 1;
+            end
+         end else begin
+            buf_i <= 0;
+            state <= STATE_BULK_CMD;
+         end
+      end
+
+      else if (state == STATE_BULK_CMD) begin
+         if (bulk_count == 0) begin
+            bulk_active <= 0;
+            state <= STATE_UART_LEN;
+         end else begin
+            // pak read of the next chunk, address packed with its CRC
+            tx_bytes[0] <= CMD_PAK_READ;
+            tx_bytes[1] <= bulk_addr[15:8];
+            tx_bytes[2] <= {bulk_addr[7:5], address_crc(bulk_addr[15:5])};
+            tx_n_bytes <= 3;
+            bulk_active <= 1;
+            state <= STATE_TX;
+         end
+      end
+
+      else if (state == STATE_BULK_CRC1) begin
+         if (!datacrc_reset) begin
+            datacrc_reset <= 1;
+            buf_i <= 0;
+         end else begin
+            datacrc_reset <= 0;
+            state <= STATE_BULK_CRC2;
+         end
+      end
+
+      else if (state == STATE_BULK_CRC2) begin
+         if (buf_i < 32) begin
+            datacrc_in <= rx_bytes[buf_i];
+            datacrc_enable <= 1;
+            buf_i <= buf_i + 1;
+         end else if (datacrc_enable) begin
+            // extra cycle for CRC calculation to propagate to result
+            datacrc_enable <= 0;
+         end else begin
+            bulk_status <= 0;
+            bulk_status[BULK_STATUS_CRC] <= datacrc_out != rx_bytes[32];
+            bulk_status[BULK_STATUS_LENGTH] <= rx_n_bytes != MAX_RX_BYTES;
+            bulk_status[BULK_STATUS_RX] <= rx_error;
+            buf_i <= 0;
+            state <= STATE_BULK_FORWARD;
+         end
+      end
+
+      else if (state == STATE_BULK_FORWARD) begin
+         // send <status> <32 data bytes> <data CRC>
+         if (uart_transmit) begin
+            uart_transmit <= 0;
+         end else if (buf_i < BULK_RECORD_BYTES) begin
+            if (!uart_is_transmitting) begin
+               if (buf_i == 0)
+                 uart_tx_byte <= bulk_status;
+               else
+                 uart_tx_byte <= rx_bytes[buf_i - 1];
+               buf_i <= buf_i + 1;
+               uart_transmit <= 1;
+            end
+         end else begin
+            buf_i <= 0;
+            bulk_addr <= bulk_addr + 32;
+            bulk_count <= bulk_count - 1;
+            state <= STATE_BULK_CMD;
          end
       end
 
       else if (state == STATE_UART_CMD) begin
          if (buf_i < tx_n_bytes) begin
-            if (uart_received) begin
-               tx_bytes[buf_i] <= uart_rx_byte;
+            if (uart_fifo_valid) begin
+               tx_bytes[buf_i] <= uart_fifo_byte;
                buf_i <= buf_i + 1;
             end
          end else begin
@@ -233,11 +461,14 @@ module top (
             if (rx_error) begin
                error_flag <= 1;
                // TODO send the bad buffer?
-               state <= STATE_FORWARD_LEN;
             end else begin
                error_flag <= 0;
-               state <= STATE_FORWARD_LEN;
             end
+
+            if (bulk_active)
+              state <= STATE_BULK_CRC1;
+            else
+              state <= STATE_FORWARD_LEN;
          end // if (rx_finished)
       end // if (state == STATE_RX)
 
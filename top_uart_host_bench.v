@@ -0,0 +1,297 @@
+// Transaction latency benchmark for the UART host bridge
+//
+// Sends each command type to the bridge a few times and counts the clock
+// cycles spent in each bridge state, from the first UART byte sent by the
+// host until the last response byte arrives back. Run with
+// `make bench_uart_host`; `+runs=N` and `+bulk_count=N` change the number
+// of transactions per command and chunks per bulk read, `+csv=FILE` also
+// writes the results as CSV.
+//
+// Bytes still arriving from the host and the tail of the last UART byte
+// back to it are counted as UART_LEN, since the bridge has already
+// returned there.
+`timescale 1ns / 1ps
+`default_nettype none
+
+module top_uart_host_bench;
+
+   // 12 MHz system clock
+   localparam real CLK_PERIOD = 1000.0 / 12.0;
+   localparam CLK_MHZ = 12;
+
+   reg CLK = 0;
+   always #(CLK_PERIOD / 2) CLK = ~CLK;
+
+   wire RX, TX;
+   reg  BTN_N = 0;
+   wire LED1, LED2, LED3, LED4, LED5;
+   wire P1A1, P1A2, P1A3, P1A4, P1A7, P1A8, P1A9, P1A10;
+
+   // Open drain JoyBus line with a pull-up
+   wire joybus;
+   pullup (joybus);
+
+   uart_host_model host (.tx(RX), .rx(TX));
+   joybus_device_model pad (.line(joybus));
+
+   top dut (
+            .CLK(CLK),
+            .RX(RX),
+            .TX(TX),
+            .BTN_N(BTN_N),
+            .BTN1(1'b 0),
+            .BTN2(1'b 0),
+            .BTN3(1'b 0),
+            .P1B1(joybus),
+            .LED1(LED1),
+            .LED2(LED2),
+            .LED3(LED3),
+            .LED4(LED4),
+            .LED5(LED5),
+            .P1A1(P1A1),
+            .P1A2(P1A2),
+            .P1A3(P1A3),
+            .P1A4(P1A4),
+            .P1A7(P1A7),
+            .P1A8(P1A8),
+            .P1A9(P1A9),
+            .P1A10(P1A10)
+            );
+
+   localparam N_STATES = 16;
+
+   localparam
+     CMD_INFO = 0,
+     CMD_STATE = 1,
+     CMD_PAK_READ = 2,
+     CMD_PAK_WRITE = 3,
+     CMD_BULK_READ = 4,
+     N_CMDS = 5;
+
+   function [8*16-1:0] state_name (input integer s);
+      case (s)
+        0: state_name = "RESET";
+        1: state_name = "UART_LEN";
+        2: state_name = "UART_CMD";
+        3: state_name = "TX";
+        4: state_name = "RX";
+        5: state_name = "FORWARD_LEN";
+        6: state_name = "FORWARD_TX";
+        7: state_name = "FORWARD_RX";
+        8: state_name = "BULK_ARGS";
+        9: state_name = "BULK_HEADER";
+        10: state_name = "BULK_CMD";
+        11: state_name = "BULK_CRC1";
+        12: state_name = "BULK_CRC2";
+        13: state_name = "BULK_FORWARD";
+        default: state_name = "?";
+      endcase
+   endfunction
+
+   function [8*16-1:0] cmd_name (input integer c);
+      case (c)
+        CMD_INFO: cmd_name = "info";
+        CMD_STATE: cmd_name = "state";
+        CMD_PAK_READ: cmd_name = "pak_read";
+        CMD_PAK_WRITE: cmd_name = "pak_write";
+        CMD_BULK_READ: cmd_name = "bulk_read";
+        default: cmd_name = "?";
+      endcase
+   endfunction
+
+   // Cycle counters for the transaction in progress
+
+   integer cycle = 0;
+   reg     measuring = 0;
+   integer state_cycles [0:N_STATES-1];
+
+   // dut.state still holds the state of the cycle that just ended
+   always @(posedge CLK) begin
+      cycle = cycle + 1;
+      if (measuring)
+        state_cycles[dut.state] = state_cycles[dut.state] + 1;
+   end
+
+   // Totals per command type
+
+   integer total_state_cycles [0:N_CMDS*N_STATES-1];
+   integer total_cycles [0:N_CMDS-1];
+   integer total_chunks [0:N_CMDS-1];
+   integer n_runs [0:N_CMDS-1];
+   integer errors = 0;
+
+   reg [7:0] cmd_buf [0:35];
+
+   // Send cmd_buf[0:n_tx-1] and wait for n_rx response bytes
+   task transaction (input integer cmd, input integer n_tx,
+                     input integer n_rx, input integer n_chunks);
+      integer start, base, s;
+      begin
+         for (s = 0; s < N_STATES; s = s + 1)
+           state_cycles[s] = 0;
+         base = host.n_received;
+
+         @(posedge CLK);
+         start = cycle;
+         measuring = 1;
+         for (s = 0; s < n_tx; s = s + 1)
+           host.send(cmd_buf[s]);
+         host.wait_bytes(base + n_rx);
+         @(posedge CLK);
+         measuring = 0;
+
+         if (host.rx_buf[base] !== 8'h AA) begin
+            $display("%0s: response starts with %02x", cmd_name(cmd),
+                     host.rx_buf[base]);
+            errors = errors + 1;
+         end
+
+         total_cycles[cmd] = total_cycles[cmd] + cycle - start;
+         total_chunks[cmd] = total_chunks[cmd] + n_chunks;
+         n_runs[cmd] = n_runs[cmd] + 1;
+         for (s = 0; s < N_STATES; s = s + 1)
+           total_state_cycles[cmd * N_STATES + s] =
+             total_state_cycles[cmd * N_STATES + s] + state_cycles[s];
+
+         // let the line settle before the next command
+         #(host.BIT_TIME * 20);
+      end
+   endtask
+
+   task set_pak_address (input [15:0] addr);
+      begin
+         cmd_buf[2] = addr[15:8];
+         cmd_buf[3] = {addr[7:5], pad.address_crc(addr[15:5])};
+      end
+   endtask
+
+   task report_line (input integer fd, input integer cmd,
+                     input [8*16-1:0] label, input integer cycles);
+      real cycles_avg;
+      begin
+         cycles_avg = 1.0 * cycles / n_runs[cmd];
+         $display("  %s %10.1f cycles %10.2f us", label, cycles_avg,
+                  cycles_avg / CLK_MHZ);
+         if (fd != 0)
+           $fdisplay(fd, "%0s,%0s,%0.1f,%0.2f", cmd_name(cmd), label,
+                     cycles_avg, cycles_avg / CLK_MHZ);
+      end
+   endtask
+
+   task report (input integer fd);
+      integer c, s;
+      real    per_chunk;
+      reg [8*16-1:0] label;
+      begin
+         if (fd != 0)
+           $fdisplay(fd, "command,state,cycles,us");
+         for (c = 0; c < N_CMDS; c = c + 1) begin
+            if (n_runs[c] != 0) begin
+               $display("%0s: %0d runs", cmd_name(c), n_runs[c]);
+               for (s = 0; s < N_STATES; s = s + 1)
+                 if (total_state_cycles[c * N_STATES + s] != 0)
+                   report_line(fd, c, state_name(s),
+                               total_state_cycles[c * N_STATES + s]);
+               report_line(fd, c, "total", total_cycles[c]);
+
+               if (total_chunks[c] > n_runs[c]) begin
+                  per_chunk = 1.0 * total_cycles[c] / total_chunks[c];
+                  label = "per chunk";
+                  $display("  %s %10.1f cycles %10.2f us", label,
+                           per_chunk, per_chunk / CLK_MHZ);
+               end
+            end
+         end
+      end
+   endtask
+
+   integer runs = 4;
+   integer bulk_count = 8;
+   reg [8*256-1:0] csv_filename;
+   integer         fd = 0;
+   integer         i, j;
+   reg [15:0]      addr;
+   initial begin
+      if (!$value$plusargs("runs=%d", runs))
+        runs = 4;
+      if (!$value$plusargs("bulk_count=%d", bulk_count))
+        bulk_count = 8;
+
+      for (i = 0; i < N_STATES; i = i + 1)
+        state_cycles[i] = 0;
+      for (i = 0; i < N_CMDS * N_STATES; i = i + 1)
+        total_state_cycles[i] = 0;
+      for (i = 0; i < N_CMDS; i = i + 1) begin
+         total_cycles[i] = 0;
+         total_chunks[i] = 0;
+         n_runs[i] = 0;
+      end
+
+      for (i = 0; i < 32768; i = i + 1)
+        pad.pak_mem[i] = (i * 7) ^ (i >> 8);
+
+      // hold reset for a few cycles
+      #(CLK_PERIOD * 10);
+      BTN_N = 1;
+      #(CLK_PERIOD * 10);
+
+      for (i = 0; i < runs; i = i + 1) begin
+         addr = 16'h 0100 + i * 32;
+
+         cmd_buf[0] = 8'h 01;
+         cmd_buf[1] = 8'h 00;
+         transaction(CMD_INFO, 2, 4 + 1 + 3, 1);
+
+         cmd_buf[0] = 8'h 01;
+         cmd_buf[1] = 8'h 01;
+         transaction(CMD_STATE, 2, 4 + 1 + 4, 1);
+
+         cmd_buf[0] = 8'h 03;
+         cmd_buf[1] = 8'h 02;
+         set_pak_address(addr);
+         transaction(CMD_PAK_READ, 4, 4 + 3 + 33, 1);
+
+         cmd_buf[0] = 8'h 23;
+         cmd_buf[1] = 8'h 03;
+         set_pak_address(addr);
+         for (j = 0; j < 32; j = j + 1)
+           cmd_buf[4 + j] = i + j;
+         transaction(CMD_PAK_WRITE, 36, 4 + 35 + 1, 1);
+
+         cmd_buf[0] = 8'h 80;
+         cmd_buf[1] = addr[15:8];
+         cmd_buf[2] = addr[7:0];
+         cmd_buf[3] = bulk_count >> 8;
+         cmd_buf[4] = bulk_count;
+         transaction(CMD_BULK_READ, 5, 6 + bulk_count * 34, bulk_count);
+      end
+
+      errors = errors + pad.n_addr_crc_errors + pad.n_unknown +
+               host.n_framing_errors;
+
+      if ($value$plusargs("csv=%s", csv_filename)) begin
+         fd = $fopen(csv_filename, "w");
+         if (fd == 0)
+           $display("can't open %0s", csv_filename);
+      end
+
+      $display("cycles at %0d MHz, averaged per transaction", CLK_MHZ);
+      report(fd);
+      if (fd != 0)
+        $fclose(fd);
+
+      if (errors == 0)
+        $display("PASS");
+      else
+        $display("FAIL: %0d errors", errors);
+      $finish;
+   end
+
+   // give up if the bridge hangs
+   initial begin
+      #1_000_000_000;
+      $display("FAIL: timeout");
+      $finish;
+   end
+
+endmodule // top_uart_host_bench
@@ -0,0 +1,172 @@
+// Testbench for the UART host bridge bulk pak read
+//
+// Drives the bridge's UART like the host software, with a controller and
+// Controller Pak modelled on the JoyBus line. Run with
+// `make sim_uart_host`, or `make top_uart_host_tb.vcd` for a waveform.
+`timescale 1ns / 1ps
+`default_nettype none
+
+module top_uart_host_tb;
+
+   // 12 MHz system clock, 1.5 Mbaud UART
+   localparam real CLK_PERIOD = 1000.0 / 12.0;
+
+   reg CLK = 0;
+   always #(CLK_PERIOD / 2) CLK = ~CLK;
+
+   wire RX, TX;
+   reg  BTN_N = 0;
+   wire LED1, LED2, LED3, LED4, LED5;
+   wire P1A1, P1A2, P1A3, P1A4, P1A7, P1A8, P1A9, P1A10;
+
+   // Open drain JoyBus line with a pull-up
+   wire joybus;
+   pullup (joybus);
+
+   uart_host_model host (.tx(RX), .rx(TX));
+   joybus_device_model pad (.line(joybus));
+
+   top dut (
+            .CLK(CLK),
+            .RX(RX),
+            .TX(TX),
+            .BTN_N(BTN_N),
+            .BTN1(1'b 0),
+            .BTN2(1'b 0),
+            .BTN3(1'b 0),
+            .P1B1(joybus),
+            .LED1(LED1),
+            .LED2(LED2),
+            .LED3(LED3),
+            .LED4(LED4),
+            .LED5(LED5),
+            .P1A1(P1A1),
+            .P1A2(P1A2),
+            .P1A3(P1A3),
+            .P1A4(P1A4),
+            .P1A7(P1A7),
+            .P1A8(P1A8),
+            .P1A9(P1A9),
+            .P1A10(P1A10)
+            );
+
+   integer errors = 0;
+
+   task expect_byte (input integer i, input [7:0] expected);
+      begin
+         if (host.rx_buf[i] !== expected) begin
+            $display("byte %0d: got %02x, expected %02x", i, host.rx_buf[i],
+                     expected);
+            errors = errors + 1;
+         end
+      end
+   endtask
+
+   // Check one bulk record against the pak model
+   task check_record (input integer offset, input [15:0] addr,
+                      input [7:0] status);
+      integer i;
+      begin
+         $display("record %04x: status %02x, CRC %02x", addr,
+                  host.rx_buf[offset], host.rx_buf[offset + 33]);
+         expect_byte(offset, status);
+         for (i = 0; i < 32; i = i + 1)
+           expect_byte(offset + 1 + i, pad.pak_mem[addr[14:0] + i]);
+         if (status == 0)
+           expect_byte(offset + 33, pad.chunk_crc(addr));
+         else
+           expect_byte(offset + 33, ~pad.chunk_crc(addr));
+      end
+   endtask
+
+   localparam [15:0] BULK_ADDR = 16'h 0120;
+   localparam        BULK_COUNT = 5;
+
+   integer base, i;
+   initial begin
+      if ($test$plusargs("vcd")) begin
+         $dumpfile("top_uart_host_tb.vcd");
+         $dumpvars(0, top_uart_host_tb);
+      end
+
+      for (i = 0; i < 32768; i = i + 1)
+        pad.pak_mem[i] = (i * 7) ^ (i >> 8);
+
+      // hold reset for a few cycles
+      #(CLK_PERIOD * 10);
+      BTN_N = 1;
+      #(CLK_PERIOD * 10);
+
+      // Ordinary framed command still works: info
+      host.send(8'h 01);
+      host.send(8'h 00);
+      host.wait_bytes(8);
+      expect_byte(0, 8'h AA);
+      expect_byte(1, 8'h 55);
+      expect_byte(2, 8'h 01);
+      expect_byte(3, 8'h 03);
+      expect_byte(4, 8'h 00);
+      expect_byte(5, 8'h 05);
+      expect_byte(6, 8'h 00);
+      expect_byte(7, 8'h 01);
+
+      // Bulk read, third chunk answered with a bad CRC
+      pad.corrupt_addr = BULK_ADDR + 2 * 32;
+      base = host.n_received;
+      host.send(8'h 80);
+      host.send(BULK_ADDR[15:8]);
+      host.send(BULK_ADDR[7:0]);
+      host.send(8'h 00);
+      host.send(BULK_COUNT);
+
+      host.wait_bytes(base + 6 + BULK_COUNT * 34);
+      expect_byte(base + 0, 8'h AA);
+      expect_byte(base + 1, 8'h 5A);
+      expect_byte(base + 2, BULK_ADDR[15:8]);
+      expect_byte(base + 3, BULK_ADDR[7:0]);
+      expect_byte(base + 4, 8'h 00);
+      expect_byte(base + 5, BULK_COUNT);
+
+      for (i = 0; i < BULK_COUNT; i = i + 1)
+        check_record(base + 6 + i * 34, BULK_ADDR + i * 32,
+                     (BULK_ADDR + i * 32 == pad.corrupt_addr) ?
+                     8'h 01 : 8'h 00);
+
+      if (pad.n_pak_reads != BULK_COUNT) begin
+         $display("%0d pak reads, expected %0d", pad.n_pak_reads,
+                  BULK_COUNT);
+         errors = errors + 1;
+      end
+
+      // nothing else is sent, and the bridge takes commands again
+      #(host.BIT_TIME * 40);
+      if (host.n_received != base + 6 + BULK_COUNT * 34) begin
+         $display("%0d extra bytes",
+                  host.n_received - base - 6 - BULK_COUNT * 34);
+         errors = errors + 1;
+      end
+
+      base = host.n_received;
+      host.send(8'h 01);
+      host.send(8'h 00);
+      host.wait_bytes(base + 8);
+      expect_byte(base + 0, 8'h AA);
+      expect_byte(base + 7, 8'h 01);
+
+      errors = errors + pad.n_addr_crc_errors + pad.n_unknown +
+               host.n_framing_errors;
+      if (errors == 0)
+        $display("PASS");
+      else
+        $display("FAIL: %0d errors", errors);
+      $finish;
+   end
+
+   // give up if the bridge hangs
+   initial begin
+      #50_000_000;
+      $display("FAIL: timeout");
+      $finish;
+   end
+
+endmodule // top_uart_host_tb
@@ -0,0 +1,59 @@
+// Simulation model of the host side of the bridge's UART, 8N1
+`timescale 1ns / 1ps
+`default_nettype none
+
+module uart_host_model (
+                        output reg tx,
+                        input wire rx
+                        );
+
+   // bit time in ns, 1.5 Mbaud by default
+   parameter real BIT_TIME = 1000.0 / 1.5;
+
+   initial tx = 1;
+
+   reg [7:0] rx_buf [0:8191];
+   integer   n_received = 0;
+   integer   n_framing_errors = 0;
+
+   task send (input [7:0] b);
+      integer i;
+      begin
+         tx = 0;
+         #(BIT_TIME);
+         for (i = 0; i < 8; i = i + 1) begin
+            tx = b[i];
+            #(BIT_TIME);
+         end
+         tx = 1;
+         #(BIT_TIME);
+      end
+   endtask
+
+   // Wait until n bytes have been received in total
+   task wait_bytes (input integer n);
+      begin
+         while (n_received < n)
+           #(BIT_TIME);
+      end
+   endtask
+
+   reg [7:0] rx_byte;
+   integer   i;
+   always begin
+      @(negedge rx);
+      // sample in the middle of each bit
+      #(BIT_TIME * 1.5);
+      for (i = 0; i < 8; i = i + 1) begin
+         rx_byte[i] = rx;
+         #(BIT_TIME);
+      end
+      if (rx != 1) begin
+         $display("UART framing error");
+         n_framing_errors = n_framing_errors + 1;
+      end
+      rx_buf[n_received] = rx_byte;
+      n_received = n_received + 1;
+   end
+
+endmodule // uart_host_model